@@ -0,0 +1,255 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# 动作优先级：撤回有时间窗口，总是先于提示消息发送
+RECALL = 0
+MESSAGE = 1
+
+WARNINGS_MERGED = REGISTRY.counter('antisetu_warnings_merged_total', '被合并进汇总消息的违规警告数')
+RECALLS_DEDUPLICATED = REGISTRY.counter('antisetu_recalls_deduplicated_total', '重复提交而被合并的撤回数')
+
+
+class TokenBucket:
+    """令牌桶：每秒补充 rate 个令牌，最多积攒 burst 个；rate 为 0 表示不限速"""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = float(rate or 0)
+        self.capacity = max(1.0, float(burst or 1))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        if self.rate > 0:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """距离下一个令牌可用还需等待的秒数"""
+        if self.rate <= 0:
+            return 0.0
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self, now: float):
+        if self.rate <= 0:
+            return
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.rate <= 0 or self.tokens >= self.capacity
+
+
+class _Action:
+    __slots__ = ('priority', 'group_id', 'func', 'future', 'key')
+
+    def __init__(self, priority: int, group_id: str, func: Callable[[], Awaitable[Any]], future: asyncio.Future,
+                 key: Optional[Any] = None):
+        self.priority = priority
+        self.group_id = group_id
+        self.func = func
+        self.future = future
+        self.key = key
+
+
+class ActionScheduler:
+    """出站动作调度：账号级和群级令牌桶限速，合并短时间内的违规警告，撤回优先
+
+    - 撤回只受账号令牌桶限制，并且总是先于提示消息发送；同一条消息重复提交的撤回只执行一次；
+    - 提示消息同时受账号和所在群的令牌桶限制，某个群被限速时不影响其他群的消息；
+    - 一个群的第一条违规警告立即发送，之后 warning_window 秒内的警告合并为一条汇总消息在窗口结束时发送；
+      窗口内有警告时接着开始下一个窗口，没有时窗口关闭，下一条警告再次立即发送。
+    """
+
+    def __init__(self, send_group_message: Callable[[str, str], Awaitable[Any]], config: Optional[Dict[str, Any]] = None):
+        config = config or {}
+        scheduler_config = config.get('action_scheduler', {})
+        self.enabled = bool(scheduler_config.get('enabled', True))
+        self.send_group_message = send_group_message
+        self.account_rate = float(scheduler_config.get('account_rate', 5))
+        self.account_burst = float(scheduler_config.get('account_burst', 10))
+        self.group_rate = float(scheduler_config.get('group_rate', 0.5))
+        self.group_burst = float(scheduler_config.get('group_burst', 2))
+        self.warning_window = float(scheduler_config.get('warning_window', 5))
+        self.max_group_buckets = int(scheduler_config.get('max_group_buckets', 1000))
+        self.account_bucket = TokenBucket(self.account_rate, self.account_burst)
+        self._group_buckets: Dict[str, TokenBucket] = {}
+        self._queues: List[Deque[_Action]] = [deque(), deque()]
+        self._pending_recalls: Dict[Any, _Action] = {}
+        self._warnings: Dict[str, List[Dict[str, Any]]] = {}
+        self._warning_timers: Dict[str, asyncio.TimerHandle] = {}
+        self._running: set = set()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._worker_task: Optional[asyncio.Task] = None
+        if self.enabled:
+            logger.info(f"出站动作调度已启用: 账号 {self.account_rate}/s（突发 {self.account_burst}），"
+                        f"单群消息 {self.group_rate}/s（突发 {self.group_burst}），警告合并窗口 {self.warning_window}s")
+
+    @property
+    def pending(self) -> int:
+        """排队中的动作数"""
+        return sum(len(queue) for queue in self._queues)
+
+    def start(self):
+        if self._worker_task is not None:
+            return
+        self._wakeup = asyncio.Event()
+        self._worker_task = asyncio.ensure_future(self._worker())
+
+    def submit(self, priority: int, group_id: str, func: Callable[[], Awaitable[Any]],
+               key: Optional[Any] = None) -> asyncio.Future:
+        """提交一个动作，返回在动作执行完成后得到结果的 Future
+
+        key 相同的撤回在排队期间只保留一个。
+        """
+        self.start()
+        if priority == RECALL and key is not None and key in self._pending_recalls:
+            RECALLS_DEDUPLICATED.inc()
+            return self._pending_recalls[key].future
+        action = _Action(priority, str(group_id), func, asyncio.get_event_loop().create_future(), key)
+        if priority == RECALL and key is not None:
+            self._pending_recalls[key] = action
+        self._queues[priority].append(action)
+        self._wakeup.set()
+        return action.future
+
+    def recall(self, group_id: str, message_id: int, func: Callable[[], Awaitable[Any]]) -> asyncio.Future:
+        """提交撤回"""
+        return self.submit(RECALL, group_id, func, key=message_id)
+
+    def warn(self, group_id: str, user_id: str, labels: List[str], text: str):
+        """登记一条违规警告：群内没有进行中的合并窗口时立即发送，否则等窗口结束时合并发送"""
+        self.start()
+        group_id = str(group_id)
+        entry = {'user_id': str(user_id), 'labels': labels, 'text': text}
+        if group_id in self._warning_timers:
+            self._warnings[group_id].append(entry)
+            return
+        self._send_warnings(group_id, [entry])
+        self._open_warning_window(group_id)
+
+    def _open_warning_window(self, group_id: str):
+        if self.warning_window <= 0:
+            return
+        self._warnings[group_id] = []
+        loop = asyncio.get_event_loop()
+        self._warning_timers[group_id] = loop.call_later(self.warning_window, self._flush_warnings, group_id)
+
+    def _flush_warnings(self, group_id: str, reopen: bool = True):
+        """合并窗口结束：发出窗口内的警告；有警告时开始下一个窗口"""
+        timer = self._warning_timers.pop(group_id, None)
+        if timer is not None:
+            timer.cancel()
+        entries = self._warnings.pop(group_id, None)
+        if not entries:
+            return
+        self._send_warnings(group_id, entries)
+        if reopen:
+            self._open_warning_window(group_id)
+
+    def _send_warnings(self, group_id: str, entries: List[Dict[str, Any]]):
+        if len(entries) == 1:
+            text = entries[0]['text']
+        else:
+            WARNINGS_MERGED.inc(len(entries))
+            text = self.format_summary(entries)
+        self.submit(MESSAGE, group_id, lambda: self.send_group_message(group_id, text))
+
+    def format_summary(self, entries: List[Dict[str, Any]]) -> str:
+        """多条警告的汇总消息"""
+        label_counts: Dict[str, int] = {}
+        for entry in entries:
+            for label in entry['labels'] or ['违规']:
+                label_counts[label] = label_counts.get(label, 0) + 1
+        users = list(dict.fromkeys(entry['user_id'] for entry in entries))
+        labels_text = "、".join(f"{label}×{count}" for label, count in label_counts.items())
+        users_text = "、".join(users[:10]) + (f" 等 {len(users)} 人" if len(users) > 10 else "")
+        return (f"⚠️ 最近 {self.warning_window:g} 秒内检测到 {len(entries)} 张可能违规的图片!\n"
+                f"违规类型: {labels_text}\n涉及成员: {users_text}\n请注意群规，维护良好的聊天环境。")
+
+    def _group_bucket(self, group_id: str, now: float) -> TokenBucket:
+        bucket = self._group_buckets.get(group_id)
+        if bucket is None:
+            if len(self._group_buckets) >= self.max_group_buckets:
+                # 只清理已经补满的桶，等同于从未限速过
+                for key in [key for key, value in self._group_buckets.items() if value.is_full(now)]:
+                    del self._group_buckets[key]
+            bucket = self._group_buckets[group_id] = TokenBucket(self.group_rate, self.group_burst)
+        return bucket
+
+    def _take_next(self, now: float):
+        """取出下一个可以执行的动作；都需要等待时返回最短等待秒数"""
+        account_wait = self.account_bucket.wait_time(now)
+        if account_wait > 0:
+            return None, account_wait
+        recalls, messages = self._queues
+        if recalls:
+            action = recalls.popleft()
+            if action.key is not None:
+                self._pending_recalls.pop(action.key, None)
+            self.account_bucket.consume(now)
+            return action, 0.0
+        wait = None
+        for index, action in enumerate(messages):
+            bucket = self._group_bucket(action.group_id, now)
+            group_wait = bucket.wait_time(now)
+            if group_wait <= 0:
+                del messages[index]
+                bucket.consume(now)
+                self.account_bucket.consume(now)
+                return action, 0.0
+            wait = group_wait if wait is None else min(wait, group_wait)
+        return None, wait
+
+    async def _worker(self):
+        while True:
+            action, wait = self._take_next(time.monotonic())
+            if action is not None:
+                task = asyncio.ensure_future(self._run(action))
+                self._running.add(task)
+                task.add_done_callback(self._running.discard)
+                continue
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _run(self, action: _Action):
+        try:
+            result = await action.func()
+            if not action.future.done():
+                action.future.set_result(result)
+        except Exception as e:
+            logger.error(f"执行出站动作异常: {e}")
+            if not action.future.done():
+                action.future.set_exception(e)
+                # 没有调用方等待时避免“未获取的异常”警告
+                action.future.exception()
+
+    async def close(self, timeout: Optional[float] = None):
+        """立即发出合并中的警告，等待排队的动作发送完成后停止"""
+        for group_id in list(self._warnings):
+            self._flush_warnings(group_id, reopen=False)
+        if self._worker_task is None:
+            return
+
+        async def _wait():
+            while self.pending or self._running:
+                await asyncio.sleep(0.05)
+
+        try:
+            await asyncio.wait_for(_wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"等待出站动作发送完成超时，剩余 {self.pending} 个")
+        self._worker_task.cancel()
+        await asyncio.gather(self._worker_task, return_exceptions=True)
+        self._worker_task = None
@@ -0,0 +1,211 @@
+"""推理后端对比：原始模型（torch）与 ONNX Runtime（int8）的概率一致性、单图延迟和内存
+
+用法：
+    python benchmarks/bench_backends.py --onnx models/v2.int8.onnx --images DIR
+    python benchmarks/bench_backends.py --onnx models/v2.int8.onnx --threads 1 2 4    # 比较不同算子内线程数
+    python benchmarks/bench_backends.py --onnx models/v2.int8.onnx --tolerance 0.05   # 概率最大允许偏差
+
+不指定 --images 时使用合成图片，只能粗略验证一致性，量化效果以真实图片为准。
+各后端在独立子进程中运行，内存互不干扰。一致性检查不通过时退出码为 1。
+"""
+import argparse
+import io
+import json
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from PIL import Image
+
+from image_detector import ImageDetector, detect_frames, preprocess_image
+from inference_backends import load_backend
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp')
+
+
+def peak_rss_mb() -> float:
+    """当前进程的峰值常驻内存（MB），读取 /proc/self/status 的 VmHWM"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+
+
+def load_images(args):
+    """读取图片目录，不指定时生成合成图片"""
+    if args.images:
+        paths = sorted(
+            os.path.join(root, name) for root, _, names in os.walk(args.images)
+            for name in names if name.lower().endswith(IMAGE_EXTENSIONS)
+        )[:args.limit]
+        images = []
+        for path in paths:
+            with open(path, 'rb') as f:
+                images.append((os.path.relpath(path, args.images), f.read()))
+        return images
+    rng = np.random.default_rng(0)
+    images = []
+    for i in range(args.limit or 32):
+        y, x = np.mgrid[0:480, 0:640]
+        base = np.stack([(x * (i + 1) / 8) % 256, (y * (i + 2) / 6) % 256, ((x + y) / (i + 3)) % 256], axis=-1)
+        pixels = (base + rng.normal(0, 25, base.shape)).clip(0, 255).astype(np.uint8)
+        buffer = io.BytesIO()
+        Image.fromarray(pixels).save(buffer, format='JPEG', quality=85)
+        images.append((f"synthetic_{i:03d}.jpg", buffer.getvalue()))
+    return images
+
+
+def run_worker(args, backend_config):
+    """子进程内加载一个后端，逐张（批次为 1）检测，输出各图概率、延迟和内存"""
+    with open(args.config, encoding='utf-8') as f:
+        config = json.load(f)
+    model_path = config.get('model_path')
+    if model_path == "your_model_dir_or_file_path":
+        model_path = None
+    version = config.get('model_config', {}).get('version', 'v2')
+    input_size = config.get('preprocess', {}).get('input_size', 224)
+    max_frames = config.get('preprocess', {}).get('max_frames', 3)
+
+    images = load_images(args)
+    frames = [preprocess_image(data, input_size, max_frames) for _, data in images]
+    rss_start = peak_rss_mb()
+    start = time.perf_counter()
+    backend = load_backend(version, model_path, backend_config)
+    load_seconds = time.perf_counter() - start
+    rss_loaded = peak_rss_mb()
+    # 预热，排除首次推理的初始化开销
+    detect_frames(backend, [frame for frame in frames if frame][:1])
+
+    latencies = []
+    results = []
+    for _ in range(args.repeat):
+        results = []
+        for image_frames in frames:
+            start = time.perf_counter()
+            results.append(detect_frames(backend, [image_frames])[0])
+            latencies.append(time.perf_counter() - start)
+    print(json.dumps({
+        'load_seconds': load_seconds,
+        'model_mb': max(0.0, rss_loaded - rss_start),
+        'peak_mb': max(0.0, peak_rss_mb() - rss_start),
+        'latencies': latencies,
+        'results': results,
+    }))
+
+
+def spawn_worker(args, backend_config):
+    output = subprocess.run(
+        [sys.executable, __file__, '--worker', json.dumps(backend_config)] + sys.argv[1:],
+        capture_output=True, text=True,
+    )
+    if output.returncode != 0:
+        raise RuntimeError(output.stderr.strip().splitlines()[-1] if output.stderr.strip() else '子进程异常退出')
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q) * 1000) if values else 0.0
+
+
+def compare(reference, candidate, detector: ImageDetector, names):
+    """逐图比较两个后端的概率：最大/平均绝对偏差、Top1 一致率、违规判定一致率"""
+    diffs, top1_same, verdict_same, compared = [], 0, 0, 0
+    mismatches = []
+    for name, ref, cand in zip(names, reference, candidate):
+        if ref is None or cand is None:
+            continue
+        compared += 1
+        diff = max(abs(ref[label] - cand.get(label, 0.0)) for label in ref)
+        diffs.append(diff)
+        ref_results = detector._format_results(ref)
+        cand_results = detector._format_results(cand)
+        top1_same += ref_results[0]['label'] == cand_results[0]['label']
+        same = detector.is_violation(ref_results) == detector.is_violation(cand_results)
+        verdict_same += same
+        if not same:
+            mismatches.append((name, ref_results[0], cand_results[0]))
+    count = max(compared, 1)
+    return {
+        'compared': compared,
+        'max_diff': max(diffs) if diffs else 0.0,
+        'mean_diff': float(np.mean(diffs)) if diffs else 0.0,
+        'top1_agreement': top1_same / count,
+        'verdict_agreement': verdict_same / count,
+        'verdict_mismatches': mismatches,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='推理后端概率一致性、延迟与内存对比')
+    parser.add_argument('--onnx', help='ONNX 模型路径，默认使用配置中的 inference_backend.onnx_path')
+    parser.add_argument('--images', help='图片目录（递归），不指定则使用合成图片')
+    parser.add_argument('--config', default=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'config.json'))
+    parser.add_argument('--threads', type=int, nargs='+', default=[0], help='ONNX 算子内线程数，0 表示自动')
+    parser.add_argument('--limit', type=int, help='最多使用的图片数')
+    parser.add_argument('--repeat', type=int, default=3, help='每张图片重复检测次数（延迟取全部样本）')
+    parser.add_argument('--tolerance', type=float, default=0.05, help='单个标签概率允许的最大绝对偏差')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args, json.loads(args.worker))
+        return
+
+    with open(args.config, encoding='utf-8') as f:
+        config = json.load(f)
+    onnx_path = args.onnx or config.get('inference_backend', {}).get('onnx_path')
+    detector = ImageDetector(config, lazy=True)
+    names = [name for name, _ in load_images(args)]
+
+    backends = [('torch', {'type': 'torch'})]
+    for threads in args.threads:
+        backends.append((f"onnx(threads={threads or '自动'})",
+                         {'type': 'onnx', 'onnx_path': onnx_path, 'intra_op_threads': threads, 'inter_op_threads': 1}))
+
+    reports = {}
+    failed = False
+    print(f"图片数: {len(names)}，每张重复 {args.repeat} 次")
+    print(f"{'后端':<22}{'加载(s)':>9}{'模型内存(MB)':>14}{'峰值内存(MB)':>14}{'p50(ms)':>10}{'p95(ms)':>10}{'p99(ms)':>10}")
+    for name, backend_config in backends:
+        try:
+            report = reports[name] = spawn_worker(args, backend_config)
+        except Exception as e:
+            print(f"{name:<22}失败: {e}")
+            failed = True
+            continue
+        latencies = report['latencies']
+        print(f"{name:<22}{report['load_seconds']:>9.2f}{report['model_mb']:>14.1f}{report['peak_mb']:>14.1f}"
+              f"{percentile(latencies, 50):>10.2f}{percentile(latencies, 95):>10.2f}{percentile(latencies, 99):>10.2f}")
+
+    if 'torch' not in reports:
+        print("原始模型运行失败，无法比较一致性")
+        sys.exit(1)
+    passed = not failed
+    print("\n===== 一致性（以原始模型为准） =====")
+    for name, report in reports.items():
+        if name == 'torch':
+            continue
+        parity = compare(reports['torch']['results'], report['results'], detector, names)
+        ok = parity['max_diff'] <= args.tolerance and parity['verdict_agreement'] == 1.0
+        passed = passed and ok
+        print(f"{name}: {'通过' if ok else '不通过'}，比较 {parity['compared']} 张，"
+              f"概率最大偏差 {parity['max_diff']:.4f}，平均偏差 {parity['mean_diff']:.4f}，"
+              f"Top1 一致 {parity['top1_agreement']:.2%}，违规判定一致 {parity['verdict_agreement']:.2%}")
+        for image_name, ref, cand in parity['verdict_mismatches']:
+            print(f"  判定不一致 {image_name}: 原始 {ref['label']} {ref['confidence']:.2%}，"
+                  f"ONNX {cand['label']} {cand['confidence']:.2%}")
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""图片解码基准：对比完整解码与降采样解码/动图抽帧的耗时和峰值内存
+
+用法：
+    python benchmarks/bench_decode.py                 # 使用合成的手机照片和动图
+    python benchmarks/bench_decode.py --images DIR    # 使用目录中的真实图片
+"""
+import argparse
+import io
+import os
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from PIL import Image
+
+from image_detector import iter_frames, preprocess_image
+
+
+def legacy_preprocess(image_data: bytes, **_):
+    """原有预处理：按原始分辨率完整解码并转换为RGB"""
+    image = Image.open(io.BytesIO(image_data))
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    image.load()
+    return [image]
+
+
+def fast_preprocess(image_data: bytes, input_size: int = 224, max_frames: int = 3):
+    return preprocess_image(image_data, input_size=input_size, max_frames=max_frames)
+
+
+def first_frame_preprocess(image_data: bytes, input_size: int = 224, max_frames: int = 3):
+    """动图第一帧已判定违规、不再解码后续帧时的开销"""
+    return [next(iter_frames(image_data, input_size, max_frames))]
+
+
+PATHS = {'legacy': legacy_preprocess, 'fast': fast_preprocess, 'first': first_frame_preprocess}
+
+
+def make_samples(directory: str):
+    """生成合成样本：手机照片尺寸的 JPEG/PNG 和一个动图"""
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:3024, 0:4032]
+    base = np.stack([(x / 16) % 256, (y / 12) % 256, ((x + y) / 20) % 256], axis=-1)
+    photo = (base + rng.normal(0, 20, base.shape)).clip(0, 255).astype(np.uint8)
+    samples = {}
+    path = os.path.join(directory, 'phone_4032x3024.jpg')
+    Image.fromarray(photo).save(path, quality=90)
+    samples['phone_4032x3024.jpg'] = path
+    path = os.path.join(directory, 'screenshot_1170x2532.png')
+    Image.fromarray(photo[:2532, :1170]).save(path)
+    samples['screenshot_1170x2532.png'] = path
+    frames = [Image.fromarray(np.roll(photo[:480, :480], i * 8, axis=1)).quantize(64) for i in range(60)]
+    path = os.path.join(directory, 'animated_480x480x60.gif')
+    frames[0].save(path, save_all=True, append_images=frames[1:], duration=40, loop=0)
+    samples['animated_480x480x60.gif'] = path
+    return samples
+
+
+def peak_rss_mb() -> float:
+    """当前进程的峰值常驻内存（MB）
+
+    Linux 下读取 /proc/self/status 的 VmHWM，它在 exec 后重新计数；
+    ru_maxrss 会继承父进程的峰值，只在其他平台上使用。
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+
+
+def run_worker(path_name: str, file: str, repeat: int, input_size: int, max_frames: int):
+    """子进程内执行一种预处理路径，输出平均耗时和峰值内存增量"""
+    with open(file, 'rb') as f:
+        image_data = f.read()
+    func = PATHS[path_name]
+    rss_before = peak_rss_mb()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        frames = func(image_data, input_size=input_size, max_frames=max_frames)
+    elapsed = (time.perf_counter() - start) / repeat
+    peak = peak_rss_mb() - rss_before
+    print(f"{elapsed * 1000:.2f} {max(0.0, peak):.1f} {len(frames)} {frames[0].size[0]}x{frames[0].size[1]}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='图片解码耗时与峰值内存基准')
+    parser.add_argument('--images', help='真实图片目录，不指定则生成合成样本')
+    parser.add_argument('--repeat', type=int, default=5, help='每种路径重复次数')
+    parser.add_argument('--input-size', type=int, default=224)
+    parser.add_argument('--max-frames', type=int, default=3)
+    parser.add_argument('--worker', nargs=2, metavar=('PATH', 'FILE'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.worker[0], args.worker[1], args.repeat, args.input_size, args.max_frames)
+        return
+
+    if args.images:
+        samples = {name: os.path.join(args.images, name) for name in sorted(os.listdir(args.images))}
+    else:
+        samples = make_samples(os.path.join(os.path.dirname(os.path.abspath(__file__)), '.samples'))
+
+    print(f"{'图片':<30}{'路径':<8}{'耗时(ms)':>10}{'峰值内存(MB)':>14}{'帧数':>6}  输出尺寸")
+    for name, file in samples.items():
+        for path_name in PATHS:
+            # 每种路径在独立子进程中运行，峰值内存互不干扰
+            output = subprocess.run(
+                [sys.executable, __file__, '--worker', path_name, file, '--repeat', str(args.repeat),
+                 '--input-size', str(args.input_size), '--max-frames', str(args.max_frames)],
+                capture_output=True, text=True,
+            )
+            if output.returncode != 0:
+                print(f"{name:<30}{path_name:<8}失败: {output.stderr.strip().splitlines()[-1:]}")
+                continue
+            elapsed, peak, frames, size = output.stdout.split()
+            print(f"{name:<30}{path_name:<8}{float(elapsed):>10.2f}{float(peak):>14.1f}{frames:>6}  {size}")
+
+
+if __name__ == '__main__':
+    main()
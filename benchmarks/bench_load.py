@@ -0,0 +1,266 @@
+"""负载与延迟基准：本地模拟 NapCat 回放群消息流量，测量机器人吞吐量和“事件到撤回”延迟
+
+用法：
+    python benchmarks/bench_load.py --rate 50 --duration 20                 # 合成流量 + 模拟检测器
+    python benchmarks/bench_load.py --detector real --rate 10               # 使用真实模型
+    python benchmarks/bench_load.py --replay events.jsonl --speed 5         # 按 5 倍速回放录制的事件
+
+录制文件每行一个 OneBot v11 群消息事件（含 time 字段）。回放时图片地址会改写到模拟 NapCat，
+所有出现的群都会加入检测白名单和自动撤回列表。
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+from typing import Any, Dict, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from detection_scheduler import DETECTION_DECISIONS
+from fake_napcat import FakeNapCat, make_image
+
+
+class FakeDetector:
+    """模拟检测器：按图片内容判定是否违规，用固定延迟和并发上限模拟模型吞吐"""
+
+    def __init__(self, violation_images, latency_ms: float = 30, concurrency: int = 4,
+                 confidence_threshold: float = 0.5):
+        self.violation_hashes = {hashlib.sha256(data).hexdigest() for data in violation_images}
+        self.latency = latency_ms / 1000
+        self.confidence_threshold = confidence_threshold
+        self.model_loaded = True
+        self.calls = 0
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    async def detect_image(self, image_data: bytes) -> List[Dict]:
+        async with self._semaphore:
+            self.calls += 1
+            await asyncio.sleep(self.latency)
+        if hashlib.sha256(image_data).hexdigest() in self.violation_hashes:
+            return [{'label': 'porn', 'confidence': 0.95}, {'label': 'other', 'confidence': 0.05}]
+        return [{'label': 'other', 'confidence': 0.95}, {'label': 'porn', 'confidence': 0.05}]
+
+    async def close(self):
+        pass
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    lower = int(k)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (k - lower)
+
+
+def build_config(fake: FakeNapCat, groups: List[int], workdir: str, with_cache: bool,
+                 local_cache: bool = False, recall_groups: Optional[int] = None) -> Dict[str, Any]:
+    """生成压测用配置：所有群都开启检测，前 recall_groups 个群（默认全部）开启自动撤回"""
+    with open(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'config.json'),
+              encoding='utf-8') as f:
+        config = json.load(f)
+    group_ids = [str(group) for group in groups]
+    config.update({
+        'napcat_ws_url': fake.ws_url,
+        'napcat_http_url': fake.http_url,
+        'admin_qq_list': ['1'],
+        'bot_qq': fake.bot_qq,
+        'whitelist_groups': group_ids,
+        'auto_recall_groups': group_ids[:recall_groups],
+        'violation_save_path': os.path.join(workdir, 'violations'),
+    })
+    config.setdefault('verdict_cache', {}).update({'enabled': with_cache, 'persist_path': None})
+    config.setdefault('phash_index', {}).update({'enabled': with_cache})
+    config.setdefault('image_source', {}).update({'local_cache': local_cache,
+                                                  'allowed_dirs': [fake.cache_dir] if fake.cache_dir else []})
+    return config
+
+
+def synthetic_events(fake: FakeNapCat, args) -> List[tuple]:
+    """生成合成流量：(相对发送时间, 事件, 是否预期撤回)"""
+    rng = random.Random(args.seed)
+    normal = [make_image(i) for i in range(args.image_pool)]
+    bad = [make_image(10_000 + i, violation=True) for i in range(args.image_pool)]
+    groups = [100000 + i for i in range(args.groups)]
+    events = []
+    total = int(args.rate * args.duration)
+    recall_groups = set(groups[:args.recall_groups])
+    for i in range(total):
+        group_id = groups[0] if rng.random() < args.hot_group_share else rng.choice(groups)
+        user_id = 200000 + rng.randrange(1000)
+        if rng.random() < args.image_ratio:
+            violation = rng.random() < args.violation_ratio
+            name = f"{'bad' if violation else 'ok'}-{i}.jpg"
+            pool = bad if violation else normal
+            fake.add_image(name, pool[rng.randrange(len(pool))])
+            segments = [fake.image_segment(name)]
+        else:
+            violation = False
+            segments = [{'type': 'text', 'data': {'text': f'hello {i}'}}]
+        # 只有自动撤回群的违规图片会被撤回
+        events.append((i / args.rate, fake.make_event(group_id, user_id, segments), violation and group_id in recall_groups))
+    return events, groups, bad
+
+
+def replay_events(fake: FakeNapCat, path: str, speed: float) -> List[tuple]:
+    """读取录制的事件，按原始时间间隔（除以 speed）回放"""
+    with open(path, encoding='utf-8') as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    records = [r for r in records if r.get('post_type') == 'message' and r.get('message_type') == 'group']
+    if not records:
+        return [], []
+    start = records[0].get('time', 0)
+    events = []
+    for record in records:
+        segments = []
+        for segment in record.get('message', []):
+            if segment.get('type') == 'image':
+                name = segment.get('data', {}).get('file') or f"img-{len(events)}.jpg"
+                segment = fake.image_segment(name)
+            segments.append(segment)
+        event = fake.make_event(int(record['group_id']), int(record.get('user_id', 0)), segments)
+        events.append(((record.get('time', start) - start) / speed, event, None))
+    groups = sorted({event['group_id'] for _, event, _ in events})
+    return events, groups
+
+
+async def run(args):
+    logging.basicConfig(level=getattr(logging, args.log_level))
+    workdir = tempfile.mkdtemp(prefix='antisetu-bench-')
+    cache_dir = os.path.join(workdir, 'napcat_cache') if args.local_cache else None
+    fake = FakeNapCat(ws_port=args.ws_port, http_port=args.http_port, cache_dir=cache_dir,
+                      action_latency_ms=args.action_latency_ms)
+    await fake.start()
+
+    if args.replay:
+        events, groups = replay_events(fake, args.replay, args.speed)
+        bad_images = []
+    else:
+        events, groups, bad_images = synthetic_events(fake, args)
+    if not events:
+        print("没有可回放的事件")
+        await fake.stop()
+        return
+
+    config_file = os.path.join(workdir, 'config.json')
+    with open(config_file, 'w', encoding='utf-8') as f:
+        config = build_config(fake, groups, workdir, args.with_cache, args.local_cache, args.recall_groups)
+        priority_config = config.setdefault('detection_priority', {})
+        priority_config['enabled'] = not args.no_priority
+        if args.detector == 'fake':
+            # 模拟检测器的并发上限就是它的处理能力
+            priority_config['concurrency'] = args.fake_concurrency
+        if args.dispatch_workers:
+            config.setdefault('event_dispatch', {})['workers'] = args.dispatch_workers
+        if args.max_pending:
+            config.setdefault('event_dispatch', {})['max_pending'] = args.max_pending
+        json.dump(config, f, ensure_ascii=False, indent=2)
+
+    # 导入 main 时会配置日志，这里再按参数调整级别
+    import main as bot_main
+    logging.getLogger().setLevel(getattr(logging, args.log_level))
+
+    detector = None
+    if args.detector == 'fake':
+        detector = FakeDetector(bad_images, args.fake_latency_ms, args.fake_concurrency)
+    bot = bot_main.NapCatBot(config_file=config_file, image_detector=detector)
+    bot_task = asyncio.ensure_future(bot.run())
+    await fake.wait_connected()
+
+    print(f"开始回放 {len(events)} 个事件，{len(groups)} 个群")
+    loop = asyncio.get_event_loop()
+    begin = loop.time()
+    lag = []
+    peak_queue = 0
+
+    async def sample_queue():
+        nonlocal peak_queue
+        while True:
+            peak_queue = max(peak_queue, bot.detection_scheduler.pending)
+            await asyncio.sleep(0.01)
+
+    sampler = asyncio.ensure_future(sample_queue())
+    for offset, event, _ in events:
+        delay = begin + offset - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        else:
+            lag.append(-delay)
+        await fake.push(event)
+    send_done = loop.time()
+
+    expected = [event['message_id'] for _, event, violation in events if violation]
+    if args.replay:
+        # 录制流量无法预知违规结果，等待一段静默时间
+        await asyncio.sleep(args.settle)
+    else:
+        await fake.wait_recalls(expected, args.settle)
+    finished = loop.time()
+    sampler.cancel()
+
+    latencies = [(fake.recalled_at[mid] - fake.sent_at[mid]) * 1000
+                 for mid in fake.recalled_at if mid in fake.sent_at]
+    image_events = sum(1 for _, event, _ in events if any(s.get('type') == 'image' for s in event['message']))
+    elapsed = finished - begin
+
+    print("\n===== 压测结果 =====")
+    print(f"事件数: {len(events)}（含图片 {image_events}），发送耗时 {send_done - begin:.2f}s，总耗时 {elapsed:.2f}s")
+    if lag and max(lag) > 0.001:
+        print(f"发送端落后计划: 最大 {max(lag) * 1000:.1f}ms（事件源本身跟不上目标速率时会出现）")
+    print(f"图片下载请求: {fake.image_requests}，动作调用: {fake.actions}")
+    if expected:
+        missed = len(set(expected) - fake.recalled_at.keys())
+        print(f"预期撤回: {len(expected)}，实际撤回: {len(fake.recalled_at)}，未撤回: {missed}")
+    print(f"吞吐量: {len(events) / elapsed:.1f} 事件/s，{image_events / elapsed:.1f} 图片/s")
+    print(f"事件到撤回延迟(ms): p50={percentile(latencies, 50):.1f} p95={percentile(latencies, 95):.1f} "
+          f"p99={percentile(latencies, 99):.1f} max={max(latencies) if latencies else float('nan'):.1f}")
+    if isinstance(detector, FakeDetector):
+        print(f"模拟检测器调用次数: {detector.calls}")
+    decisions = {name: int(DETECTION_DECISIONS.value(decision=name))
+                 for name in ('recall', 'normal', 'downgraded', 'recall_late')}
+    print(f"检测优先级队列峰值: {peak_queue}，调度决策: {decisions}")
+
+    bot_task.cancel()
+    await asyncio.gather(bot_task, return_exceptions=True)
+    await bot.close()
+    await fake.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='机器人负载与延迟基准')
+    parser.add_argument('--detector', choices=['fake', 'real'], default='fake', help='检测器：模拟或真实模型')
+    parser.add_argument('--fake-latency-ms', type=float, default=30, help='模拟检测器单张耗时')
+    parser.add_argument('--fake-concurrency', type=int, default=4, help='模拟检测器并发上限')
+    parser.add_argument('--replay', help='回放录制的事件文件（JSONL）')
+    parser.add_argument('--speed', type=float, default=1.0, help='回放倍速')
+    parser.add_argument('--rate', type=float, default=20, help='合成流量：每秒事件数')
+    parser.add_argument('--duration', type=float, default=10, help='合成流量：持续秒数')
+    parser.add_argument('--groups', type=int, default=10, help='合成流量：群数量')
+    parser.add_argument('--hot-group-share', type=float, default=0.0, help='合成流量：集中到第一个群的事件比例')
+    parser.add_argument('--image-ratio', type=float, default=0.6, help='合成流量：图片消息比例')
+    parser.add_argument('--violation-ratio', type=float, default=0.2, help='合成流量：违规图片比例')
+    parser.add_argument('--image-pool', type=int, default=20, help='合成流量：不同图片内容数')
+    parser.add_argument('--recall-groups', type=int, help='合成流量：只有前 N 个群开启自动撤回（默认全部）')
+    parser.add_argument('--no-priority', action='store_true', help='关闭检测优先级调度，用于对比')
+    parser.add_argument('--with-cache', action='store_true', help='启用检测结果缓存和感知哈希索引')
+    parser.add_argument('--local-cache', action='store_true', help='模拟同机部署的 NapCat，图片从本地缓存读取')
+    parser.add_argument('--action-latency-ms', type=float, default=0, help='模拟NapCat动作响应延迟')
+    parser.add_argument('--dispatch-workers', type=int, help='覆盖 event_dispatch.workers')
+    parser.add_argument('--max-pending', type=int, help='覆盖 event_dispatch.max_pending')
+    parser.add_argument('--settle', type=float, default=30, help='发送结束后等待撤回的最长秒数')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--ws-port', type=int, default=13001)
+    parser.add_argument('--http-port', type=int, default=13000)
+    parser.add_argument('--log-level', default='WARNING')
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
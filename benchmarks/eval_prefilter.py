@@ -0,0 +1,86 @@
+"""预筛评估：对目录中的图片同时运行预筛和完整模型，报告各层放行比例、漏检率和预筛耗时
+
+用法：
+    python benchmarks/eval_prefilter.py --images DIR                  # 使用 config.json 中的预筛阈值
+    python benchmarks/eval_prefilter.py --images DIR --config my.json
+    python benchmarks/eval_prefilter.py --images DIR --show-misses    # 列出被放行但模型判定违规的图片
+
+漏检率以当前模型的判定为准（置信度阈值和违规关键词与机器人一致）。
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from image_detector import ImageDetector
+from prefilter import TIERS
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp')
+
+
+async def evaluate(args):
+    with open(args.config, encoding='utf-8') as f:
+        config = json.load(f)
+    config.setdefault('prefilter', {}).update({'enabled': True, 'evaluate': True})
+    config.setdefault('inference_batching', {})['enabled'] = False
+    detector = ImageDetector(config)
+    prefilter = detector.prefilter
+
+    paths = sorted(
+        os.path.join(root, name)
+        for root, _, names in os.walk(args.images)
+        for name in names if name.lower().endswith(IMAGE_EXTENSIONS)
+    )
+    if args.limit:
+        paths = paths[:args.limit]
+    misses = []
+    prefilter_seconds = 0.0
+    model_seconds = 0.0
+    for path in paths:
+        with open(path, 'rb') as f:
+            image_data = f.read()
+        start = time.perf_counter()
+        tier = prefilter.check(image_data)
+        prefilter_seconds += time.perf_counter() - start
+        prefilter.count(tier)
+        start = time.perf_counter()
+        results = await detector._detect_with_model(image_data)
+        model_seconds += time.perf_counter() - start
+        if not results:
+            continue
+        violation = detector.is_violation(results)
+        prefilter.record_evaluation(tier, violation)
+        if tier is not None and violation:
+            misses.append((path, tier, results[0]))
+    await detector.close()
+
+    stats = prefilter.stats()
+    count = max(len(paths), 1)
+    print("\n===== 预筛评估 =====")
+    print(f"图片数: {len(paths)}，模型判定违规: {prefilter.violations}")
+    for tier in TIERS + ('model',):
+        print(f"  {tier:8s} {stats['counts'][tier]:6d}")
+    print(f"预筛放行比例: {stats['cleared_ratio']:.2%}")
+    print(f"放行图片中的违规比例: {stats['miss_rate']:.2%}，违规图片被漏掉的比例: {stats['missed_violation_ratio']:.2%}")
+    print(f"各层漏检率: {stats['miss_rate_by_tier']}")
+    print(f"平均耗时: 预筛 {prefilter_seconds / count * 1000:.2f}ms，模型 {model_seconds / count * 1000:.2f}ms")
+    if args.show_misses:
+        for path, tier, top in misses:
+            print(f"  漏检 [{tier}] {path}: {top['label']} {top['confidence']:.2%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='预筛放行比例与漏检率评估')
+    parser.add_argument('--images', required=True, help='图片目录（递归）')
+    parser.add_argument('--config', default=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'config.json'))
+    parser.add_argument('--limit', type=int, help='最多评估的图片数')
+    parser.add_argument('--show-misses', action='store_true', help='列出漏检的图片')
+    asyncio.run(evaluate(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
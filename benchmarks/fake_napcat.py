@@ -0,0 +1,232 @@
+"""本地模拟的 NapCat：WebSocket 事件源 + 图片/动作 HTTP 接口
+
+既可以被 bench_load.py 导入使用，也可以单独运行，供手动调试机器人：
+    python benchmarks/fake_napcat.py --ws-port 13001 --http-port 13000
+"""
+import argparse
+import asyncio
+import hashlib
+import io
+import json
+import logging
+import os
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import websockets
+from aiohttp import web
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+
+def make_image(seed: int, size: int = 256, violation: bool = False) -> bytes:
+    """生成一张确定性的 JPEG 测试图片，违规图以红色为主色调"""
+    rng = np.random.default_rng(seed)
+    pixels = rng.integers(0, 256, (size, size, 3), dtype=np.uint8)
+    if violation:
+        pixels[..., 0] = 255
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format='JPEG', quality=85)
+    return buffer.getvalue()
+
+
+class FakeNapCat:
+    """模拟 NapCat：向机器人推送群消息事件，记录收到的 send_group_msg / delete_msg 动作，支持 get_image、get_group_list 和 get_group_msg_history"""
+
+    def __init__(self, host: str = '127.0.0.1', ws_port: int = 13001, http_port: int = 13000,
+                 bot_qq: str = '10000', cache_dir: Optional[str] = None, action_latency_ms: float = 0):
+        self.host = host
+        self.ws_port = ws_port
+        self.http_port = http_port
+        self.bot_qq = bot_qq
+        # 指定时图片同时写入该目录，get_image 返回其中的本地路径，模拟与机器人同机部署的 NapCat 缓存
+        self.cache_dir = cache_dir
+        # WebSocket 动作响应的延迟，模拟繁忙的 NapCat
+        self.action_latency = action_latency_ms / 1000
+        self.images: Dict[str, bytes] = {}
+        self.sent_at: Dict[int, float] = {}  # message_id -> 事件推送时间
+        self.recalled_at: Dict[int, float] = {}  # message_id -> 收到撤回动作的时间
+        self.messages_sent: List[Dict[str, Any]] = []
+        self.actions: Dict[str, int] = {}
+        self.image_requests = 0
+        self.history: Dict[int, List[Dict[str, Any]]] = {}  # group_id -> 推送过的消息，供 get_group_msg_history 查询
+        self.group_list: Optional[List[int]] = None  # get_group_list 返回的群，None 时为推送过消息的群
+        self._clients = set()
+        self._connected = asyncio.Event()
+        self._recall_event = asyncio.Event()
+        self._ws_server = None
+        self._runner = None
+        self._next_message_id = 1
+
+    @property
+    def ws_url(self) -> str:
+        return f"ws://{self.host}:{self.ws_port}"
+
+    @property
+    def http_url(self) -> str:
+        return f"http://{self.host}:{self.http_port}"
+
+    def image_url(self, name: str) -> str:
+        return f"{self.http_url}/images/{name}"
+
+    def add_image(self, name: str, data: bytes):
+        self.images[name] = data
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(os.path.join(self.cache_dir, name), 'wb') as f:
+                f.write(data)
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/images/{name}', self._handle_image)
+        app.router.add_post('/{action}', self._handle_http_action)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.http_port).start()
+        self._ws_server = await websockets.serve(self._handle_ws, self.host, self.ws_port, max_size=None)
+        logger.info(f"模拟NapCat已启动: {self.ws_url} / {self.http_url}")
+
+    async def stop(self):
+        if self._ws_server is not None:
+            self._ws_server.close()
+            await self._ws_server.wait_closed()
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def wait_connected(self, timeout: float = 30):
+        await asyncio.wait_for(self._connected.wait(), timeout)
+
+    async def _handle_ws(self, websocket, *args):
+        self._clients.add(websocket)
+        self._connected.set()
+        try:
+            async for frame in websocket:
+                data = json.loads(frame)
+                if self.action_latency:
+                    # 各动作分别延迟响应，不阻塞后续帧的读取
+                    asyncio.ensure_future(self._respond_later(websocket, data))
+                    continue
+                await self._respond(websocket, data)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            self._clients.discard(websocket)
+            if not self._clients:
+                self._connected.clear()
+
+    async def _respond(self, websocket, data: Dict[str, Any]):
+        response = self._run_action(data.get('action', ''), data.get('params', {}))
+        response['echo'] = data.get('echo')
+        await websocket.send(json.dumps(response, ensure_ascii=False))
+
+    async def _respond_later(self, websocket, data: Dict[str, Any]):
+        await asyncio.sleep(self.action_latency)
+        try:
+            await self._respond(websocket, data)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    async def _handle_image(self, request: web.Request) -> web.Response:
+        self.image_requests += 1
+        data = self.images.get(request.match_info['name'])
+        if data is None:
+            # 回放录制流量时图片不在本地，按文件名生成一张确定性的图片
+            seed = int(hashlib.md5(request.match_info['name'].encode()).hexdigest()[:8], 16)
+            data = make_image(seed)
+        return web.Response(body=data, content_type='image/jpeg')
+
+    async def _handle_http_action(self, request: web.Request) -> web.Response:
+        params = await request.json()
+        return web.json_response(self._run_action(request.match_info['action'], params))
+
+    def _run_action(self, action: str, params: Dict[str, Any]) -> Dict[str, Any]:
+        now = time.perf_counter()
+        self.actions[action] = self.actions.get(action, 0) + 1
+        if action == 'delete_msg':
+            message_id = int(params.get('message_id', 0))
+            self.recalled_at.setdefault(message_id, now)
+            self._recall_event.set()
+        elif action in ('send_group_msg', 'send_private_msg'):
+            self.messages_sent.append(params)
+        elif action == 'get_group_msg_history':
+            messages = self.history.get(int(params.get('group_id', 0)), [])
+            count = int(params.get('count', 20))
+            return {'status': 'ok', 'retcode': 0, 'data': {'messages': messages[-count:]}}
+        elif action == 'get_group_list':
+            groups = self.group_list if self.group_list is not None else sorted(self.history)
+            return {'status': 'ok', 'retcode': 0, 'data': [{'group_id': group_id} for group_id in groups]}
+        elif action == 'get_image':
+            name = os.path.basename(str(params.get('file', '')))
+            path = os.path.join(self.cache_dir, name) if self.cache_dir else None
+            if not path or not os.path.exists(path):
+                return {'status': 'failed', 'retcode': 1404, 'data': None}
+            return {'status': 'ok', 'retcode': 0, 'data': {'file': path, 'file_name': name, 'url': self.image_url(name)}}
+        return {'status': 'ok', 'retcode': 0, 'data': {'message_id': 0}}
+
+    def make_event(self, group_id: int, user_id: int, segments: List[Dict[str, Any]],
+                   message_id: Optional[int] = None) -> Dict[str, Any]:
+        """构造 OneBot v11 群消息事件"""
+        if message_id is None:
+            message_id = self._next_message_id
+            self._next_message_id += 1
+        return {
+            'post_type': 'message',
+            'message_type': 'group',
+            'sub_type': 'normal',
+            'time': int(time.time()),
+            'self_id': int(self.bot_qq),
+            'group_id': group_id,
+            'user_id': user_id,
+            'message_id': message_id,
+            'message': segments,
+        }
+
+    def image_segment(self, name: str) -> Dict[str, Any]:
+        return {'type': 'image', 'data': {'file': name, 'file_unique': name, 'url': self.image_url(name)}}
+
+    async def push(self, event: Dict[str, Any]):
+        """向所有已连接的机器人推送事件，并记录推送时间"""
+        frame = json.dumps(event, ensure_ascii=False)
+        self.sent_at[event['message_id']] = time.perf_counter()
+        self.history.setdefault(event['group_id'], []).append(event)
+        await asyncio.gather(*[client.send(frame) for client in list(self._clients)], return_exceptions=True)
+
+    async def disconnect_clients(self):
+        """断开所有机器人连接，模拟 NapCat 重启或网络中断"""
+        await asyncio.gather(*[client.close() for client in list(self._clients)], return_exceptions=True)
+
+    async def wait_recalls(self, message_ids, timeout: float):
+        """等待指定消息全部被撤回或超时"""
+        pending = set(message_ids)
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
+        while pending - self.recalled_at.keys():
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            self._recall_event.clear()
+            try:
+                await asyncio.wait_for(self._recall_event.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+
+
+async def _serve(args):
+    fake = FakeNapCat(args.host, args.ws_port, args.http_port)
+    await fake.start()
+    print(f"模拟NapCat运行中: {fake.ws_url} / {fake.http_url}，Ctrl+C 退出")
+    await asyncio.Event().wait()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='本地模拟 NapCat')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--ws-port', type=int, default=13001)
+    parser.add_argument('--http-port', type=int, default=13000)
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(_serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
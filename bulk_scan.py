@@ -0,0 +1,304 @@
+"""离线批量扫描：检查群相册、聊天记录导出等已有图片，逐张输出 JSONL 判定结果
+
+用法：
+    python bulk_scan.py DIR [DIR ...] --output scan.jsonl             # 扫描目录（递归）
+    python bulk_scan.py album.zip export.tar.gz --output scan.jsonl   # 扫描 zip / tar 压缩包
+    python bulk_scan.py DIR --output scan.jsonl --concurrency 64      # 提高同时处理的图片数
+
+中断后用相同的 --output 重新运行即可继续，已写入结果的图片会被跳过；--restart 从头扫描。
+判定使用 config.json 中的模型、阈值和违规关键词，标签映射和判定规则与机器人一致。
+内容相同的图片只检测一次。
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sys
+import tarfile
+import threading
+import time
+import zipfile
+from typing import Any, Dict, Iterator, Optional, Set, Tuple
+
+from image_detector import DEFAULT_LABEL_MAP, DEFAULT_VIOLATION_KEYWORDS, ImageDetector, evaluate_results
+from image_sniff import SNIFF_BYTES, sniff_format
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp')
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz')
+# 压缩包内成员的来源写作 “压缩包路径!成员路径”
+ARCHIVE_SEPARATOR = '!'
+
+
+def is_archive(path: str) -> bool:
+    return os.path.isfile(path) and path.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def iter_sources(inputs, max_bytes: int) -> Iterator[Tuple[str, Optional[bytes], Optional[str]]]:
+    """按顺序产出 (来源, 图片数据, 错误)，目录递归遍历，压缩包按流读取不解压到磁盘"""
+    for path in inputs:
+        if is_archive(path):
+            yield from _iter_archive(path, max_bytes)
+        elif os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                for name in sorted(names):
+                    file = os.path.join(root, name)
+                    if is_archive(file):
+                        yield from _iter_archive(file, max_bytes)
+                    elif name.lower().endswith(IMAGE_EXTENSIONS):
+                        yield _read_file(file, max_bytes)
+        elif os.path.isfile(path):
+            yield _read_file(path, max_bytes)
+        else:
+            logger.warning(f"路径不存在: {path}")
+
+
+def _read_file(path: str, max_bytes: int) -> Tuple[str, Optional[bytes], Optional[str]]:
+    try:
+        if os.path.getsize(path) > max_bytes:
+            return path, None, 'too_large'
+        with open(path, 'rb') as f:
+            return path, f.read(), None
+    except OSError as e:
+        return path, None, f'read_error: {e}'
+
+
+def _iter_archive(path: str, max_bytes: int) -> Iterator[Tuple[str, Optional[bytes], Optional[str]]]:
+    try:
+        if path.lower().endswith('.zip'):
+            with zipfile.ZipFile(path) as archive:
+                for info in sorted(archive.infolist(), key=lambda info: info.filename):
+                    if info.is_dir() or not info.filename.lower().endswith(IMAGE_EXTENSIONS):
+                        continue
+                    source = f"{path}{ARCHIVE_SEPARATOR}{info.filename}"
+                    if info.file_size > max_bytes:
+                        yield source, None, 'too_large'
+                        continue
+                    yield source, archive.read(info), None
+        else:
+            # 流式模式按成员顺序读取，.tar.gz 不需要先完整解压
+            with tarfile.open(path, 'r|*') as archive:
+                for member in archive:
+                    if not member.isfile() or not member.name.lower().endswith(IMAGE_EXTENSIONS):
+                        continue
+                    source = f"{path}{ARCHIVE_SEPARATOR}{member.name}"
+                    if member.size > max_bytes:
+                        yield source, None, 'too_large'
+                        continue
+                    yield source, archive.extractfile(member).read(), None
+    except (OSError, zipfile.BadZipFile, tarfile.TarError) as e:
+        logger.error(f"读取压缩包失败: {path} {e}")
+        yield path, None, f'archive_error: {e}'
+
+
+def load_done(output: str) -> Set[str]:
+    """读取已有的结果文件，返回已成功检测的来源
+
+    带 error 的记录（读取失败、检测异常等）不算完成，从文件中删去后重新扫描；
+    中断时写了一半的最后一行也会被截掉。
+    """
+    done: Set[str] = set()
+    if not os.path.exists(output):
+        return done
+    with open(output, 'rb') as f:
+        data = f.read()
+    kept = []
+    for line in data.splitlines(keepends=True):
+        try:
+            record = json.loads(line)
+            source = record['source']
+        except (ValueError, KeyError):
+            continue
+        if not line.endswith(b'\n') or record.get('error'):
+            continue
+        done.add(source)
+        kept.append(line)
+    if len(kept) != len(data.splitlines()):
+        # 原子替换，重写过程中再次中断也不会损坏已有结果
+        tmp = output + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.writelines(kept)
+        os.replace(tmp, output)
+    return done
+
+
+class BulkScanner:
+    """批量扫描：读取线程按顺序产出图片，多个协程并发检测
+
+    解码在线程池（或推理进程）中并行进行，推理经由 ImageDetector 的微批调度器合并成批次。
+    """
+
+    def __init__(self, config: Dict[str, Any], output: str, concurrency: int = 32):
+        self.config = config
+        self.output = output
+        self.concurrency = max(1, int(concurrency))
+        self.detector = ImageDetector(config, lazy=True)
+        self.label_map = dict(DEFAULT_LABEL_MAP)
+        self.violation_keywords = config.get('violation_keywords', DEFAULT_VIOLATION_KEYWORDS)
+        self.max_bytes = int(config.get('image_download', {}).get('max_bytes', 10 * 1024 * 1024))
+        self.done: Set[str] = set()
+        self.stats = {'scanned': 0, 'violations': 0, 'errors': 0, 'skipped': 0, 'duplicates': 0}
+        self._verdicts: Dict[str, asyncio.Future] = {}  # 内容哈希 -> 检测结果，相同内容只检测一次
+        self._file = None
+
+    def _produce(self, inputs, queue: asyncio.Queue, loop: asyncio.AbstractEventLoop, stop: threading.Event):
+        """在读取线程中遍历输入，队列满时阻塞，形成反压"""
+        try:
+            for source, data, error in iter_sources(inputs, self.max_bytes):
+                if stop.is_set():
+                    break
+                if source in self.done:
+                    self.stats['skipped'] += 1
+                    continue
+                asyncio.run_coroutine_threadsafe(queue.put((source, data, error)), loop).result()
+        finally:
+            for _ in range(self.concurrency):
+                asyncio.run_coroutine_threadsafe(queue.put(None), loop).result()
+
+    async def _detect(self, data: bytes, digest: str):
+        future = self._verdicts.get(digest)
+        if future is not None:
+            self.stats['duplicates'] += 1
+            return await asyncio.shield(future)
+        future = self._verdicts[digest] = asyncio.get_event_loop().create_future()
+        try:
+            results = await self.detector.detect_image(data)
+            future.set_result(results)
+        except Exception as e:
+            future.set_exception(e)
+            # 后续相同内容的图片会重新等待这个结果，避免“未获取的异常”警告
+            future.exception()
+        return await future
+
+    async def _scan_one(self, source: str, data: Optional[bytes], error: Optional[str]) -> Dict[str, Any]:
+        record: Dict[str, Any] = {'source': source}
+        if error is None and sniff_format(data[:SNIFF_BYTES]) is None:
+            error = 'unsupported_format'
+        if error is not None:
+            record['error'] = error
+            return record
+        digest = hashlib.sha256(data).hexdigest()
+        record['sha256'] = digest
+        try:
+            results = await self._detect(data, digest)
+        except Exception as e:
+            record['error'] = f'detect_error: {e}'
+            return record
+        if not results:
+            record['error'] = 'decode_error'
+            return record
+        verdict = evaluate_results(results, self.label_map, self.detector.confidence_threshold, self.violation_keywords)
+        record.update({
+            'violation': verdict['violation'],
+            'labels': verdict['labels'],
+            'raw_labels': verdict['raw_labels'],
+            'results': [
+                {'label': r['label'], 'label_cn': self.label_map.get(r['label'].lower(), f"{r['label']}(未翻译)"),
+                 'confidence': round(float(r['confidence']), 6)}
+                for r in results
+            ],
+        })
+        if any('prefilter' in r for r in results):
+            record['prefilter'] = results[0]['prefilter']
+        return record
+
+    async def _consume(self, queue: asyncio.Queue):
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            record = await self._scan_one(*item)
+            record['scanned_at'] = int(time.time())
+            self.stats['scanned'] += 1
+            if record.get('error'):
+                self.stats['errors'] += 1
+            elif record['violation']:
+                self.stats['violations'] += 1
+            # 每条结果写完立即落盘，中断后最多丢失正在处理的图片
+            self._file.write(json.dumps(record, ensure_ascii=False) + '\n')
+            self._file.flush()
+
+    async def _report_progress(self, start: float, interval: float = 10):
+        while True:
+            await asyncio.sleep(interval)
+            elapsed = time.monotonic() - start
+            logger.info(f"已扫描 {self.stats['scanned']} 张（{self.stats['scanned'] / elapsed:.1f} 张/s），"
+                        f"违规 {self.stats['violations']}，错误 {self.stats['errors']}，跳过 {self.stats['skipped']}")
+
+    async def run(self, inputs, restart: bool = False) -> Dict[str, Any]:
+        if restart and os.path.exists(self.output):
+            os.remove(self.output)
+        self.done = load_done(self.output)
+        await self.detector.load_async()
+        if not self.detector.model_loaded:
+            raise RuntimeError("模型加载失败，无法扫描")
+        if self.done:
+            logger.info(f"继续上次的扫描，已完成 {len(self.done)} 张")
+        loop = asyncio.get_event_loop()
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        stop = threading.Event()
+        start = time.monotonic()
+        self._file = open(self.output, 'a', encoding='utf-8')
+        progress = asyncio.ensure_future(self._report_progress(start))
+        producer = loop.run_in_executor(None, self._produce, inputs, queue, loop, stop)
+        consumers = [asyncio.ensure_future(self._consume(queue)) for _ in range(self.concurrency)]
+        try:
+            await asyncio.gather(*consumers)
+            await producer
+        finally:
+            stop.set()
+            progress.cancel()
+            for consumer in consumers:
+                consumer.cancel()
+            # 让读取线程从阻塞的 put 中退出
+            while not producer.done():
+                while not queue.empty():
+                    queue.get_nowait()
+                await asyncio.sleep(0.05)
+            self._file.close()
+            await self.detector.close()
+        self.stats['elapsed'] = round(time.monotonic() - start, 2)
+        return self.stats
+
+
+def _main():
+    parser = argparse.ArgumentParser(description='离线批量扫描图片目录和压缩包')
+    parser.add_argument('inputs', nargs='+', help='图片目录、图片文件或 zip/tar 压缩包')
+    parser.add_argument('--output', required=True, help='JSONL 结果文件，已存在时继续上次的扫描')
+    parser.add_argument('--config', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.json'))
+    parser.add_argument('--concurrency', type=int, default=32, help='同时处理的图片数')
+    parser.add_argument('--batch-size', type=int, help='推理批次大小，默认使用 inference_batching.max_batch_size')
+    parser.add_argument('--workers', type=int, help='使用多进程推理的进程数，默认按 inference_executor 配置')
+    parser.add_argument('--restart', action='store_true', help='删除已有结果从头扫描')
+    parser.add_argument('--log-level', default='INFO')
+    args = parser.parse_args()
+    logging.basicConfig(level=getattr(logging, args.log_level.upper()), format='%(asctime)s - %(levelname)s - %(message)s')
+    if logging.getLogger().level > logging.DEBUG:
+        # 逐张检测的日志太多，只保留进度和汇总
+        logging.getLogger('image_detector').setLevel(logging.WARNING)
+
+    with open(args.config, encoding='utf-8') as f:
+        config = json.load(f)
+    # 离线扫描吞吐优先：总是启用微批推理
+    batching = config.setdefault('inference_batching', {})
+    batching['enabled'] = True
+    if args.batch_size:
+        batching['max_batch_size'] = args.batch_size
+    if args.workers:
+        config['inference_executor'] = dict(config.get('inference_executor', {}), type='process', workers=args.workers)
+
+    scanner = BulkScanner(config, args.output, args.concurrency)
+    try:
+        stats = asyncio.run(scanner.run(args.inputs, args.restart))
+    except KeyboardInterrupt:
+        print(f"\n已中断，结果保存在 {args.output}，重新运行相同命令即可继续")
+        sys.exit(130)
+    print(f"扫描完成: {json.dumps(stats, ensure_ascii=False)}，结果: {args.output}")
+
+
+if __name__ == '__main__':
+    _main()
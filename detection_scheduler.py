@@ -0,0 +1,152 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# 优先级：仍在撤回时限内的自动撤回群图片最先检测，其余按消息时间排队，重连后补查的历史图片最后
+RECALL = 0
+NORMAL = 1
+CATCH_UP = 2
+
+DETECTION_DECISIONS = REGISTRY.counter(
+    'antisetu_detection_priority_total',
+    '检测前优先级调度的决策数（recall=撤回优先，normal=普通，catch_up=重连补查，downgraded=超时降级，dropped=超时丢弃，recall_late=检测完成时已接近或超过撤回时限）',
+)
+
+
+def inference_capacity(config: Dict[str, Any]) -> int:
+    """模型同时能处理的图片数：启用微批时为一个批次（批次逐个送入模型），
+    否则多进程后端为进程数，进程内推理为 CPU 核数"""
+    batching_config = config.get('inference_batching', {})
+    if batching_config.get('enabled', True):
+        return max(1, int(batching_config.get('max_batch_size', 8)))
+    executor_config = config.get('inference_executor', {})
+    if executor_config.get('type', 'thread') == 'process':
+        return max(1, int(executor_config.get('workers') or os.cpu_count() or 1))
+    return os.cpu_count() or 1
+
+
+class DeadlineScheduler:
+    """检测前的优先级调度：限制同时检测的图片数，排队的图片按撤回时限排序
+
+    - 自动撤回群的图片优先，按消息时间从早到晚检测；
+    - 超过撤回时限（消息时间 + recall_window - safety_margin）的图片已无法撤回，
+      按配置降级为普通优先级（仍检测并发警告）或直接丢弃；
+    - 其他群的图片按消息时间排在后面；
+    - 重连后补查的历史图片排在所有实时图片之后。
+
+    同时检测的图片数默认等于模型的处理能力（inference_capacity），超出的图片在这里
+    按优先级排队，而不是在推理调度器中按先后顺序排队。
+    """
+
+    def __init__(self, config: Optional[Dict[str, Any]] = None):
+        config = config or {}
+        priority_config = config.get('detection_priority', {})
+        self.enabled = bool(priority_config.get('enabled', True))
+        self.concurrency = max(1, int(priority_config.get('concurrency') or inference_capacity(config)))
+        self.recall_window = float(priority_config.get('recall_window', 120))
+        self.safety_margin = float(priority_config.get('safety_margin', 5))
+        self.expired_action = priority_config.get('expired_action', 'downgrade')
+        self._active = 0
+        self._heap: List[tuple] = []
+        self._seq = itertools.count()
+        if self.enabled:
+            logger.info(f"检测优先级调度已启用: 并发={self.concurrency}, 撤回时限={self.recall_window}s, "
+                        f"超时处理={self.expired_action}")
+
+    @property
+    def pending(self) -> int:
+        """排队等待检测的图片数"""
+        return len(self._heap)
+
+    def is_expired(self, message_time: Optional[float], now: Optional[float] = None) -> bool:
+        """消息是否已超过撤回时限（留出 safety_margin 秒余量）"""
+        if not message_time:
+            return False
+        now = time.time() if now is None else now
+        return now > message_time + self.recall_window - self.safety_margin
+
+    def _classify(self, recall: bool, message_time: Optional[float], catch_up: bool = False) -> Optional[int]:
+        """决定排队优先级并计数，需要丢弃时返回 None"""
+        if catch_up:
+            if recall and self.is_expired(message_time) and self.expired_action == 'drop':
+                DETECTION_DECISIONS.inc(decision='dropped')
+                return None
+            DETECTION_DECISIONS.inc(decision='catch_up')
+            return CATCH_UP
+        if not recall:
+            DETECTION_DECISIONS.inc(decision='normal')
+            return NORMAL
+        if not self.is_expired(message_time):
+            DETECTION_DECISIONS.inc(decision='recall')
+            return RECALL
+        if self.expired_action == 'drop':
+            DETECTION_DECISIONS.inc(decision='dropped')
+            return None
+        DETECTION_DECISIONS.inc(decision='downgraded')
+        return NORMAL
+
+    async def run(self, func: Callable[[], Awaitable[Any]], recall: bool = False,
+                  message_time: Optional[float] = None, catch_up: bool = False) -> Optional[Any]:
+        """按优先级获得检测名额后执行 func，超时被丢弃时返回 None"""
+        if not self.enabled:
+            return await func()
+        priority = self._classify(recall, message_time, catch_up)
+        if priority is None:
+            return None
+        if not await self._acquire(priority, message_time):
+            return None
+        try:
+            return await func()
+        finally:
+            self._release()
+
+    async def _acquire(self, priority: int, message_time: Optional[float]) -> bool:
+        if self._active < self.concurrency and not self._heap:
+            self._active += 1
+            return True
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(self._heap, (priority, message_time or time.time(), next(self._seq), future))
+        try:
+            return await future
+        except asyncio.CancelledError:
+            # 已被分配名额但还没来得及执行就被取消，把名额交还
+            if future.done() and not future.cancelled() and future.result():
+                self._release()
+            raise
+
+    def _release(self):
+        self._active -= 1
+        now = time.time()
+        while self._heap and self._active < self.concurrency:
+            priority, message_time, seq, future = heapq.heappop(self._heap)
+            if future.done():
+                continue
+            # 排队期间超过撤回时限的图片重新处理
+            if priority == RECALL and self.is_expired(message_time, now):
+                if self.expired_action == 'drop':
+                    DETECTION_DECISIONS.inc(decision='dropped')
+                    future.set_result(False)
+                    continue
+                DETECTION_DECISIONS.inc(decision='downgraded')
+                heapq.heappush(self._heap, (NORMAL, message_time, seq, future))
+                continue
+            self._active += 1
+            future.set_result(True)
+
+    def record_recall(self, message_time: Optional[float]) -> bool:
+        """检测完成、即将撤回时调用：已接近或超过撤回时限时计数并返回 True
+
+        撤回仍然照常发送，是否已超时由 NapCat 判断。
+        """
+        if self.enabled and self.is_expired(message_time):
+            DETECTION_DECISIONS.inc(decision='recall_late')
+            return True
+        return False
@@ -0,0 +1,201 @@
+import asyncio
+import logging
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def shed_oldest(queue: Deque[Tuple[bool, Any]]) -> bool:
+    """从 (是否需要检测, 事件) 队列中丢弃一条：优先丢弃最旧的无需检测的事件，
+    全部需要检测时丢弃最旧的一条，返回丢弃的是否为需要检测的事件"""
+    for index, (protected, _) in enumerate(queue):
+        if not protected:
+            del queue[index]
+            return False
+    queue.popleft()
+    return True
+
+
+class InboundBuffer:
+    """WebSocket 读取与事件分发之间的缓冲
+
+    读取协程调用 put 从不等待，动作响应和心跳不会因为事件积压而停止读取；
+    由单独的协程取出事件交给分发器，分发器的反压只作用在这里。缓冲满时按
+    shed_oldest 的顺序腾出位置。
+    """
+
+    def __init__(self, max_size: int = 10000, is_protected: Optional[Callable[[Any], bool]] = None):
+        self.max_size = max(1, int(max_size))
+        self.is_protected = is_protected or (lambda event: False)
+        self.dropped = 0
+        self.dropped_protected = 0
+        self._queue: Deque[Tuple[bool, Tuple[str, Any]]] = deque()
+        self._has_item = asyncio.Event()
+        self._taken = 0  # 已取出但尚未交给分发器的事件数
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    @property
+    def unfinished(self) -> int:
+        """缓冲中和已取出尚未交出的事件数"""
+        return len(self._queue) + self._taken
+
+    def put(self, key: str, event: Any):
+        if len(self._queue) >= self.max_size:
+            self.dropped += 1
+            if shed_oldest(self._queue):
+                self.dropped_protected += 1
+                logger.warning(f"事件缓冲已满，丢弃最旧的一条图片消息，该图片未经检测（累计 {self.dropped_protected}）")
+        self._queue.append((bool(self.is_protected(event)), (key, event)))
+        self._has_item.set()
+
+    async def get(self) -> Tuple[str, Any]:
+        while not self._queue:
+            self._has_item.clear()
+            await self._has_item.wait()
+        self._taken += 1
+        return self._queue.popleft()[1]
+
+    def task_done(self):
+        """get 取出的事件已交给分发器"""
+        self._taken -= 1
+
+
+class EventDispatcher:
+    """有界并发事件分发器：按群轮转调度，避免单个刷屏群饿死其他群
+
+    - 固定数量的工作协程并发处理事件；
+    - 各群事件分别排队，工作协程按群轮流取事件；
+    - 排队总数达到上限时 dispatch 会等待，从而反压 InboundBuffer 的取出协程；
+    - 单个群排队超过上限时，先丢弃最旧的无需检测的事件（普通聊天、非白名单群消息），
+      只有全部是需要检测的图片消息时才丢弃其中最旧的一条，单独计数并记录警告，
+      避免刷屏把自己之前发的图片挤出队列而逃过检测。
+    """
+
+    def __init__(self, handler: Callable[[Any], Awaitable[None]], workers: int = 8,
+                 max_pending: int = 1000, max_pending_per_group: int = 100,
+                 is_protected: Optional[Callable[[Any], bool]] = None):
+        self.handler = handler
+        self.worker_count = max(1, int(workers))
+        self.max_pending = max(1, int(max_pending))
+        self.max_pending_per_group = max(1, int(max_pending_per_group))
+        # 需要检测的事件，排队过多时最后才丢弃
+        self.is_protected = is_protected or (lambda event: False)
+        self.dropped = 0
+        self.dropped_protected = 0
+        self._queues: Dict[str, Deque[Tuple[bool, Any]]] = {}
+        self._ready: Deque[str] = deque()  # 有待处理事件的群，按轮转顺序排列
+        self._pending = 0
+        self._in_flight = 0
+        self._has_work: Optional[asyncio.Event] = None
+        self._has_space: Optional[asyncio.Event] = None
+        self._idle: Optional[asyncio.Event] = None
+        self._workers: List[asyncio.Task] = []
+
+    @property
+    def pending(self) -> int:
+        """排队中的事件数"""
+        return self._pending
+
+    @property
+    def in_flight(self) -> int:
+        """正在处理的事件数"""
+        return self._in_flight
+
+    def start(self):
+        """启动工作协程"""
+        if self._workers:
+            return
+        self._has_work = asyncio.Event()
+        self._has_space = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._update_state()
+        self._workers = [asyncio.ensure_future(self._worker()) for _ in range(self.worker_count)]
+        logger.info(f"事件分发器已启动: 并发={self.worker_count}, 队列上限={self.max_pending}, 单群上限={self.max_pending_per_group}")
+
+    def _update_state(self):
+        if self._ready:
+            self._has_work.set()
+        else:
+            self._has_work.clear()
+        if self._pending < self.max_pending:
+            self._has_space.set()
+        else:
+            self._has_space.clear()
+        if self._pending or self._in_flight:
+            self._idle.clear()
+        else:
+            self._idle.set()
+
+    async def dispatch(self, key: str, event: Any):
+        """把事件放入对应群的队列，排队总数已满时等待"""
+        self.start()
+        while self._pending >= self.max_pending:
+            await self._has_space.wait()
+        queue = self._queues.get(key)
+        if queue is not None and len(queue) >= self.max_pending_per_group:
+            self.dropped += 1
+            self._pending -= 1
+            if shed_oldest(queue):
+                self.dropped_protected += 1
+                logger.warning(f"群 {key} 待处理的图片消息过多，丢弃最旧的一条，该图片未经检测"
+                               f"（累计未检测丢弃 {self.dropped_protected}）")
+            else:
+                logger.debug(f"群 {key} 待处理事件过多，丢弃一条无需检测的事件（累计丢弃 {self.dropped}）")
+        if queue is None:
+            queue = self._queues[key] = deque()
+            self._ready.append(key)
+        queue.append((bool(self.is_protected(event)), event))
+        self._pending += 1
+        self._update_state()
+
+    async def _next_event(self) -> Any:
+        while not self._ready:
+            await self._has_work.wait()
+        key = self._ready.popleft()
+        queue = self._queues[key]
+        _, event = queue.popleft()
+        if queue:
+            self._ready.append(key)
+        else:
+            del self._queues[key]
+        self._pending -= 1
+        self._in_flight += 1
+        self._update_state()
+        return event
+
+    async def _worker(self):
+        while True:
+            event = await self._next_event()
+            try:
+                await self.handler(event)
+            except Exception as e:
+                logger.error(f"处理事件异常: {e}", exc_info=True)
+            finally:
+                self._in_flight -= 1
+                self._update_state()
+
+    async def drain(self, timeout: Optional[float] = None) -> bool:
+        """等待已接收的事件全部处理完，返回是否在超时前完成"""
+        if not self._workers:
+            return True
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            logger.warning(f"等待事件处理完成超时，剩余排队 {self._pending}，处理中 {self._in_flight}")
+            return False
+
+    async def close(self, timeout: Optional[float] = None):
+        """处理完已接收的事件后停止工作协程"""
+        await self.drain(timeout)
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._queues.clear()
+        self._ready.clear()
+        self._pending = 0
+        self._in_flight = 0
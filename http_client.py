@@ -0,0 +1,99 @@
+import asyncio
+import contextlib
+import logging
+import random
+from typing import Any, Dict, Optional
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+
+class HttpClient:
+    """共享的HTTP客户端：按主机复用长连接，支持连接数限制、超时和带抖动的重试"""
+
+    def __init__(self, config: Optional[Dict[str, Any]] = None):
+        config = config or {}
+        http_config = config.get('http_client', {})
+        self.limit = int(http_config.get('limit', 100))
+        self.limit_per_host = int(http_config.get('limit_per_host', 20))
+        self.keepalive_timeout = float(http_config.get('keepalive_timeout', 30))
+        self.timeout = aiohttp.ClientTimeout(
+            total=float(http_config.get('total_timeout', 15)),
+            connect=float(http_config.get('connect_timeout', 5)),
+        )
+        self.retries = int(http_config.get('retries', 2))
+        self.retry_backoff = float(http_config.get('retry_backoff', 0.2))
+        self.retry_backoff_max = float(http_config.get('retry_backoff_max', 2))
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """首次使用时在当前事件循环中创建会话"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=300,
+            )
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self._session
+
+    async def _backoff(self, attempt: int):
+        """指数退避 + 全抖动"""
+        delay = min(self.retry_backoff_max, self.retry_backoff * (2 ** attempt))
+        await asyncio.sleep(random.uniform(0, delay))
+
+    @contextlib.asynccontextmanager
+    async def request(self, method: str, url: str, idempotent: bool = True, **kwargs):
+        """发起请求并返回响应，失败时按配置重试
+
+        非幂等请求（如发送消息）只在连接建立失败时重试，避免重复发送；
+        幂等请求在连接异常、超时和 5xx 响应时都会重试。
+        """
+        session = self._get_session()
+        attempts = self.retries + 1
+        response = None
+        for attempt in range(attempts):
+            last_attempt = attempt + 1 >= attempts
+            try:
+                response = await session.request(method, url, **kwargs)
+            except aiohttp.ClientConnectorError as e:
+                if last_attempt:
+                    raise
+                logger.debug(f"连接失败，准备重试({attempt + 1}/{self.retries}): {url} {e}")
+                await self._backoff(attempt)
+                continue
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if last_attempt or not idempotent:
+                    raise
+                logger.debug(f"请求异常，准备重试({attempt + 1}/{self.retries}): {url} {e!r}")
+                await self._backoff(attempt)
+                continue
+            if response.status >= 500 and idempotent and not last_attempt:
+                logger.debug(f"服务端错误 {response.status}，准备重试({attempt + 1}/{self.retries}): {url}")
+                response.release()
+                await self._backoff(attempt)
+                continue
+            break
+        try:
+            yield response
+        finally:
+            response.release()
+
+    async def post_json(self, url: str, data: Dict[str, Any], idempotent: bool = True) -> Optional[Dict[str, Any]]:
+        """POST JSON 并解析返回的 JSON，HTTP 状态非 200 时返回 None"""
+        async with self.request('POST', url, idempotent=idempotent, json=data) as response:
+            if response.status != 200:
+                logger.error(f"请求失败: {url} {response.status}")
+                return None
+            try:
+                return await response.json(content_type=None)
+            except ValueError:
+                return {}
+
+    async def close(self):
+        """关闭会话和连接池"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
@@ -2,25 +2,216 @@ import asyncio
 import logging
 from PIL import Image
 import io
-from typing import List, Dict, Optional
-from SensitiveImgDetect import Detect
+from typing import Callable, Iterator, List, Dict, Optional, Tuple
+from inference_scheduler import BatchInferenceScheduler
+from inference_pool import ProcessPoolBackend
+from inference_backends import load_backend
+from metrics import stage_timer, timed
+from prefilter import Prefilter
 
 logger = logging.getLogger(__name__)
 
+# 默认违规关键词，标签包含其中任一关键词且置信度超过阈值即判定违规
+DEFAULT_VIOLATION_KEYWORDS = ["porn", "politic", "explicit", "sexual", "sex", "敏感", "色情"]
+
+# 模型标签到中文的映射，未收录的标签显示为“标签(未翻译)”
+DEFAULT_LABEL_MAP = {
+    "cartoon": "动漫",
+    "carton": "动漫",
+    "porn": "色情",
+    "politic": "涉政",
+    "other": "其他",
+    "explicit": "露骨",
+    "sexual": "性暗示",
+    "sex": "性相关",
+    "敏感": "敏感",
+    "色情": "色情"
+}
+
+
+def evaluate_results(results: List[Dict], label_map: Dict[str, str], confidence_threshold: float,
+                     violation_keywords: List[str]) -> Dict:
+    """按标签映射和违规关键词判定一张图片的检测结果，机器人和批量扫描共用"""
+    violation_found = False
+    result_text = "🔍 图片检测结果:\n"
+    violation_labels = []
+    violation_raw_labels = []
+
+    for i, result in enumerate(results, 1):
+        label = result.get('label', '未知')
+        label_cn = label_map.get(label.lower(), f"{label}(未翻译)")
+        confidence = result.get('confidence', 0)
+        result_text += f"{i}. {label_cn}: {confidence:.2%}\n"
+
+        if confidence > confidence_threshold:
+            if any(keyword in label.lower() for keyword in violation_keywords):
+                violation_found = True
+                violation_labels.append(label_cn)
+                violation_raw_labels.append(label)
+                logger.info(f"检测到违规内容: {label_cn} ({confidence:.2%})")
+
+    return {
+        'results': results,
+        'violation': violation_found,
+        'text': result_text,
+        'labels': violation_labels,
+        'raw_labels': violation_raw_labels,
+    }
+
+
+def _reduce_frame(image: Image.Image, input_size: Optional[int]) -> Image.Image:
+    """把单帧转换为RGB，并缩小到短边等于模型输入尺寸"""
+    if input_size:
+        width, height = image.size
+        scale = input_size / min(width, height)
+        if scale < 1:
+            target = (max(1, round(width * scale)), max(1, round(height * scale)))
+            # JPEG 在解码阶段按 1/2、1/4、1/8 降采样，不必先解码出原图
+            image.draft('RGB', target)
+            # 调色板/二值图不支持插值缩放，需先转换；其他模式先缩小再转换，处理的数据更少
+            if image.mode in ('P', '1'):
+                image = image.convert('RGB')
+            image = image.resize(target, Image.BILINEAR, reducing_gap=2.0)
+    if image.mode != 'RGB':
+        logger.debug(f"转换图片模式: {image.mode} -> RGB")
+        image = image.convert('RGB')
+    return image
+
+
+def iter_frames(image_data: bytes, input_size: Optional[int] = None, max_frames: int = 1) -> Iterator[Image.Image]:
+    """逐帧解码为RGB并缩小到模型输入尺寸，动图均匀抽取最多 max_frames 帧
+
+    GIF 的后续帧依赖前面的帧，取靠后的帧要顺序解码中间的所有帧：480x480、60 帧的动图
+    只取第一帧约 3ms，取到最后一帧约 330ms。因此只有调用方继续取下一帧时才往后解码。
+    """
+    image = Image.open(io.BytesIO(image_data))
+    frame_count = getattr(image, 'n_frames', 1)
+    if frame_count <= 1 or max_frames <= 1:
+        yield _reduce_frame(image, input_size)
+        return
+    # 动图按帧号均匀抽样，首尾帧都会被选中
+    count = min(max_frames, frame_count)
+    indices = sorted({round(i * (frame_count - 1) / (count - 1)) for i in range(count)})
+    logger.debug(f"动图共 {frame_count} 帧，抽取第 {indices} 帧检测")
+    for index in indices:
+        image.seek(index)
+        yield _reduce_frame(image.copy(), input_size)
+
+
+def preprocess_image(image_data: bytes, input_size: Optional[int] = None,
+                     max_frames: int = 1) -> Optional[List[Image.Image]]:
+    """预处理图片：一次解码所有抽取的帧，失败时返回 None"""
+    try:
+        return list(iter_frames(image_data, input_size, max_frames))
+    except Exception as e:
+        logger.error(f"图片预处理失败: {e}")
+        return None
+
+
+def next_frame(frames: Iterator[Image.Image]) -> Optional[Image.Image]:
+    """取下一帧，没有更多帧或解码失败时返回 None"""
+    try:
+        return next(frames, None)
+    except Exception as e:
+        logger.error(f"图片预处理失败: {e}")
+        return None
+
+
+def frame_is_violation(results_dict: Dict, confidence_threshold: float, violation_keywords: List[str]) -> bool:
+    """按概率字典判定是否违规，与机器人的判定规则相同"""
+    return any(
+        confidence > confidence_threshold and any(keyword in label.lower() for keyword in violation_keywords)
+        for label, confidence in results_dict.items()
+    )
+
+
+def merge_frame_results(frame_results: List[Dict]) -> Dict:
+    """合并动图各帧的检测结果：每个标签取各帧中的最高置信度"""
+    if len(frame_results) == 1:
+        return frame_results[0]
+    merged = {}
+    for results_dict in frame_results:
+        for label, confidence in results_dict.items():
+            merged[label] = max(confidence, merged.get(label, confidence))
+    return merged
+
+
+def detect_batch(detector, images: List[Image.Image]) -> List[Dict]:
+    """批量检测，模型支持时整批送入，否则逐张检测"""
+    detect_list_prob = getattr(detector, 'detect_list_prob', None)
+    if detect_list_prob is not None and len(images) > 1:
+        return list(detect_list_prob(images))
+    return [detector.detect_single_prob(image) for image in images]
+
+
+def detect_images(detector, images_data: List[bytes], preprocess_options: Dict,
+                  is_violation: Optional[Callable[[Dict], bool]] = None) -> List[Optional[Dict]]:
+    """解码并检测一批图片，预处理失败的图片返回 None
+
+    各图片按轮次取下一帧合成一批检测；某张动图已有一帧判定违规时不再解码它后面的帧。
+    各帧结果取最高置信度合并，提前停止不会改变违规判定。
+    """
+    frames = [iter_frames(image_data, **preprocess_options) for image_data in images_data]
+    results: List[Optional[Dict]] = [None] * len(images_data)
+    active = list(range(len(images_data)))
+    while active:
+        batch = [(index, next_frame(frames[index])) for index in active]
+        batch = [(index, frame) for index, frame in batch if frame is not None]
+        if not batch:
+            break
+        outputs = detect_batch(detector, [frame for _, frame in batch])
+        active = []
+        for (index, _), output in zip(batch, outputs):
+            results[index] = output if results[index] is None else merge_frame_results([results[index], output])
+            if is_violation is None or not is_violation(results[index]):
+                active.append(index)
+    return results
+
+
+def detect_frames(detector, frames_per_image: List[Optional[List[Image.Image]]]) -> List[Optional[Dict]]:
+    """把多张图片的所有帧合成一批检测，再按图片合并各帧结果"""
+    flat = [frame for frames in frames_per_image if frames for frame in frames]
+    outputs = iter(detect_batch(detector, flat) if flat else [])
+    results = []
+    for frames in frames_per_image:
+        if not frames:
+            results.append(None)
+            continue
+        results.append(merge_frame_results([next(outputs) for _ in frames]))
+    return results
+
 class ImageDetector:
-    def __init__(self, config: Dict = None):
+    def __init__(self, config: Dict = None, lazy: bool = False):
+        """lazy 为 True 时只读取配置，模型由 load() / load_async() 加载"""
         self.detector = None
         self.version = 'v2'
         self.labels = ['cartoon', 'porn', 'politic', 'other']
         self.confidence_threshold = 0.65  # 默认阈值
         self.model_path = None  # 模型路径
+        self.scheduler = None  # 微批推理调度器
+        self.process_pool = None  # 多进程推理后端
+        self.input_size = 224  # 解码时直接缩小到的短边尺寸（模型输入尺寸）
+        self.max_frames = 3  # 动图最多抽取的帧数
+        self.violation_keywords = DEFAULT_VIOLATION_KEYWORDS  # 预筛评估模式判定违规用
+        self.ready = False  # 模型已加载并完成预热
+        self.in_flight = 0  # 正在检测的图片数，热切换模型时等待其归零
+        batching_config = {}
+        executor_config = {}
+        self.backend_config = {}  # 推理后端（torch / onnx）
 
         # 从配置文件加载模型设置
         if config:
+            preprocess_config = config.get('preprocess', {})
+            self.input_size = preprocess_config.get('input_size', self.input_size)
+            self.max_frames = int(preprocess_config.get('max_frames', self.max_frames))
+            batching_config = config.get('inference_batching', {})
+            executor_config = config.get('inference_executor', {})
+            self.backend_config = config.get('inference_backend', {})
             model_config = config.get('model_config', {})
             self.version = model_config.get('version', 'v2')
             self.labels = model_config.get('labels', self.labels)
             self.confidence_threshold = float(model_config.get('confidence_threshold', 0.65))
+            self.violation_keywords = config.get('violation_keywords', self.violation_keywords)
             # 读取模型路径，只有非空且非默认才用
             model_path = config.get('model_path', None)
             if model_path and model_path != "your_model_dir_or_file_path":
@@ -28,83 +219,251 @@ class ImageDetector:
             else:
                 self.model_path = None
 
+        # 模型前的廉价预筛
+        self.prefilter = Prefilter(config)
+
+        self._batching_config = batching_config
+        self._executor_config = executor_config
         logger.info(f"配置加载完成: 版本={self.version}, 标签={self.labels}, 阈值={self.confidence_threshold}, 模型路径={self.model_path}")
-        self._initialize_detector()
+        if not lazy:
+            self.load()
+
+    def load(self):
+        """加载模型并创建推理调度器（耗时操作，异步场景下放到线程中执行）"""
+        executor_config = self._executor_config
+        batching_config = self._batching_config
+        if executor_config.get('type', 'thread') == 'process':
+            self._initialize_process_pool(executor_config)
+        else:
+            self._initialize_detector()
+
+        if batching_config.get('enabled', True):
+            run_batch = self.process_pool.run_batch if self.process_pool is not None else self._detect_batch
+            self.scheduler = BatchInferenceScheduler(
+                run_batch,
+                max_batch_size=batching_config.get('max_batch_size', 8),
+                max_wait_ms=batching_config.get('max_wait_ms', 10),
+            )
+            logger.info(f"微批推理已启用: 最大批次={self.scheduler.max_batch_size}, 最长等待={batching_config.get('max_wait_ms', 10)}ms")
 
     def _initialize_detector(self):
-        """初始化SensitiveImgDetect模型"""
+        """按 inference_backend 配置初始化推理后端，ONNX 后端加载失败时改用原始模型"""
+        backend_type = self.backend_config.get('type', 'torch')
         try:
-            # 支持自定义模型路径
-            if self.model_path:
-                self.detector = Detect(device='cpu', version=self.version, model_path=self.model_path)
-            else:
-                self.detector = Detect(device='cpu', version=self.version)
-            logger.info(f"SensitiveImgDetect模型加载成功")
+            self.detector = load_backend(self.version, self.model_path, self.backend_config)
+            logger.info(f"推理后端加载成功: {backend_type}")
+            return
+        except Exception as e:
+            logger.error(f"推理后端 {backend_type} 初始化失败: {e}")
+            self.detector = None
+        if backend_type == 'torch':
+            return
+        try:
+            self.detector = load_backend(self.version, self.model_path)
+            logger.info(f"已改用SensitiveImgDetect原始模型")
         except Exception as e:
             logger.error(f"模型初始化失败: {e}")
             self.detector = None
     
-    def _preprocess_image(self, image_data: bytes) -> Optional[Image.Image]:
-        """预处理图片：转换为RGB格式"""
+    def _initialize_process_pool(self, executor_config: Dict):
+        """初始化多进程推理后端，模型由各工作进程自行加载"""
         try:
-            image = Image.open(io.BytesIO(image_data))
-            if image.mode != 'RGB':
-                logger.debug(f"转换图片模式: {image.mode} -> RGB")
-                image = image.convert('RGB')
-            return image
+            self.process_pool = ProcessPoolBackend(
+                self.version,
+                self.model_path,
+                preprocess_options=self.preprocess_options,
+                violation_rule=self._violation_rule,
+                backend_config=self.backend_config,
+                workers=executor_config.get('workers'),
+                max_tasks_per_child=executor_config.get('max_tasks_per_child'),
+                max_restarts=executor_config.get('max_restarts', 5),
+                restart_cooldown=executor_config.get('restart_cooldown', 60),
+            )
+        except Exception as e:
+            logger.error(f"多进程推理后端初始化失败，改用进程内推理: {e}")
+            self.process_pool = None
+            self._initialize_detector()
+
+    async def load_async(self):
+        """在线程中加载模型，再用一张合成图片预热，完成后标记为就绪
+
+        多进程后端要等所有工作进程都加载模型并检测成功才算可用，否则关闭进程池改用进程内推理。
+        """
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        await loop.run_in_executor(None, self.load)
+        if not await self.warm_up() and self.process_pool is not None:
+            logger.error("多进程推理后端预热失败，改用进程内推理")
+            await loop.run_in_executor(None, self._fall_back_to_in_process)
+            await self.warm_up()
+        self.ready = True
+        logger.info(f"模型已就绪，加载和预热耗时 {loop.time() - start:.1f}s")
+
+    async def warm_up(self) -> bool:
+        """预热：完成首次推理的初始化开销，多进程后端让每个工作进程都加载模型，返回是否成功"""
+        if not self.model_loaded:
+            logger.warning("模型未加载，跳过预热")
+            return False
+        buffer = io.BytesIO()
+        Image.new('RGB', (self.input_size or 224, self.input_size or 224), color=(128, 128, 128)).save(buffer, format='JPEG')
+        image_data = buffer.getvalue()
+        try:
+            if self.process_pool is not None:
+                return await self.process_pool.verify(image_data)
+            return bool(await self._detect_with_model(image_data))
         except Exception as e:
-            logger.error(f"图片预处理失败: {e}")
-            return None
+            logger.error(f"模型预热失败: {e}")
+            return False
+
+    def _fall_back_to_in_process(self):
+        """关闭多进程后端，在当前进程中加载模型，微批调度器改用进程内推理"""
+        pool, self.process_pool = self.process_pool, None
+        pool.close()
+        self._initialize_detector()
+        if self.scheduler is not None:
+            self.scheduler.run_batch = self._detect_batch
+
+    @property
+    def model_loaded(self) -> bool:
+        """模型是否可用（进程内模型或多进程后端）"""
+        return self.detector is not None or self.process_pool is not None
+
+    @property
+    def preprocess_options(self) -> Dict:
+        """预处理参数，进程内和多进程后端共用"""
+        return {'input_size': self.input_size, 'max_frames': self.max_frames}
+
+    def _violation_rule(self) -> Tuple[float, List[str]]:
+        """当前的违规判定规则，热重载后多进程后端下一批即使用新值"""
+        return self.confidence_threshold, self.violation_keywords
+
+    def _frame_is_violation(self, results_dict: Dict) -> bool:
+        """动图提前停止解码的判定"""
+        return frame_is_violation(results_dict, self.confidence_threshold, self.violation_keywords)
     
+    def _detect_batch(self, images: List[Image.Image]) -> List[Dict]:
+        """批量检测，模型支持时整批送入，否则逐张检测"""
+        return detect_batch(self.detector, images)
+
+    def is_violation(self, results: List[Dict]) -> bool:
+        """与机器人处理检测结果相同的违规判定：置信度超过阈值且标签包含违规关键词"""
+        return frame_is_violation({result.get('label', ''): result.get('confidence', 0) for result in results},
+                                  self.confidence_threshold, self.violation_keywords)
+
+    @timed('detect')
     async def detect_image(self, image_data: bytes) -> List[Dict]:
-        """检测图片内容"""
+        """检测图片内容，启用预筛时明显无害的图片不经过模型"""
+        if not self.model_loaded:
+            logger.warning("模型未加载，使用模拟检测结果")
+            return self._get_mock_results()
+        self.in_flight += 1
         try:
-            if self.detector is None:
-                logger.warning("模型未加载，使用模拟检测结果")
-                return self._get_mock_results()
+            return await self._detect(image_data)
+        finally:
+            self.in_flight -= 1
+
+    async def _detect(self, image_data: bytes) -> List[Dict]:
+        if not self.prefilter.enabled:
+            return await self._detect_with_model(image_data)
+
+        loop = asyncio.get_event_loop()
+        with stage_timer('prefilter'):
+            tier = await loop.run_in_executor(None, self.prefilter.check, image_data)
+        self.prefilter.count(tier)
+        if tier is not None and not self.prefilter.evaluate:
+            logger.info(f"预筛放行（{tier}），跳过模型检测")
+            return self.prefilter.cleared_results(tier)
+
+        results = await self._detect_with_model(image_data)
+        if self.prefilter.evaluate and results:
+            # 评估模式：全部图片仍由模型检测，统计预筛放行的图片中有多少被模型判定违规
+            self.prefilter.record_evaluation(tier, self.is_violation(results))
+        return results
+
+    async def _detect_with_model(self, image_data: bytes) -> List[Dict]:
+        """使用模型检测图片内容"""
+        try:
+            if self.process_pool is not None:
+                # 多进程后端：图片以字节形式传给工作进程，预处理也在工作进程内完成
+                logger.debug("调用多进程后端检测")
+                with stage_timer('inference'):
+                    if self.scheduler is not None:
+                        results_dict = await self.scheduler.submit(image_data)
+                    else:
+                        results_dict = (await self.process_pool.run_batch([image_data]))[0]
+                if results_dict is None:
+                    logger.warning("图片预处理失败，无法检测")
+                    return []
+                return self._format_results(results_dict)
             
-            logger.debug("开始预处理图片")
-            image = self._preprocess_image(image_data)
-            if image is None:
+            loop = asyncio.get_event_loop()
+            if self.scheduler is None:
+                # 解码和检测都放到线程池，避免阻塞事件循环
+                with stage_timer('inference'):
+                    results_dict = (await loop.run_in_executor(
+                        None, detect_images, self.detector, [image_data], self.preprocess_options,
+                        self._frame_is_violation))[0]
+            else:
+                # 逐帧解码后交给微批调度器，与其他群的待检测图片合并推理；
+                # 动图某一帧已判定违规时不再解码后面的帧
+                frames = iter_frames(image_data, **self.preprocess_options)
+                results_dict = None
+                while results_dict is None or not self._frame_is_violation(results_dict):
+                    with stage_timer('decode'):
+                        frame = await loop.run_in_executor(None, next_frame, frames)
+                    if frame is None:
+                        break
+                    with stage_timer('inference'):
+                        output = await self.scheduler.submit(frame)
+                    results_dict = output if results_dict is None else merge_frame_results([results_dict, output])
+            if results_dict is None:
                 logger.warning("图片预处理失败，无法检测")
                 return []
-            
-            logger.debug("调用模型检测")
-            # 使用线程池运行检测避免阻塞事件循环
-            loop = asyncio.get_event_loop()
-            # 调用detect_single_prob方法获取概率字典
-            results_dict = await loop.run_in_executor(
-                None, 
-                self.detector.detect_single_prob, 
-                image
-            )
-            
-            # 记录原始结果
-            logger.debug(f"模型原始输出: {results_dict}")
-            
-            # 将结果字典转换成我们需要的格式
-            results = []
-            for label, confidence in results_dict.items():
-                # 添加所有结果，不进行过滤
-                results.append({
-                    'label': label,
-                    'confidence': confidence
-                })
-            
-            # 按置信度排序
-            results.sort(key=lambda x: x['confidence'], reverse=True)
-            
-            logger.info(f"图片检测完成，检测到 {len(results)} 个分类结果")
-            # 记录详细结果
-            for i, result in enumerate(results):
-                logger.debug(f"结果 {i+1}: {result['label']} - {result['confidence']:.2%}")
-            
-            return results
+            return self._format_results(results_dict)
             
         except Exception as e:
             logger.error(f"图片检测异常: {e}", exc_info=True)
             return []
+
+    def _format_results(self, results_dict: Dict) -> List[Dict]:
+        """把模型输出的概率字典转换成按置信度排序的结果列表"""
+        # 记录原始结果
+        logger.debug(f"模型原始输出: {results_dict}")
+        
+        # 将结果字典转换成我们需要的格式
+        results = []
+        for label, confidence in results_dict.items():
+            # 添加所有结果，不进行过滤
+            results.append({
+                'label': label,
+                'confidence': confidence
+            })
+        
+        # 按置信度排序
+        results.sort(key=lambda x: x['confidence'], reverse=True)
+        
+        logger.info(f"图片检测完成，检测到 {len(results)} 个分类结果")
+        # 记录详细结果
+        for i, result in enumerate(results):
+            logger.debug(f"结果 {i+1}: {result['label']} - {result['confidence']:.2%}")
+        
+        return results
     
+    async def close(self, timeout: float = 30):
+        """等待正在检测的图片完成，再停止推理调度器和推理进程池"""
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
+        while self.in_flight and loop.time() < deadline:
+            await asyncio.sleep(0.05)
+        if self.prefilter.enabled:
+            logger.info(f"预筛统计: {self.prefilter.stats()}")
+        if self.scheduler is not None:
+            logger.info(f"批量推理统计: {self.scheduler.stats()}")
+            await self.scheduler.close()
+        if self.process_pool is not None:
+            # 等待工作进程退出，放到线程中避免阻塞事件循环
+            await loop.run_in_executor(None, self.process_pool.close)
+
     def _get_mock_results(self) -> List[Dict]:
         """获取模拟检测结果（当模型未加载时使用）"""
         import random
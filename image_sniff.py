@@ -0,0 +1,58 @@
+import io
+import logging
+from typing import Optional, Tuple
+
+from PIL import Image
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# 默认像素上限：Pillow 判定为解压炸弹并拒绝打开的像素数，低于此值的大图在检测时按降采样解码
+MAX_PIXELS = 2 * Image.MAX_IMAGE_PIXELS
+
+UNMODERATED_IMAGES = REGISTRY.counter('antisetu_images_unmoderated_total', '无法检测而跳过的图片数（too_large=像素超过上限）')
+
+
+class ImageTooLarge(ValueError):
+    """图片像素超过上限，不下载、不检测"""
+
+
+def check_pixels(size: Optional[Tuple[int, int]], max_pixels: int):
+    """宽高超过像素上限时抛出 ImageTooLarge"""
+    if size and size[0] * size[1] > max_pixels:
+        raise ImageTooLarge(f"{size[0]}x{size[1]}")
+
+# 只需前几个字节即可识别的图片格式签名
+SIGNATURES = (
+    (b'\xff\xd8\xff', 'JPEG'),
+    (b'\x89PNG\r\n\x1a\n', 'PNG'),
+    (b'GIF87a', 'GIF'),
+    (b'GIF89a', 'GIF'),
+    (b'BM', 'BMP'),
+)
+
+# 识别格式所需的最少字节数
+SNIFF_BYTES = 12
+
+
+def sniff_format(head: bytes) -> Optional[str]:
+    """根据文件头识别图片格式，不支持或无法识别时返回 None"""
+    for signature, name in SIGNATURES:
+        if head.startswith(signature):
+            return name
+    if len(head) >= 12 and head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'WEBP'
+    return None
+
+
+def probe_size(data: bytes) -> Optional[Tuple[int, int]]:
+    """只解析图片头部获取宽高，头部数据不完整时返回 None，解压炸弹抛出 ImageTooLarge"""
+    try:
+        # Image.open 只读取头部，不会解码像素
+        with Image.open(io.BytesIO(data)) as image:
+            return image.size
+    except Image.DecompressionBombError as e:
+        raise ImageTooLarge(str(e)) from e
+    except Exception:
+        return None
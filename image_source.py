@@ -0,0 +1,191 @@
+import asyncio
+import logging
+import mmap
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+from urllib.parse import unquote, urlparse
+
+from PIL import Image
+
+from image_sniff import MAX_PIXELS, SNIFF_BYTES, ImageTooLarge, check_pixels, sniff_format
+from metrics import REGISTRY, timed
+
+logger = logging.getLogger(__name__)
+
+IMAGE_SOURCE = REGISTRY.counter(
+    'antisetu_image_source_total',
+    '图片获取来源（local=消息段中的本地路径，get_image=NapCat get_image 接口，http=下载，failed=全部失败）',
+)
+IMAGE_SOURCE_BYTES = REGISTRY.counter('antisetu_image_source_bytes_total', '各来源读取的图片字节数')
+
+# NapCat（Linux 版 QQ）的数据目录，图片缓存和临时文件都在其中
+DEFAULT_ALLOWED_DIRS = ['~/.config/QQ']
+
+
+def read_local_image(path: str, max_bytes: int, max_pixels: int) -> Optional[bytes]:
+    """通过 mmap 读取本地图片，与下载使用相同的大小、格式和像素限制
+
+    格式和宽高只读取文件头所在的页面，不符合限制的图片不会读入整个文件；
+    通过检查后只复制一次得到图片数据。像素超过上限时抛出 ImageTooLarge。
+    path 应为已解析的真实路径，最后一级是符号链接时拒绝打开。
+    """
+    with open(os.open(path, os.O_RDONLY | getattr(os, 'O_NOFOLLOW', 0)), 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < SNIFF_BYTES:
+            logger.debug(f"本地图片为空或过短: {path}")
+            return None
+        if size > max_bytes:
+            logger.warning(f"本地图片过大，跳过: {size} 字节")
+            return None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if sniff_format(mapped[:SNIFF_BYTES]) is None:
+                logger.warning(f"本地文件不是支持的图片格式: {path}")
+                return None
+            try:
+                # Image.open 只解析头部，mmap 可直接作为文件对象使用
+                with Image.open(mapped) as image:
+                    size = image.size
+            except Image.DecompressionBombError as e:
+                raise ImageTooLarge(str(e)) from e
+            except Exception as e:
+                logger.warning(f"无法解析本地图片头部: {path} {e}")
+                return None
+            check_pixels(size, max_pixels)
+            return mapped[:]
+
+
+class ImageSource:
+    """图片获取：优先读取 NapCat 已缓存在本机的文件，失败时再从 QQ 图床下载
+
+    依次尝试：
+    1. 消息段 ``path`` / ``file`` 字段中的本地路径（绝对路径或 file:// URI）；
+    2. 调用 NapCat 的 ``get_image`` 接口取得本地缓存路径；
+    3. 通过 ``url`` 下载。
+
+    NapCat 运行在容器中时，用 path_map 把容器内路径映射到本机路径。
+    消息段中的路径来自群消息，只读取 allowed_dirs 中的文件；未配置 allowed_dirs 时不读取本地文件。
+    连续多次拿不到可读的本地文件（例如 NapCat 在另一台机器上）时，
+    暂停本地读取 retry_after 秒，避免每张图片都白白多一次 get_image 调用。
+    """
+
+    def __init__(self, download: Callable[[str], Awaitable[Optional[bytes]]],
+                 call_action: Callable[[str, Dict[str, Any]], Awaitable[Optional[Dict[str, Any]]]],
+                 config: Optional[Dict[str, Any]] = None):
+        config = config or {}
+        source_config = config.get('image_source', {})
+        download_config = config.get('image_download', {})
+        self.download = download
+        self.call_action = call_action
+        self.local_enabled = bool(source_config.get('local_cache', True))
+        self.use_get_image = bool(source_config.get('get_image', True))
+        self.get_image_timeout = float(source_config.get('get_image_timeout', 2))
+        self.path_map: Dict[str, str] = dict(source_config.get('path_map', {}))
+        self.allowed_dirs: List[str] = [os.path.realpath(os.path.expanduser(path))
+                                        for path in source_config.get('allowed_dirs', DEFAULT_ALLOWED_DIRS) or []]
+        self.max_failures = int(source_config.get('max_consecutive_failures', 20))
+        self.retry_after = float(source_config.get('retry_after', 600))
+        self.max_bytes = int(download_config.get('max_bytes', 10 * 1024 * 1024))
+        self.max_pixels = int(download_config.get('max_pixels') or MAX_PIXELS)
+        self._failures = 0
+        self._paused_until = 0.0
+        if self.local_enabled and not self.allowed_dirs:
+            logger.warning("未配置 image_source.allowed_dirs，不读取本地缓存，图片全部通过下载获取")
+            self.local_enabled = False
+        logger.info(f"图片获取: 本地缓存={self.local_enabled}, get_image={self.use_get_image}, 路径映射={self.path_map}")
+
+    def _map_path(self, path: str) -> Optional[str]:
+        """把消息段或 get_image 返回的路径转换为本机路径，不是本地路径时返回 None"""
+        if not path:
+            return None
+        if path.startswith('file://'):
+            path = unquote(urlparse(path).path)
+            # Windows 路径形如 file:///C:/...
+            if len(path) > 2 and path[0] == '/' and path[2] == ':':
+                path = path[1:]
+        elif '://' in path or path.startswith('base64:'):
+            return None
+        for prefix, target in self.path_map.items():
+            if path.startswith(prefix):
+                path = target + path[len(prefix):]
+                break
+        if not os.path.isabs(path):
+            return None
+        real = os.path.realpath(path)
+        if not any(real == base or real.startswith(base + os.sep) for base in self.allowed_dirs):
+            logger.debug(f"本地路径不在允许的目录中: {path}")
+            return None
+        # 返回检查过的真实路径，检查之后再替换成符号链接也不会读到允许目录以外的文件
+        return real
+
+    async def _read(self, path: str) -> Optional[bytes]:
+        loop = asyncio.get_event_loop()
+        try:
+            return await loop.run_in_executor(None, read_local_image, path, self.max_bytes, self.max_pixels)
+        except FileNotFoundError:
+            logger.debug(f"本地图片不存在: {path}")
+        except OSError as e:
+            logger.debug(f"读取本地图片失败: {path} {e}")
+        return None
+
+    async def _get_image_path(self, file: str) -> Optional[str]:
+        try:
+            response = await asyncio.wait_for(self.call_action('get_image', {'file': file}), self.get_image_timeout)
+        except asyncio.TimeoutError:
+            logger.debug(f"get_image 超时: {file}")
+            return None
+        except Exception as e:
+            logger.debug(f"get_image 调用失败: {e}")
+            return None
+        data = (response or {}).get('data') or {}
+        return data.get('file') if isinstance(data, dict) else None
+
+    async def _fetch_local(self, data: Dict[str, Any]) -> Optional[bytes]:
+        if not self.local_enabled or time.monotonic() < self._paused_until:
+            return None
+        file = data.get('file')
+        for candidate in (data.get('path'), file):
+            path = self._map_path(candidate) if isinstance(candidate, str) else None
+            if path:
+                image_data = await self._read(path)
+                if image_data is not None:
+                    self._failures = 0
+                    IMAGE_SOURCE.inc(source='local')
+                    IMAGE_SOURCE_BYTES.inc(len(image_data), source='local')
+                    return image_data
+        if self.use_get_image and isinstance(file, str) and file:
+            path = self._map_path(await self._get_image_path(file) or '')
+            if path:
+                image_data = await self._read(path)
+                if image_data is not None:
+                    self._failures = 0
+                    IMAGE_SOURCE.inc(source='get_image')
+                    IMAGE_SOURCE_BYTES.inc(len(image_data), source='get_image')
+                    return image_data
+        self._failures += 1
+        if self.max_failures and self._failures >= self.max_failures:
+            logger.warning(f"连续 {self._failures} 张图片无法从本地缓存读取，{self.retry_after:g} 秒内直接下载")
+            self._paused_until = time.monotonic() + self.retry_after
+            self._failures = 0
+        return None
+
+    @timed('fetch_image')
+    async def fetch(self, segment: Dict[str, Any]) -> Optional[bytes]:
+        """获取图片消息段的图片数据，全部方式失败时返回 None，像素超过上限时抛出 ImageTooLarge"""
+        data = segment.get('data', {})
+        image_data = await self._fetch_local(data)
+        if image_data is not None:
+            logger.debug(f"从本地缓存读取图片: {len(image_data)} 字节")
+            return image_data
+        url = data.get('url')
+        if not url:
+            logger.warning("图片消息中没有URL，且无法从本地缓存读取")
+            IMAGE_SOURCE.inc(source='failed')
+            return None
+        image_data = await self.download(url)
+        if image_data is None:
+            IMAGE_SOURCE.inc(source='failed')
+            return None
+        IMAGE_SOURCE.inc(source='http')
+        IMAGE_SOURCE_BYTES.inc(len(image_data), source='http')
+        return image_data
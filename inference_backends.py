@@ -0,0 +1,291 @@
+"""推理后端：机器人只依赖 detect_single_prob / detect_list_prob 两个方法
+
+- torch：SensitiveImgDetect 原始模型（默认）；
+- onnx：由本模块导出并做 int8 量化的同一模型，使用 ONNX Runtime 推理，可设置算子内线程数。
+
+导出和量化：
+    python inference_backends.py export --output models/v2.onnx                   # 导出 FP32 模型
+    python inference_backends.py export --output models/v2.int8.onnx --quantize    # 导出并做动态 int8 量化
+    python inference_backends.py export --output models/v2.int8.onnx --quantize --calibration DIR  # 用校准图片做静态量化
+
+导出后用 benchmarks/bench_backends.py 比较两个后端的标签概率、单图延迟和内存占用。
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+BACKEND_TYPES = ('torch', 'onnx')
+
+# 未能从原始模型中读到预处理参数时使用的 ImageNet 归一化参数
+DEFAULT_MEAN = [0.485, 0.456, 0.406]
+DEFAULT_STD = [0.229, 0.224, 0.225]
+
+
+def load_backend(version: str, model_path: Optional[str] = None, backend_config: Optional[Dict[str, Any]] = None):
+    """按 inference_backend 配置创建推理后端"""
+    backend_config = backend_config or {}
+    backend_type = backend_config.get('type', 'torch')
+    if backend_type == 'onnx':
+        return OnnxBackend(
+            backend_config.get('onnx_path'),
+            intra_op_threads=backend_config.get('intra_op_threads', 0),
+            inter_op_threads=backend_config.get('inter_op_threads', 1),
+            labels=backend_config.get('labels'),
+        )
+    if backend_type != 'torch':
+        raise ValueError(f"未知的推理后端: {backend_type}，可选 {BACKEND_TYPES}")
+    return load_sensitive_img_detect(version, model_path)
+
+
+def load_sensitive_img_detect(version: str, model_path: Optional[str] = None):
+    """加载 SensitiveImgDetect 原始模型"""
+    # 模型库依赖较重，用到时才导入
+    from SensitiveImgDetect import Detect
+    if model_path:
+        return Detect(device='cpu', version=version, model_path=model_path)
+    return Detect(device='cpu', version=version)
+
+
+def _softmax(logits: np.ndarray) -> np.ndarray:
+    shifted = logits - logits.max(axis=1, keepdims=True)
+    exp = np.exp(shifted)
+    return exp / exp.sum(axis=1, keepdims=True)
+
+
+def image_to_array(image: Image.Image, input_size: int, mean: List[float], std: List[float],
+                   resize: str = 'stretch') -> np.ndarray:
+    """把 RGB 图片转换为模型输入（CHW，float32，已归一化）
+
+    resize 为 stretch 时直接拉伸到 input_size×input_size；center_crop 时短边缩放到 input_size 再居中裁剪。
+    """
+    if resize == 'center_crop':
+        width, height = image.size
+        scale = input_size / min(width, height)
+        if scale != 1:
+            image = image.resize((max(input_size, round(width * scale)), max(input_size, round(height * scale))),
+                                 Image.BILINEAR)
+        width, height = image.size
+        left, top = (width - input_size) // 2, (height - input_size) // 2
+        image = image.crop((left, top, left + input_size, top + input_size))
+    elif image.size != (input_size, input_size):
+        image = image.resize((input_size, input_size), Image.BILINEAR)
+    array = np.asarray(image, dtype=np.float32) / 255.0
+    array = (array - np.asarray(mean, dtype=np.float32)) / np.asarray(std, dtype=np.float32)
+    return array.transpose(2, 0, 1)
+
+
+class OnnxBackend:
+    """ONNX Runtime 推理后端，接口与 SensitiveImgDetect.Detect 一致
+
+    标签顺序和预处理参数（输入尺寸、归一化、缩放方式）在导出时写入模型元数据。
+    """
+
+    def __init__(self, onnx_path: str, intra_op_threads: int = 0, inter_op_threads: int = 1,
+                 labels: Optional[List[str]] = None):
+        if not onnx_path or not os.path.exists(onnx_path):
+            raise FileNotFoundError(f"ONNX 模型文件不存在: {onnx_path}")
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        # 0 表示由 ONNX Runtime 按 CPU 核数决定；多进程推理时建议设为 核数/进程数
+        options.intra_op_num_threads = int(intra_op_threads or 0)
+        options.inter_op_num_threads = int(inter_op_threads or 0)
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(onnx_path, sess_options=options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        self.labels = labels or json.loads(metadata.get('labels', 'null') or 'null')
+        if not self.labels:
+            raise ValueError("ONNX 模型缺少标签元数据，请在 inference_backend.labels 中按模型输出顺序填写")
+        self.input_size = int(metadata.get('input_size', 224))
+        self.mean = json.loads(metadata.get('mean', 'null') or 'null') or DEFAULT_MEAN
+        self.std = json.loads(metadata.get('std', 'null') or 'null') or DEFAULT_STD
+        self.resize = metadata.get('resize', 'stretch')
+        self.apply_softmax = metadata.get('output', 'probabilities') == 'logits'
+        logger.info(f"ONNX 推理后端已加载: {onnx_path}, 算子内线程={options.intra_op_num_threads or '自动'}, "
+                    f"输入尺寸={self.input_size}, 标签={self.labels}")
+
+    def detect_list_prob(self, images: List[Image.Image]) -> List[Dict[str, float]]:
+        if not images:
+            return []
+        batch = np.stack([image_to_array(image, self.input_size, self.mean, self.std, self.resize) for image in images])
+        outputs = self.session.run(None, {self.input_name: batch})[0]
+        if self.apply_softmax:
+            outputs = _softmax(outputs)
+        return [{label: float(prob) for label, prob in zip(self.labels, row)} for row in outputs]
+
+    def detect_single_prob(self, image: Image.Image) -> Dict[str, float]:
+        return self.detect_list_prob([image])[0]
+
+
+def _find_module(detector):
+    """在 Detect 实例上找到 torch 模型"""
+    import torch
+    for name, value in vars(detector).items():
+        if isinstance(value, torch.nn.Module):
+            return name, value
+    raise RuntimeError("未在 SensitiveImgDetect.Detect 实例上找到 torch 模型，请用 --module-attr 指定属性名")
+
+
+def _find_preprocess(detector) -> Dict[str, Any]:
+    """从 Detect 实例的 torchvision transforms 中读取输入尺寸、归一化参数和缩放方式"""
+    found: Dict[str, Any] = {}
+    for value in vars(detector).values():
+        for transform in getattr(value, 'transforms', None) or []:
+            name = type(transform).__name__
+            if name == 'Normalize':
+                found['mean'] = [float(x) for x in transform.mean]
+                found['std'] = [float(x) for x in transform.std]
+            elif name == 'Resize':
+                size = transform.size
+                if isinstance(size, int) or len(size) == 1:
+                    found.setdefault('resize', 'center_crop')
+                    found.setdefault('input_size', int(size if isinstance(size, int) else size[0]))
+                else:
+                    found['resize'] = 'stretch'
+                    found['input_size'] = int(size[0])
+            elif name == 'CenterCrop':
+                size = transform.size
+                found['resize'] = 'center_crop'
+                found['input_size'] = int(size if isinstance(size, int) else size[0])
+    return found
+
+
+def _write_metadata(path: str, metadata: Dict[str, str]):
+    import onnx
+    model = onnx.load(path)
+    existing = {prop.key: prop for prop in model.metadata_props}
+    for key, value in metadata.items():
+        prop = existing.get(key) or model.metadata_props.add()
+        prop.key, prop.value = key, value
+    onnx.save(model, path)
+
+
+class _CalibrationReader:
+    """静态量化校准数据：逐张读取目录中的图片，按导出时的预处理参数转换"""
+
+    def __init__(self, directory: str, input_name: str, metadata: Dict[str, Any], limit: int):
+        from image_detector import preprocess_image
+        self.input_name = input_name
+        paths = sorted(
+            os.path.join(root, name) for root, _, names in os.walk(directory) for name in names
+            if name.lower().endswith(('.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp'))
+        )[:limit]
+        self._items = []
+        for path in paths:
+            with open(path, 'rb') as f:
+                frames = preprocess_image(f.read(), metadata['input_size'])
+            if frames:
+                array = image_to_array(frames[0], metadata['input_size'], metadata['mean'], metadata['std'], metadata['resize'])
+                self._items.append({input_name: array[np.newaxis]})
+        self._iter = iter(self._items)
+
+    def get_next(self):
+        return next(self._iter, None)
+
+
+def export(args):
+    """导出 SensitiveImgDetect 模型为 ONNX，可选 int8 量化"""
+    import torch
+    detector = load_sensitive_img_detect(args.version, args.model_path)
+    if args.module_attr:
+        module = getattr(detector, args.module_attr)
+    else:
+        attr, module = _find_module(detector)
+        print(f"使用 Detect.{attr} 作为导出模型")
+    module.eval()
+
+    found = _find_preprocess(detector)
+    metadata = {
+        'input_size': args.input_size or found.get('input_size', 224),
+        'mean': found.get('mean', DEFAULT_MEAN),
+        'std': found.get('std', DEFAULT_STD),
+        'resize': args.resize or found.get('resize', 'stretch'),
+    }
+    labels = list(getattr(detector, 'labels', None) or args.labels or [])
+    if not labels:
+        raise RuntimeError("无法从模型读取标签，请用 --labels 按输出顺序指定")
+    print(f"预处理参数: {metadata}，标签: {labels}")
+
+    class _WithSoftmax(torch.nn.Module):
+        # 输出与 detect_single_prob 相同的概率，后端不必再做 softmax
+        def __init__(self, inner):
+            super().__init__()
+            self.inner = inner
+
+        def forward(self, x):
+            return torch.softmax(self.inner(x), dim=1)
+
+    size = metadata['input_size']
+    output = os.path.abspath(args.output)
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    fp32_path = output if not args.quantize else output + '.fp32.onnx'
+    torch.onnx.export(
+        _WithSoftmax(module) if not args.logits else module,
+        torch.zeros(1, 3, size, size),
+        fp32_path,
+        input_names=['input'],
+        output_names=['output'],
+        dynamic_axes={'input': {0: 'batch'}, 'output': {0: 'batch'}},
+        opset_version=args.opset,
+    )
+
+    if args.quantize:
+        from onnxruntime.quantization import QuantFormat, QuantType, quantize_dynamic, quantize_static
+        if args.calibration:
+            reader = _CalibrationReader(args.calibration, 'input', metadata, args.calibration_limit)
+            print(f"使用 {len(reader._items)} 张校准图片做静态 int8 量化")
+            quantize_static(fp32_path, output, reader, quant_format=QuantFormat.QDQ, per_channel=True,
+                            activation_type=QuantType.QInt8, weight_type=QuantType.QInt8)
+        else:
+            print("未提供校准图片，做动态 int8 量化（仅权重量化）")
+            quantize_dynamic(fp32_path, output, weight_type=QuantType.QInt8)
+        if not args.keep_fp32:
+            os.remove(fp32_path)
+
+    _write_metadata(output, {
+        'labels': json.dumps(labels, ensure_ascii=False),
+        'input_size': str(size),
+        'mean': json.dumps(metadata['mean']),
+        'std': json.dumps(metadata['std']),
+        'resize': metadata['resize'],
+        'output': 'logits' if args.logits else 'probabilities',
+        'source_version': args.version,
+        'quantized': 'int8' if args.quantize else 'none',
+    })
+    print(f"已导出: {output}（{os.path.getsize(output) / 1024 / 1024:.1f}MB）")
+
+
+def _main():
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    parser = argparse.ArgumentParser(description='导出并量化 ONNX 推理模型')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    export_parser = subparsers.add_parser('export', help='把 SensitiveImgDetect 模型导出为 ONNX')
+    export_parser.add_argument('--output', required=True, help='输出的 .onnx 文件路径')
+    export_parser.add_argument('--version', default='v2', help='模型版本，与 model_config.version 一致')
+    export_parser.add_argument('--model-path', help='自定义模型路径，与 model_path 一致')
+    export_parser.add_argument('--module-attr', help='Detect 实例上 torch 模型的属性名，默认自动查找')
+    export_parser.add_argument('--labels', nargs='+', help='模型输出顺序的标签，默认读取 Detect.labels')
+    export_parser.add_argument('--input-size', type=int, help='输入尺寸，默认从模型的预处理中读取')
+    export_parser.add_argument('--resize', choices=('stretch', 'center_crop'), help='缩放方式，默认从模型的预处理中读取')
+    export_parser.add_argument('--logits', action='store_true', help='导出原始 logits，由后端做 softmax')
+    export_parser.add_argument('--opset', type=int, default=17)
+    export_parser.add_argument('--quantize', action='store_true', help='做 int8 量化')
+    export_parser.add_argument('--calibration', help='静态量化的校准图片目录，不提供时做动态量化')
+    export_parser.add_argument('--calibration-limit', type=int, default=200, help='最多使用的校准图片数')
+    export_parser.add_argument('--keep-fp32', action='store_true', help='量化后保留 FP32 模型')
+    args = parser.parse_args()
+    if args.command == 'export':
+        export(args)
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,203 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 子进程内的模型实例和预处理参数，每个工作进程只加载一次
+_worker_detector = None
+_worker_preprocess_options: Dict = {}
+_worker_barrier = None
+
+
+def _init_worker(version: str, model_path: Optional[str], preprocess_options: Dict, backend_config: Dict,
+                 barrier=None):
+    """工作进程初始化：按 inference_backend 配置加载推理后端"""
+    global _worker_detector, _worker_preprocess_options, _worker_barrier
+    from inference_backends import load_backend
+    _worker_preprocess_options = preprocess_options
+    _worker_barrier = barrier
+    _worker_detector = load_backend(version, model_path, backend_config)
+
+
+def _worker_detect_batch(images_data: List[bytes],
+                         violation_rule: Optional[Tuple[float, List[str]]] = None) -> List[Optional[Dict]]:
+    """工作进程内预处理并检测一批图片，预处理失败的图片返回 None
+
+    violation_rule 随每一批传入，热重载修改阈值和关键词后不需要重建进程池。
+    """
+    # 与进程内路径使用同一套预处理和批量检测逻辑，保证结果一致
+    from image_detector import detect_images, frame_is_violation
+    is_violation = None
+    if violation_rule is not None:
+        def is_violation(results_dict: Dict) -> bool:
+            return frame_is_violation(results_dict, *violation_rule)
+    return detect_images(_worker_detector, images_data, _worker_preprocess_options, is_violation)
+
+
+def _worker_warm_up(image_data: bytes, violation_rule: Optional[Tuple[float, List[str]]],
+                    timeout: float) -> Tuple[int, Optional[Dict]]:
+    """预热任务：检测一次后在屏障处等待，所有工作进程各持有一个预热任务时才一起返回
+
+    一个进程在屏障处等待时不会再领取任务，因此每个工作进程恰好执行一次预热。
+    """
+    result = _worker_detect_batch([image_data], violation_rule)[0]
+    _worker_barrier.wait(timeout)
+    return os.getpid(), result
+
+
+class ProcessPoolBackend:
+    """多进程推理后端：每个工作进程各自加载一份模型，图片以字节形式传入
+
+    工作进程崩溃时重建进程池，并把这一批图片逐张重试，反复导致崩溃的图片跳过检测，
+    不会拖垮同批的其他图片。连续崩溃（中间没有任何一批成功）达到 max_restarts 次时
+    停止重建，restart_cooldown 秒后再重新尝试。
+    """
+
+    def __init__(self, version: str, model_path: Optional[str] = None, preprocess_options: Optional[Dict] = None,
+                 workers: Optional[int] = None, max_tasks_per_child: Optional[int] = None, max_restarts: int = 5,
+                 backend_config: Optional[Dict] = None, restart_cooldown: float = 60,
+                 violation_rule: Optional[Callable[[], Tuple[float, List[str]]]] = None):
+        self.version = version
+        self.model_path = model_path
+        self.preprocess_options = preprocess_options or {}
+        # 返回当前 (置信度阈值, 违规关键词)，每批提交时读取，动图某一帧已判定违规时不再解码后面的帧
+        self.violation_rule = violation_rule
+        self.backend_config = backend_config or {}
+        self.workers = int(workers or os.cpu_count() or 1)
+        self.max_tasks_per_child = int(max_tasks_per_child) if max_tasks_per_child else None
+        self.max_restarts = int(max_restarts)
+        self.restart_cooldown = float(restart_cooldown)
+        # 连续崩溃次数，任意一批成功后清零
+        self.restarts = 0
+        self.skipped_images = 0
+        self._broken_since: Optional[float] = None
+        self._jobs = 0
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._barrier = None
+        self._start_pool()
+
+    def _start_pool(self):
+        # 模型库内部有线程池，fork 出的子进程可能死锁，统一使用 spawn
+        context = multiprocessing.get_context('spawn')
+        # 预热屏障，让每个工作进程都执行一次预热
+        self._barrier = context.Barrier(self.workers)
+        kwargs = {
+            'max_workers': self.workers,
+            'mp_context': context,
+            'initializer': _init_worker,
+            'initargs': (self.version, self.model_path, self.preprocess_options, self.backend_config,
+                         self._barrier),
+        }
+        if self.max_tasks_per_child and sys.version_info >= (3, 11):
+            kwargs['max_tasks_per_child'] = self.max_tasks_per_child
+        self._pool = ProcessPoolExecutor(**kwargs)
+        self._jobs = 0
+        logger.info(f"多进程推理后端已启动: 进程数={self.workers}, 单进程最大任务数={self.max_tasks_per_child}")
+
+    def _recycle_if_needed(self):
+        """旧版本 Python 不支持 max_tasks_per_child 时，按任务总数整体轮换进程池"""
+        if not self.max_tasks_per_child or sys.version_info >= (3, 11):
+            return
+        if self._jobs >= self.max_tasks_per_child * self.workers:
+            logger.info("推理进程池达到任务上限，轮换工作进程")
+            old_pool = self._pool
+            self._start_pool()
+            old_pool.shutdown(wait=False)
+
+    def _rebuild(self, pool: ProcessPoolExecutor):
+        """工作进程崩溃后重建进程池；连续崩溃达到上限时不再重建，记录停用时间"""
+        # 并发的多个批次可能同时发现崩溃，只重建一次
+        if pool is not self._pool or self._broken_since is not None:
+            return
+        pool.shutdown(wait=False)
+        if self.restarts >= self.max_restarts:
+            self._broken_since = time.monotonic()
+            logger.error(f"推理进程池连续崩溃 {self.restarts} 次，暂停推理，{self.restart_cooldown:g} 秒后再尝试")
+            return
+        self.restarts += 1
+        logger.error(f"推理工作进程崩溃，正在重建进程池（连续第 {self.restarts} 次）")
+        self._start_pool()
+
+    async def _submit(self, images_data: List[bytes]) -> List[Optional[Dict]]:
+        """提交一批图片，崩溃时重建进程池后抛出 BrokenProcessPool"""
+        if self._broken_since is not None:
+            if time.monotonic() - self._broken_since < self.restart_cooldown:
+                raise BrokenProcessPool("推理进程池多次崩溃，暂停推理中")
+            logger.info("推理进程池暂停期已过，重新启动")
+            self._broken_since = None
+            self.restarts = 0
+            self._start_pool()
+        self._recycle_if_needed()
+        loop = asyncio.get_event_loop()
+        pool = self._pool
+        self._jobs += 1
+        try:
+            results = await loop.run_in_executor(pool, _worker_detect_batch, images_data, self._current_rule())
+        except BrokenProcessPool:
+            self._rebuild(pool)
+            raise
+        self.restarts = 0
+        return results
+
+    def _current_rule(self) -> Optional[Tuple[float, List[str]]]:
+        return self.violation_rule() if self.violation_rule is not None else None
+
+    async def run_batch(self, images_data: List[bytes]) -> List[Optional[Dict]]:
+        """在进程池中检测一批图片，工作进程崩溃时逐张重试，找出并跳过导致崩溃的图片"""
+        try:
+            return await self._submit(images_data)
+        except BrokenProcessPool:
+            if self._broken_since is not None:
+                raise
+        if len(images_data) == 1:
+            return [await self._run_single(images_data[0], attempts=1)]
+        logger.warning(f"推理批次导致工作进程崩溃，逐张重试 {len(images_data)} 张图片")
+        results = []
+        for image_data in images_data:
+            results.append(await self._run_single(image_data))
+        return results
+
+    async def _run_single(self, image_data: bytes, attempts: int = 2) -> Optional[Dict]:
+        """单独检测一张图片；单独运行时两次导致崩溃则跳过（第一次可能是同时运行的其他批次造成的）"""
+        for _ in range(attempts):
+            try:
+                return (await self._submit([image_data]))[0]
+            except BrokenProcessPool:
+                if self._broken_since is not None:
+                    raise
+        self.skipped_images += 1
+        logger.error(f"图片（{len(image_data)} 字节）反复导致推理进程崩溃，跳过检测（累计 {self.skipped_images} 张）")
+        return None
+
+    async def verify(self, image_data: bytes, timeout: float = 120) -> bool:
+        """预热：让每个工作进程都加载模型并检测一次，任一进程初始化或检测失败时返回 False
+
+        预热任务在屏障处互相等待，每个工作进程恰好执行一个，并以返回的进程号确认。
+        """
+        loop = asyncio.get_event_loop()
+        try:
+            results = await asyncio.gather(*[
+                loop.run_in_executor(self._pool, _worker_warm_up, image_data, self._current_rule(), timeout)
+                for _ in range(self.workers)
+            ])
+        except Exception as e:
+            logger.error(f"推理进程预热失败: {e!r}")
+            return False
+        pids = {pid for pid, _ in results}
+        if len(pids) < self.workers:
+            logger.error(f"推理进程预热只覆盖了 {len(pids)}/{self.workers} 个工作进程")
+            return False
+        return all(result is not None for _, result in results)
+
+    def close(self):
+        """关闭进程池"""
+        if self._pool is not None:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+            self._pool = None
@@ -0,0 +1,121 @@
+import asyncio
+import logging
+from collections import Counter
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class BatchInferenceScheduler:
+    """微批推理调度器：把各群同时待检测的图片合并成一个批次送入模型"""
+
+    def __init__(self, run_batch: Callable[[List[Any]], Any], max_batch_size: int = 8,
+                 max_wait_ms: float = 10, executor=None, report_every: int = 100):
+        self.run_batch = run_batch
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000
+        self.executor = executor
+        self.report_every = report_every
+        self.batch_sizes: Counter = Counter()
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+
+    def _ensure_started(self):
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.ensure_future(self._run())
+
+    async def submit(self, item: Any) -> Any:
+        """提交一张待检测图片，返回该图片的检测结果"""
+        future = self.submit_nowait(item)
+        return await future
+
+    def submit_nowait(self, item: Any) -> asyncio.Future:
+        """提交一张待检测图片，立即返回对应的 Future"""
+        self._ensure_started()
+        future = asyncio.get_event_loop().create_future()
+        self._queue.put_nowait((item, future))
+        return future
+
+    @property
+    def pending(self) -> int:
+        """等待组批的图片数量"""
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def _collect(self) -> List[tuple]:
+        """等待第一张图片，然后在截止时间内尽量凑满一个批次"""
+        loop = asyncio.get_event_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            # 已排队的图片直接取走，不必等待
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout=remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = await self._collect()
+            # 调用方已取消的图片不再送入模型
+            batch = [(item, future) for item, future in batch if not future.done()]
+            if not batch:
+                continue
+            items = [item for item, _ in batch]
+            try:
+                if asyncio.iscoroutinefunction(self.run_batch):
+                    outputs = await self.run_batch(items)
+                else:
+                    outputs = await loop.run_in_executor(self.executor, self.run_batch, items)
+                if len(outputs) != len(items):
+                    raise RuntimeError(f"批量推理返回数量不匹配: {len(outputs)} != {len(items)}")
+            except Exception as e:
+                logger.error(f"批量推理失败: {e}", exc_info=True)
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), output in zip(batch, outputs):
+                if not future.done():
+                    future.set_result(output)
+            self._record(len(batch))
+
+    def _record(self, size: int):
+        self.batch_sizes[size] += 1
+        total = sum(self.batch_sizes.values())
+        if self.report_every and total % self.report_every == 0:
+            logger.info(f"批量推理统计: {self.stats()}")
+
+    def stats(self) -> Dict[str, Any]:
+        """批次大小统计"""
+        batches = sum(self.batch_sizes.values())
+        images = sum(size * count for size, count in self.batch_sizes.items())
+        return {
+            'batches': batches,
+            'images': images,
+            'avg_batch_size': round(images / batches, 2) if batches else 0.0,
+            'batch_sizes': dict(sorted(self.batch_sizes.items())),
+        }
+
+    async def close(self):
+        """停止调度器，未完成的图片以取消结束"""
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        if self._queue is not None:
+            while not self._queue.empty():
+                _, future = self._queue.get_nowait()
+                if not future.done():
+                    future.cancel()
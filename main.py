@@ -4,11 +4,27 @@ import json
 import logging
 import aiohttp
 import base64
+import contextlib
+import contextvars
+import copy
 import os
+import tempfile
+import time
 import datetime
 from pathlib import Path
-from typing import Dict, List, Any, Optional
-from image_detector import ImageDetector
+from typing import Callable, Dict, List, Any, Optional
+from image_detector import DEFAULT_LABEL_MAP, DEFAULT_VIOLATION_KEYWORDS, ImageDetector, evaluate_results
+from verdict_cache import VerdictCache
+from phash_index import PHashIndex, compute_dhash
+from prefilter import Prefilter
+from violation_archive import ViolationArchive
+from event_dispatcher import EventDispatcher
+from http_client import HttpClient
+from detection_scheduler import DeadlineScheduler
+from image_sniff import MAX_PIXELS, SNIFF_BYTES, UNMODERATED_IMAGES, ImageTooLarge, check_pixels, sniff_format, probe_size
+from napcat_connection import NapCatConnection, account_configs
+from reconnect import RECONNECTS, SeenMessages, message_key
+from metrics import REGISTRY, MetricsServer, SlowEventTracer, timed
 
 # 配置日志
 logging.basicConfig(
@@ -21,150 +37,564 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# 正在处理的事件来自哪个账号，撤回、警告和图片获取都经由该账号的连接
+_current_connection: contextvars.ContextVar[Optional[NapCatConnection]] = contextvars.ContextVar('napcat_connection', default=None)
+
 class ConfigManager:
+    # 默认配置，配置文件缺少的顶层项用它补齐
+    DEFAULT_CONFIG = {
+        "napcat_ws_url": "ws://localhost:3001",
+        "napcat_http_url": "http://localhost:3000",
+        "admin_qq_list": [],
+        "whitelist_groups": [],
+        "bot_qq": "",
+        "model_config": {
+            "version": "v2",
+            "labels": ["cartoon", "porn", "politic", "other"],
+            "confidence_threshold": 0.65
+        },
+        # 自动撤回白名单
+        "auto_recall_groups": [],
+        # 违规图片保存路径
+        "violation_save_path": "violations"
+    }
+
     def __init__(self, config_file: str = 'config.json'):
         self.config_file = config_file
+        # 管理员、白名单、自动撤回群的集合索引，每条消息都要查询，避免线性查找列表
+        self._admins = set()
+        self._whitelist_groups = set()
+        self._auto_recall_groups = set()
+        # 配置重新加载后的回调，参数为 (旧配置, 新配置)
+        self.listeners: List[Callable[[Dict[str, Any], Dict[str, Any]], None]] = []
+        self._save_task: Optional[asyncio.Task] = None
+        self._save_requested = False
+        self._last_saved_text: Optional[str] = None
+        self._last_signature = None
+        # 保存时沿用配置文件原有的换行符
+        self._newline = '\n'
+        self.save_delay = 0.5
         self.config = self.load_config()
-        # 自动撤回白名单
-        if "auto_recall_groups" not in self.config:
-            self.config["auto_recall_groups"] = []
-            self.save_config()
-        # 违规图片保存路径
-        if "violation_save_path" not in self.config:
-            self.config["violation_save_path"] = "violations"
-            self.save_config()
+        reload_config = self.config.get("config_reload", {})
+        self.watch_enabled = bool(reload_config.get("enabled", True))
+        self.watch_interval = float(reload_config.get("interval", 2))
+        self.save_delay = float(reload_config.get("save_delay", self.save_delay))
+
+    def _apply_defaults(self, config: Dict[str, Any]) -> bool:
+        """补齐缺少的配置项，返回是否有改动"""
+        changed = False
+        for key, value in self.DEFAULT_CONFIG.items():
+            if key not in config:
+                config[key] = copy.deepcopy(value)
+                changed = True
+        return changed
+
+    def rebuild_indexes(self):
+        """根据配置中的列表重建集合索引"""
+        self._admins = {str(qq) for qq in self.config.get('admin_qq_list', [])}
+        self._whitelist_groups = {str(group) for group in self.config.get('whitelist_groups', [])}
+        self._auto_recall_groups = {str(group) for group in self.config.get('auto_recall_groups', [])}
+
+    def _file_signature(self):
+        """配置文件的修改时间和大小，用于发现外部修改"""
+        try:
+            stat = os.stat(self.config_file)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
 
     def load_config(self) -> Dict[str, Any]:
         """加载配置文件"""
-        default_config = {
-            "napcat_ws_url": "ws://localhost:3001",
-            "napcat_http_url": "http://localhost:3000",
-            "admin_qq_list": [],
-            "whitelist_groups": [],
-            "bot_qq": "",
-            "model_config": {
-                "version": "v2",
-                "labels": ["cartoon", "porn", "politic", "other"],
-                "confidence_threshold": 0.65
-            }
-        }
-        
         if os.path.exists(self.config_file):
             try:
                 with open(self.config_file, 'r', encoding='utf-8') as f:
-                    config = json.load(f)
-                    # 合并默认配置
-                    for key, value in default_config.items():
-                        if key not in config:
-                            config[key] = value
-                    return config
+                    text = f.read()
+                    if isinstance(f.newlines, str):
+                        self._newline = f.newlines
+                config = json.loads(text)
+                self._last_saved_text = text
+                self._last_signature = self._file_signature()
             except Exception as e:
                 logger.error(f"加载配置文件失败: {e}")
-                return default_config
-        else:
-            self.save_config(default_config)
-            return default_config
-    
-    def save_config(self, config: Optional[Dict[str, Any]] = None) -> None:
-        """保存配置文件"""
-        if config is None:
-            config = self.config
-        
-        try:
-            with open(self.config_file, 'w', encoding='utf-8') as f:
-                json.dump(config, f, indent=2, ensure_ascii=False)
+                config = copy.deepcopy(self.DEFAULT_CONFIG)
+                self.config = config
+                self.rebuild_indexes()
+                return config
+            # 合并默认配置
+            changed = self._apply_defaults(config)
             self.config = config
+            self.rebuild_indexes()
+            # 启动阶段直接写入，保证补齐后的配置文件立即可见
+            if changed:
+                self._save_now()
+            return config
+        config = copy.deepcopy(self.DEFAULT_CONFIG)
+        self.config = config
+        self.rebuild_indexes()
+        self._save_now()
+        return config
+
+    def _serialize(self, config: Dict[str, Any]) -> str:
+        return json.dumps(config, indent=2, ensure_ascii=False)
+
+    def _write_file(self, text: str):
+        """原子写入：先写临时文件并落盘，再替换配置文件，中途崩溃不会留下半个文件"""
+        directory = os.path.dirname(os.path.abspath(self.config_file))
+        fd, tmp_path = tempfile.mkstemp(prefix='.config-', suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8', newline=self._newline) as f:
+                f.write(text)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.config_file)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.unlink(tmp_path)
+            raise
+        self._last_saved_text = text
+        self._last_signature = self._file_signature()
+
+    def _save_now(self):
+        """同步写入配置文件"""
+        try:
+            self._write_file(self._serialize(self.config))
             logger.info("配置文件已保存")
         except Exception as e:
             logger.error(f"保存配置文件失败: {e}")
-    
+
+    def save_config(self, config: Optional[Dict[str, Any]] = None) -> None:
+        """保存配置文件
+
+        在事件循环中调用时只登记保存请求，由后台任务合并短时间内的多次修改后在线程池中写入；
+        没有运行中的事件循环（如启动阶段）时直接写入。
+        """
+        if config is not None:
+            self.config = config
+            self.rebuild_indexes()
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+
+        if loop is None:
+            self._save_now()
+            return
+
+        self._save_requested = True
+        if self._save_task is None or self._save_task.done():
+            self._save_task = loop.create_task(self._save_soon())
+
+    async def _save_soon(self):
+        """等待一小段时间合并多次修改，然后在线程池中写入"""
+        await asyncio.sleep(self.save_delay)
+        await self._write_pending()
+
+    async def _write_pending(self):
+        loop = asyncio.get_running_loop()
+        while self._save_requested:
+            self._save_requested = False
+            # 序列化在事件循环中完成，写入线程拿到的是当时配置的快照
+            text = self._serialize(self.config)
+            try:
+                await loop.run_in_executor(None, self._write_file, text)
+                logger.info("配置文件已保存")
+            except Exception as e:
+                logger.error(f"保存配置文件失败: {e}")
+
+    async def flush(self):
+        """立即写入尚未保存的修改，退出前调用"""
+        task = self._save_task
+        if task is not None and not task.done():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        await self._write_pending()
+
+    async def reload_if_changed(self) -> bool:
+        """配置文件被外部修改时重新加载，返回是否应用了新配置"""
+        signature = self._file_signature()
+        if signature is None or signature == self._last_signature:
+            return False
+        # 自身的保存还没完成时先不读取，避免用磁盘上的旧内容覆盖内存中的修改
+        if self._save_requested or (self._save_task is not None and not self._save_task.done()):
+            return False
+
+        loop = asyncio.get_running_loop()
+        try:
+            text = await loop.run_in_executor(None, Path(self.config_file).read_text, 'utf-8')
+        except OSError as e:
+            logger.error(f"读取配置文件失败: {e}")
+            return False
+        self._last_signature = signature
+        if text == self._last_saved_text:
+            return False
+        try:
+            config = json.loads(text)
+        except ValueError as e:
+            logger.error(f"配置文件格式错误，继续使用当前配置: {e}")
+            return False
+        if not isinstance(config, dict):
+            logger.error("配置文件格式错误，继续使用当前配置")
+            return False
+
+        self._apply_defaults(config)
+        old_config = self.config
+        self.config = config
+        self._last_saved_text = text
+        self.rebuild_indexes()
+        logger.info("配置文件已重新加载")
+        for listener in self.listeners:
+            try:
+                listener(old_config, config)
+            except Exception as e:
+                logger.error(f"应用新配置失败: {e}", exc_info=True)
+        return True
+
+    async def watch(self):
+        """定期检查配置文件，外部修改后无需重启即可生效"""
+        logger.info(f"配置文件热加载已启用，检查间隔 {self.watch_interval} 秒")
+        while True:
+            await asyncio.sleep(self.watch_interval)
+            try:
+                await self.reload_if_changed()
+            except Exception as e:
+                logger.error(f"检查配置文件异常: {e}")
+
     def add_whitelist_group(self, group_id: str) -> bool:
         """添加白名单群组"""
-        if group_id not in self.config['whitelist_groups']:
+        if group_id not in self._whitelist_groups:
             self.config['whitelist_groups'].append(group_id)
+            self._whitelist_groups.add(group_id)
             self.save_config()
             return True
         return False
     
     def remove_whitelist_group(self, group_id: str) -> bool:
         """移除白名单群组"""
-        if group_id in self.config['whitelist_groups']:
-            self.config['whitelist_groups'].remove(group_id)
+        if group_id in self._whitelist_groups:
+            self.config['whitelist_groups'] = [
+                group for group in self.config['whitelist_groups'] if str(group) != group_id
+            ]
+            self._whitelist_groups.discard(group_id)
             self.save_config()
             return True
         return False
     
     def is_admin(self, qq: str) -> bool:
         """检查是否为管理员"""
-        return qq in self.config['admin_qq_list']
+        return qq in self._admins
     
     def is_whitelist_group(self, group_id: str) -> bool:
         """检查是否为白名单群组"""
-        return group_id in self.config['whitelist_groups']
+        return group_id in self._whitelist_groups
 
     def add_auto_recall_group(self, group_id: str) -> bool:
         """添加自动撤回白名单群组"""
-        if group_id not in self.config['auto_recall_groups']:
+        if group_id not in self._auto_recall_groups:
             self.config['auto_recall_groups'].append(group_id)
+            self._auto_recall_groups.add(group_id)
             self.save_config()
             return True
         return False
 
     def is_auto_recall_group(self, group_id: str) -> bool:
         """检查是否为自动撤回白名单群组"""
-        return group_id in self.config['auto_recall_groups']
+        return group_id in self._auto_recall_groups
 
 class NapCatBot:
-    def __init__(self):
-        self.config_manager = ConfigManager()
-        self.image_detector = ImageDetector(self.config_manager.config)
-        self.websocket = None
-        self.running = False
-        self.label_map = {
-            "cartoon": "动漫",
-            "carton": "动漫",
-            "porn": "色情",
-            "politic": "涉政",
-            "other": "其他",
-            "explicit": "露骨",
-            "sexual": "性暗示",
-            "sex": "性相关",
-            "敏感": "敏感",
-            "色情": "色情"
-        }
-        self.violation_keywords = self.config_manager.config.get(
-            "violation_keywords",
-            ["porn", "politic", "explicit", "sexual", "sex", "敏感", "色情"]
-        )
+    def __init__(self, config_file: str = 'config.json', image_detector: Optional[ImageDetector] = None):
+        self.config_manager = ConfigManager(config_file)
+        # 可传入自定义检测器（如压测用的模拟检测器），否则按配置创建，模型在连接后于后台加载
+        self.image_detector = image_detector or ImageDetector(self.config_manager.config, lazy=True)
+        self.model_ready: Optional[asyncio.Event] = None
+        self.model_task: Optional[asyncio.Task] = None
+        self.model_swapping = False
+        self.model_swap_pending = False  # 切换期间模型配置又有修改，当前切换完成后再切换一次
+        # 当前检测器加载时使用的配置和模型代数，切换模型后旧模型的检测结果不写入缓存
+        self.detector_config = copy.deepcopy(self.config_manager.config)
+        self.model_generation = 0
+        self.verdict_cache = VerdictCache(self.config_manager.config)
+        # 图片下载限制：大小上限、单次超时、像素上限（默认为 Pillow 的解压炸弹上限）
+        download_config = self.config_manager.config.get("image_download", {})
+        self.download_max_bytes = int(download_config.get("max_bytes", 10 * 1024 * 1024))
+        self.download_max_pixels = int(download_config.get("max_pixels") or MAX_PIXELS)
+        self.download_timeout = aiohttp.ClientTimeout(total=float(download_config.get("timeout", 10)))
+        self.download_chunk_size = int(download_config.get("chunk_size", 64 * 1024))
+        # 所有NapCat接口和图片下载共用的HTTP连接池
+        self.http = HttpClient(self.config_manager.config)
+        # 每个机器人账号一个NapCat连接，模型、检测调度和结果缓存由所有账号共用
+        self.connections = [
+            NapCatConnection(
+                account, self.http, self.config_manager.config,
+                lambda connection, group_id, message: self.send_message('group', group_id, message, connection),
+                self.download_image,
+                lambda connection, event: self.handle_event(event, catch_up=True, connection=connection),
+                self.is_protected_event,
+            )
+            for account in account_configs(self.config_manager.config)
+        ]
+        self.label_map = dict(DEFAULT_LABEL_MAP)
+        self.violation_keywords = self.config_manager.config.get("violation_keywords", DEFAULT_VIOLATION_KEYWORDS)
         # 违规图片保存路径
         self.violation_save_path = self.config_manager.config.get("violation_save_path", "violations")
         os.makedirs(self.violation_save_path, exist_ok=True)
+        # 已知违规图片的感知哈希索引，用于识别重新压缩/裁剪后的重复违规图
+        self.phash_index = PHashIndex(self.config_manager.config)
+        # 违规图片归档：按内容哈希去重保存，带查询索引
+        self.violation_archive = ViolationArchive(self.config_manager.config)
+        # 并发事件分发，按群轮转，避免单个群的慢处理阻塞其他群
+        dispatch_config = self.config_manager.config.get("event_dispatch", {})
+        self.drain_timeout = float(dispatch_config.get("drain_timeout", 30))
+        self.dispatcher = EventDispatcher(
+            lambda item: self.handle_event(item[1], connection=item[0]),
+            workers=dispatch_config.get("workers", 64),
+            max_pending=dispatch_config.get("max_pending", 1000),
+            max_pending_per_group=dispatch_config.get("max_pending_per_group", 100),
+            is_protected=lambda item: self.is_protected_event(item[1]),
+        )
+        # 检测前的优先级调度：自动撤回群优先，超过撤回时限的降级或丢弃
+        self.detection_scheduler = DeadlineScheduler(self.config_manager.config)
+        if self.detection_scheduler.enabled and self.dispatcher.worker_count <= self.detection_scheduler.concurrency:
+            logger.warning(f"event_dispatch.workers ({self.dispatcher.worker_count}) 不大于检测并发 "
+                           f"({self.detection_scheduler.concurrency})，待检测的图片不会在优先级队列中排队")
+        # 运行指标和慢事件追踪
+        metrics_config = self.config_manager.config.get("metrics", {})
+        self.images_in_flight = 0
+        self.tracer = SlowEventTracer(metrics_config.get("slow_event_ms"), metrics_config.get("slow_event_log"))
+        self.metrics_server = None
+        if metrics_config.get("enabled", False):
+            self.metrics_server = MetricsServer(metrics_config.get("host", "127.0.0.1"), int(metrics_config.get("port", 9464)))
+        self._register_metrics()
+        # 已处理的群消息：多个账号在同一群中或重连补查时，同一条消息只处理一次
+        self.seen_messages = SeenMessages(self.config_manager.config.get("reconnect", {}).get("seen_messages", 50000))
+        # 配置文件热加载：白名单、关键词、阈值等修改无需重启即可生效
+        self.config_watch_task: Optional[asyncio.Task] = None
+        self.config_manager.listeners.append(self._on_config_reloaded)
+
+    def _on_config_reloaded(self, old_config: Dict[str, Any], new_config: Dict[str, Any]):
+        """配置文件重新加载后更新运行中的设置（不重新加载模型）"""
+        self.violation_keywords = new_config.get("violation_keywords", self.violation_keywords)
+        if hasattr(self.image_detector, 'violation_keywords'):
+            self.image_detector.violation_keywords = self.violation_keywords
+        model_config = new_config.get("model_config", {})
+        if "confidence_threshold" in model_config:
+            self.image_detector.confidence_threshold = float(model_config["confidence_threshold"])
+        if "labels" in model_config and hasattr(self.image_detector, 'labels'):
+            self.image_detector.labels = model_config["labels"]
+        if old_config.get("prefilter", {}) != new_config.get("prefilter", {}) and hasattr(self.image_detector, 'prefilter'):
+            # 预筛参数变化会清空缓存（见缓存指纹），同时换上新的预筛，两者保持一致
+            if self.image_detector.prefilter.enabled:
+                logger.info(f"旧预筛参数的统计: {self.image_detector.prefilter.stats()}")
+            self.image_detector.prefilter = Prefilter(new_config)
+            logger.info("预筛配置已修改，新参数立即生效")
+        if self.model_key(old_config) != self.model_key(new_config) and isinstance(self.image_detector, ImageDetector):
+            logger.info("模型版本、模型路径或推理后端已修改，开始在后台加载新模型")
+            asyncio.ensure_future(self.swap_model())
+        # 模型相关的指纹在切换成功后才更新，阈值、标签等其他配置立即生效
+        self.verdict_cache.update_fingerprint(self.fingerprint_config(new_config))
+        self._update_accounts(new_config)
+        logger.info(f"新配置已生效: 白名单群 {len(new_config.get('whitelist_groups', []))} 个，"
+                    f"自动撤回群 {len(new_config.get('auto_recall_groups', []))} 个，"
+                    f"阈值 {self.image_detector.confidence_threshold}")
+
+    @staticmethod
+    def model_key(config: Dict[str, Any]) -> tuple:
+        """决定需要重新加载模型的配置项：模型版本、模型路径、推理后端"""
+        return (config.get("model_config", {}).get("version"), config.get("model_path"),
+                config.get("inference_backend", {}))
+
+    def fingerprint_config(self, config: Dict[str, Any]) -> Dict[str, Any]:
+        """缓存指纹使用的配置：模型版本、路径和推理后端取正在使用的检测器的配置，其余取 config"""
+        merged = dict(config, model_path=self.detector_config.get("model_path"),
+                      inference_backend=self.detector_config.get("inference_backend", {}))
+        merged["model_config"] = dict(config.get("model_config", {}),
+                                      version=self.detector_config.get("model_config", {}).get("version"))
+        return merged
+
+    def _update_accounts(self, config: Dict[str, Any]):
+        """按账号名称更新连接地址，新地址在下次重连时生效；增删账号需要重启"""
+        try:
+            accounts = {account['name']: account for account in account_configs(config)}
+        except (KeyError, ValueError) as e:
+            logger.error(f"账号配置错误，继续使用当前账号配置: {e}")
+            return
+        for connection in self.connections:
+            account = accounts.pop(connection.name, None)
+            if account is None:
+                logger.warning(f"账号 {connection.name} 已从配置中移除，重启后生效")
+                continue
+            if (account['napcat_ws_url'], account['napcat_http_url']) != (connection.ws_url, connection.http_url):
+                logger.info(f"账号 {connection.name} 的NapCat地址已修改，下次重连时生效")
+            connection.update(account)
+        if accounts:
+            logger.warning(f"新增的账号 {', '.join(accounts)} 需要重启后生效")
+
+    @property
+    def connection(self) -> NapCatConnection:
+        """当前事件所属账号的连接，不在事件处理中时为第一个账号"""
+        return _current_connection.get() or self.connections[0]
+
+    def _register_metrics(self):
+        """注册队列深度、处理中数量、缓存命中率等瞬时指标"""
+        REGISTRY.gauge('antisetu_model_ready', '模型是否已加载并完成预热', lambda: int(self.model_ready is not None and self.model_ready.is_set()))
+        REGISTRY.gauge('antisetu_event_queue_depth', '排队等待处理的事件数（含读取缓冲）',
+                       lambda: self.dispatcher.pending + sum(len(connection.inbound) for connection in self.connections))
+        REGISTRY.gauge('antisetu_events_in_flight', '正在处理的事件数', lambda: self.dispatcher.in_flight)
+        REGISTRY.gauge('antisetu_images_in_flight', '正在处理的图片数', lambda: self.images_in_flight)
+        REGISTRY.gauge('antisetu_events_dropped', '因排队过多被丢弃的事件数',
+                       lambda: self.dispatcher.dropped + sum(connection.inbound.dropped for connection in self.connections))
+        REGISTRY.gauge('antisetu_image_events_dropped', '因排队过多未经检测被丢弃的图片消息数',
+                       lambda: self.dispatcher.dropped_protected
+                       + sum(connection.inbound.dropped_protected for connection in self.connections))
+        REGISTRY.gauge('antisetu_detection_queue_depth', '排队等待检测的图片数', lambda: self.detection_scheduler.pending)
+        REGISTRY.gauge('antisetu_action_queue_depth', '排队等待发送的撤回和消息数',
+                       lambda: sum(connection.action_scheduler.pending for connection in self.connections))
+        REGISTRY.gauge('antisetu_connections_up', '已连接的NapCat账号数',
+                       lambda: sum(connection.running for connection in self.connections))
+        REGISTRY.gauge('antisetu_verdict_cache_hit_ratio', '检测结果缓存命中率', self.verdict_cache.hit_ratio)
+        REGISTRY.gauge('antisetu_verdict_cache_hits', '检测结果缓存命中次数', lambda: self.verdict_cache.hits)
+        REGISTRY.gauge('antisetu_verdict_cache_misses', '检测结果缓存未命中次数', lambda: self.verdict_cache.misses)
+        scheduler = getattr(self.image_detector, 'scheduler', None)
+        if scheduler is not None:
+            REGISTRY.gauge('antisetu_inference_queue_depth', '等待组批推理的图片数', lambda: scheduler.pending)
+            REGISTRY.gauge('antisetu_inference_avg_batch_size', '平均推理批次大小', lambda: scheduler.stats()['avg_batch_size'])
+
+    def start_model_loading(self):
+        """在后台加载并预热模型，期间收到的事件在分发队列中等待"""
+        if self.model_ready is not None:
+            return
+        self.model_ready = asyncio.Event()
+        if getattr(self.image_detector, 'ready', True):
+            self.model_ready.set()
+            return
+        self.model_task = asyncio.ensure_future(self._load_model())
+
+    async def _load_model(self):
+        try:
+            await self.image_detector.load_async()
+        except Exception as e:
+            logger.error(f"模型加载失败: {e}", exc_info=True)
+        finally:
+            # 加载失败时沿用模拟检测结果，不让事件一直排队
+            self._register_metrics()
+            self.model_ready.set()
+
+    async def wait_model_ready(self):
+        """等待模型加载和预热完成"""
+        if self.model_ready is not None and not self.model_ready.is_set():
+            logger.debug("模型尚未就绪，等待加载完成")
+            await self.model_ready.wait()
+
+    async def swap_model(self) -> bool:
+        """按当前配置在旧模型旁加载新模型，预热完成后原子切换，旧模型处理完手头的图片后关闭
+
+        加载期间和失败时旧模型继续提供检测，返回是否切换成功。加载期间模型配置又有修改时，
+        当前切换完成后按最新配置再切换一次。
+        """
+        if self.model_swapping:
+            logger.info("已有模型正在加载，完成后按最新配置再次切换")
+            self.model_swap_pending = True
+            return False
+        self.model_swapping = True
+        try:
+            await self.wait_model_ready()
+            config = copy.deepcopy(self.config_manager.config)
+            new_detector = ImageDetector(config, lazy=True)
+            await new_detector.load_async()
+            if not new_detector.model_loaded:
+                logger.error("新模型加载失败，继续使用旧模型")
+                await new_detector.close()
+                return False
+            old_detector, self.image_detector = self.image_detector, new_detector
+            # 切换、代数加一和缓存指纹更新之间没有等待，切换前开始的检测结果不会以新指纹写入缓存
+            self.detector_config = config
+            self.model_generation += 1
+            self.verdict_cache.update_fingerprint(self.fingerprint_config(self.config_manager.config))
+            self._register_metrics()
+            logger.info("已切换到新模型")
+            await old_detector.close()
+            return True
+        except Exception as e:
+            logger.error(f"切换模型异常: {e}", exc_info=True)
+            return False
+        finally:
+            self.model_swapping = False
+            if self.model_swap_pending:
+                self.model_swap_pending = False
+                if self.model_key(self.config_manager.config) != self.model_key(self.detector_config):
+                    asyncio.ensure_future(self.swap_model())
+
+    async def _swap_model_and_report(self, group_id: str):
+        if await self.swap_model():
+            await self.send_message('group', group_id, "✅ 新模型已加载并切换完成")
+        else:
+            await self.send_message('group', group_id, "❌ 新模型加载失败，继续使用原模型，详情见日志")
+
+    def is_protected_event(self, data: Dict[str, Any]) -> bool:
+        """排队过多时最后才丢弃的事件：白名单群中带图片的消息和管理员的消息"""
+        if data.get('post_type') != 'message' or data.get('message_type') != 'group':
+            return False
+        if self.config_manager.is_admin(str(data.get('user_id', ''))):
+            return True
+        if not self.config_manager.is_whitelist_group(str(data.get('group_id', ''))):
+            return False
+        message = data.get('message')
+        return isinstance(message, list) and any(segment.get('type') == 'image' for segment in message)
+
+    async def handle_event(self, data: Dict[str, Any], catch_up: bool = False,
+                           connection: Optional[NapCatConnection] = None):
+        """分发器调用的事件入口：按消息去重，记录事件所属账号，统计处理中的图片数并追踪慢事件"""
+        if data.get('post_type') == 'message' and data.get('message_type') == 'group':
+            # 多个账号在同一群中会各收到一次，重连补查也可能与实时事件重复，同一条消息只处理一次
+            if not self.seen_messages.add(message_key(data)):
+                logger.debug(f"消息 {data.get('message_id')} 已处理过，跳过")
+                return
+        # 分发器的工作协程会复用，处理完后恢复，避免账号泄漏到下一个事件
+        token = _current_connection.set(connection or self.connections[0])
+        message = data.get('message')
+        image_count = sum(1 for segment in message if segment.get('type') == 'image') if isinstance(message, list) else 0
+        description = {
+            'group_id': data.get('group_id'),
+            'message_id': data.get('message_id'),
+            'images': image_count,
+            'catch_up': catch_up,
+            'account': self.connection.name,
+        }
+        self.images_in_flight += image_count
+        try:
+            with self.tracer.trace(description):
+                await self.process_message(data, catch_up=catch_up)
+        finally:
+            self.images_in_flight -= image_count
+            _current_connection.reset(token)
 
-    async def connect(self):
+    async def connect(self, connection: NapCatConnection):
         """连接到NapCat WebSocket"""
-        ws_url = self.config_manager.config['napcat_ws_url']
+        ws_url = connection.ws_url
         try:
-            self.websocket = await websockets.connect(ws_url)
-            self.running = True
-            logger.info(f"已连接到NapCat: {ws_url}")
+            connection.websocket = await websockets.connect(ws_url)
+            connection.actions.attach(connection.websocket)
+            connection.running = True
+            logger.info(f"[{connection.name}] 已连接到NapCat: {ws_url}")
             return True
         except Exception as e:
-            logger.error(f"连接NapCat失败: {e}")
+            logger.error(f"[{connection.name}] 连接NapCat失败: {e}")
             return False
     
-    async def send_message(self, message_type: str, target_id: str, message: str):
-        """发送消息"""
+    @timed('send_message')
+    async def send_message(self, message_type: str, target_id: str, message: str,
+                           connection: Optional[NapCatConnection] = None):
+        """发送消息，不指定账号时由当前事件所属的账号发送"""
+        connection = connection or self.connection
         try:
-            http_url = self.config_manager.config['napcat_http_url']
-            
             if message_type == 'group':
-                url = f"{http_url}/send_group_msg"
+                action = "send_group_msg"
                 data = {
                     "group_id": int(target_id),
                     "message": message
                 }
             elif message_type == 'private':
-                url = f"{http_url}/send_private_msg"
+                action = "send_private_msg"
                 data = {
                     "user_id": int(target_id),
                     "message": message
@@ -173,129 +603,292 @@ class NapCatBot:
                 logger.error(f"不支持的消息类型: {message_type}")
                 return
             
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, json=data) as response:
-                    if response.status == 200:
-                        logger.info(f"消息发送成功: {message}")
-                    else:
-                        logger.error(f"消息发送失败: {response.status}")
+            # 发送消息不是幂等操作，超时后不会重复发送
+            response = await connection.actions.call(action, data, idempotent=False)
+            if connection.actions.is_ok(response):
+                logger.info(f"消息发送成功: {message}")
+            else:
+                logger.error(f"消息发送失败: {response}")
                         
         except Exception as e:
             logger.error(f"发送消息异常: {e}")
     
+    @timed('download')
     async def download_image(self, url: str) -> Optional[bytes]:
-        """下载图片"""
+        """流式下载图片：限制大小，根据文件头尽早放弃不支持的格式和解压炸弹
+
+        像素超过上限时抛出 ImageTooLarge，由调用方计为未检测；上限以下的大图照常下载，
+        检测时按降采样解码。
+        """
         try:
             logger.debug(f"开始下载图片: {url}")
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url) as response:
-                    if response.status == 200:
-                        image_data = await response.read()
-                        logger.debug(f"图片下载成功，大小: {len(image_data)} 字节")
-                        return image_data
-                    else:
-                        logger.error(f"下载图片失败: {response.status}")
+            async with self.http.request('GET', url, timeout=self.download_timeout) as response:
+                if response.status != 200:
+                    logger.error(f"下载图片失败: {response.status}")
+                    return None
+                if response.content_length and response.content_length > self.download_max_bytes:
+                    logger.warning(f"图片过大，放弃下载: {response.content_length} 字节")
+                    return None
+
+                buffer = bytearray()
+                image_format = None
+                image_size = None
+                async for chunk in response.content.iter_chunked(self.download_chunk_size):
+                    buffer += chunk
+                    if len(buffer) > self.download_max_bytes:
+                        logger.warning(f"图片超过大小上限 {self.download_max_bytes} 字节，停止下载")
                         return None
+                    if image_format is None and len(buffer) >= SNIFF_BYTES:
+                        image_format = sniff_format(bytes(buffer[:SNIFF_BYTES]))
+                        if image_format is None:
+                            logger.warning(f"不支持的图片格式，停止下载: {bytes(buffer[:SNIFF_BYTES])!r}")
+                            return None
+                    # 头部到齐后即可得到宽高，像素超过上限的图片不再继续下载
+                    if image_format is not None and image_size is None:
+                        image_size = probe_size(bytes(buffer))
+                        check_pixels(image_size, self.download_max_pixels)
+
+                if image_format is None:
+                    logger.warning("图片数据过短或格式无法识别")
+                    return None
+                logger.debug(f"图片下载成功，格式: {image_format}，尺寸: {image_size}，大小: {len(buffer)} 字节")
+                return bytes(buffer)
+        except ImageTooLarge:
+            raise
         except Exception as e:
             logger.error(f"下载图片异常: {e}")
             return None
     
-    async def process_image_message(self, group_id: str, user_id: str, message_data: List[Dict], message_id: Optional[int] = None):
-        """处理图片消息"""
+    @timed('process_image')
+    async def process_image_message(self, group_id: str, user_id: str, message_data: List[Dict], message_id: Optional[int] = None, message_time: Optional[float] = None,
+                                    catch_up: bool = False):
+        """处理图片消息：并发检测消息中的所有图片，合并为一个结论
+
+        第一张图片确认违规时立即撤回，不等待其余图片；全部完成后只发送一条警告。
+        """
+        tasks = []
         try:
-            logger.debug(f"收到图片消息，群组: {group_id}, 用户: {user_id}")
-            for segment in message_data:
-                if segment.get('type') == 'image':
-                    image_url = segment.get('data', {}).get('url')
-                    if not image_url:
-                        logger.warning("图片消息中没有URL")
-                        continue
-                    
-                    logger.debug(f"发现图片URL: {image_url}")
-                    # 下载图片
-                    image_data = await self.download_image(image_url)
-                    if not image_data:
-                        logger.warning("图片下载失败，跳过处理")
-                        continue
-                    
-                    # 调用图片检测模块
-                    logger.debug("开始检测图片内容")
-                    results = await self.image_detector.detect_image(image_data)
-                    logger.debug(f"检测完成，结果数量: {len(results)}")
-                    
-                    if results:
-                        # 处理检测结果，传递 message_id 和 image_data
-                        await self.handle_detection_results(group_id, user_id, results, message_id, image_data=image_data, image_url=image_url)
-                    else:
-                        logger.warning("未获得检测结果")
-                        
+            segments = [segment for segment in message_data if segment.get('type') == 'image']
+            logger.debug(f"收到图片消息，群组: {group_id}, 用户: {user_id}, 图片数: {len(segments)}")
+
+            async def check(index: int, segment: Dict):
+                return index, await self.check_image(segment, group_id, message_id, message_time, catch_up)
+
+            tasks = [asyncio.ensure_future(check(index, segment)) for index, segment in enumerate(segments)]
+            verdicts: List[Optional[Dict[str, Any]]] = [None] * len(segments)
+            recall_decided = False
+            for next_done in asyncio.as_completed(tasks):
+                index, verdict = await next_done
+                if verdict is not None:
+                    verdict['index'] = index
+                verdicts[index] = verdict
+                if verdict is not None and verdict['violation'] and not recall_decided:
+                    # 第一张确认违规的图片立即触发撤回
+                    recall_decided = True
+                    await self.recall_violation(group_id, message_id, message_time)
+
+            await self.apply_verdicts(group_id, user_id, [verdict for verdict in verdicts if verdict],
+                                      message_id, message_time, recall_decided=recall_decided,
+                                      image_count=len(segments))
         except Exception as e:
             logger.error(f"处理图片消息异常: {e}", exc_info=True)
+        finally:
+            for task in tasks:
+                task.cancel()
 
-    async def recall_message(self, message_id: int):
-        """撤回消息"""
+    async def check_image(self, segment: Dict, group_id: str, message_id: Optional[int] = None,
+                          message_time: Optional[float] = None, catch_up: bool = False) -> Optional[Dict[str, Any]]:
+        """检测单张图片，返回判定结果；无法获得检测结果时返回 None
+
+        catch_up 为 True 表示重连后补查的历史消息，检测排在实时消息之后。
+        """
         try:
-            http_url = self.config_manager.config['napcat_http_url']
-            url = f"{http_url}/delete_msg"
-            data = {"message_id": message_id}
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, json=data) as response:
-                    if response.status == 200:
-                        logger.info(f"消息撤回成功: {message_id}")
+            image_url = segment.get('data', {}).get('url')
+            logger.debug(f"发现图片: {segment.get('data', {}).get('file')} {image_url}")
+            image_data = None
+            image_hash = None
+            # 先按图片文件ID查缓存，命中则跳过下载和检测
+            file_key = self.verdict_cache.segment_key(segment)
+            # 下载后还会按内容哈希再查一次，这里未命中不计数，一张图片只计一次未命中
+            results = await self.verdict_cache.get(file_key, count_miss=False)
+            if results is not None:
+                logger.debug(f"检测结果缓存命中: {file_key}")
+            else:
+                # 获取图片：本机缓存优先，失败时下载
+                try:
+                    image_data = await self.connection.image_source.fetch(segment)
+                except ImageTooLarge as e:
+                    self.verdict_cache.record_miss()
+                    UNMODERATED_IMAGES.inc(reason='too_large')
+                    logger.warning(f"图片像素超过上限 ({e})，未经检测: 消息 {message_id}")
+                    return None
+                if not image_data:
+                    self.verdict_cache.record_miss()
+                    logger.warning("图片获取失败，跳过处理")
+                    return None
+
+                # 文件ID未命中时按内容哈希再查一次
+                content_key = self.verdict_cache.content_key(image_data)
+                results = await self.verdict_cache.get(content_key)
+                if results is not None:
+                    logger.debug(f"检测结果缓存命中: {content_key}")
+                    self.verdict_cache.put(results, file_key)
+                else:
+                    # 与已知违规图片近似重复时直接沿用其检测结果
+                    image_hash = await self.compute_image_hash(image_data)
+                    results = self.match_known_violation(image_hash)
+                    if results is not None:
+                        self.verdict_cache.put(results, file_key, content_key)
                     else:
-                        logger.error(f"消息撤回失败: {response.status}")
+                        # 调用图片检测模块，排队时自动撤回群的图片优先
+                        await self.wait_model_ready()
+                        generation = self.model_generation
+                        logger.debug("开始检测图片内容")
+                        results = await self.detection_scheduler.run(
+                            lambda: self.image_detector.detect_image(image_data),
+                            recall=self.config_manager.is_auto_recall_group(group_id),
+                            message_time=message_time,
+                            catch_up=catch_up,
+                        )
+                        if results is None:
+                            logger.warning(f"消息 {message_id} 已超过撤回时限，跳过检测")
+                            return None
+                        logger.debug(f"检测完成，结果数量: {len(results)}")
+                        # 模型未加载时的模拟结果、检测期间模型已切换时旧模型的结果不写入缓存
+                        if self.image_detector.model_loaded and generation == self.model_generation:
+                            self.verdict_cache.put(results, file_key, content_key)
+
+            if not results:
+                logger.warning("未获得检测结果")
+                return None
+            verdict = self.evaluate_results(results)
+            verdict.update({'image_data': image_data, 'image_url': image_url, 'image_hash': image_hash})
+            return verdict
+        except Exception as e:
+            logger.error(f"检测图片异常: {e}", exc_info=True)
+            return None
+
+    async def compute_image_hash(self, image_data: bytes) -> Optional[int]:
+        """在线程池中计算图片感知哈希"""
+        if not self.phash_index.enabled:
+            return None
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, compute_dhash, image_data)
+
+    def match_known_violation(self, image_hash: Optional[int]) -> Optional[List[Dict]]:
+        """在已知违规图片索引中查找近似重复，命中则返回其检测结果"""
+        match = self.phash_index.lookup(image_hash)
+        if match is None:
+            return None
+        distance, entry = match
+        logger.info(f"命中已知违规图片: {entry.get('file')}，汉明距离 {distance}，跳过模型检测")
+        return entry['results']
+
+    @timed('recall')
+    async def recall_message(self, message_id: int, connection: Optional[NapCatConnection] = None):
+        """撤回消息，不指定账号时由当前事件所属的账号撤回"""
+        connection = connection or self.connection
+        try:
+            data = {"message_id": message_id}
+            response = await connection.actions.call("delete_msg", data)
+            if connection.actions.is_ok(response):
+                logger.info(f"消息撤回成功: {message_id}")
+            else:
+                logger.error(f"消息撤回失败: {response}")
         except Exception as e:
             logger.error(f"撤回消息异常: {e}")
 
-    async def handle_detection_results(self, group_id: str, user_id: str, results: List[Dict], message_id: Optional[int] = None, image_data: Optional[bytes] = None, image_url: Optional[str] = None):
-        """处理检测结果"""
-        if not results:
-            logger.warning("没有检测到任何结果")
-            return
-        
+    def evaluate_results(self, results: List[Dict]) -> Dict[str, Any]:
+        """按标签映射和违规关键词判定一张图片的检测结果"""
         logger.debug(f"检测结果: {json.dumps(results, ensure_ascii=False, indent=2)}")
-        
-        violation_found = False
-        result_text = "🔍 图片检测结果:\n"
-        violation_labels = []
-
-        for i, result in enumerate(results, 1):
-            label = result.get('label', '未知')
-            label_cn = self.label_map.get(label.lower(), f"{label}(未翻译)")
-            confidence = result.get('confidence', 0)
-            result_text += f"{i}. {label_cn}: {confidence:.2%}\n"
-            
-            if confidence > self.image_detector.confidence_threshold:
-                if any(keyword in label.lower() for keyword in self.violation_keywords):
-                    violation_found = True
-                    violation_labels.append(label_cn)
-                    logger.info(f"检测到违规内容: {label_cn} ({confidence:.2%})")
-        
-        # 检测到违规内容时保存图片
-        if violation_found and image_data:
-            try:
+        return evaluate_results(results, self.label_map, self.image_detector.confidence_threshold, self.violation_keywords)
+
+    async def save_violation(self, group_id: str, user_id: str, verdict: Dict[str, Any], message_id: Optional[int] = None):
+        """保存违规图片并登记到感知哈希索引"""
+        image_data = verdict.get('image_data')
+        if not image_data:
+            return
+        try:
+            if self.violation_archive.enabled:
+                # 交给后台归档，按内容哈希去重保存并登记索引
+                filename = self.violation_archive.submit(
+                    image_data, group_id, user_id, verdict['results'], verdict['raw_labels'], message_id)
+            else:
                 now = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-                label_str = "_".join(violation_labels) if violation_labels else "violation"
+                label_str = "_".join(verdict['labels']) if verdict['labels'] else "violation"
                 filename = f"{now}_群{group_id}_用户{user_id}_{label_str}.jpg"
                 save_path = os.path.join(self.violation_save_path, filename)
-                with open(save_path, "wb") as f:
-                    f.write(image_data)
+                await asyncio.get_event_loop().run_in_executor(None, Path(save_path).write_bytes, image_data)
                 logger.info(f"违规图片已保存到: {save_path}")
-            except Exception as e:
-                logger.error(f"保存违规图片失败: {e}")
+            # 登记到感知哈希索引
+            image_hash = verdict.get('image_hash')
+            if image_hash is None:
+                image_hash = await self.compute_image_hash(image_data)
+            self.phash_index.add(image_hash, verdict['results'], file=filename)
+        except Exception as e:
+            logger.error(f"保存违规图片失败: {e}")
 
-        if violation_found:
-            warning_msg = f"⚠️ 检测到可能的违规内容!\n{result_text}\n请注意群规，维护良好的聊天环境。"
-            await self.send_message('group', group_id, warning_msg)
-            logger.info("已发送违规警告")
-            # 自动撤回功能
-            if self.config_manager.is_auto_recall_group(group_id) and message_id:
-                await self.recall_message(message_id)
+    async def recall_violation(self, group_id: str, message_id: Optional[int], message_time: Optional[float] = None) -> bool:
+        """自动撤回群中的违规消息：提交撤回，返回是否已撤回或已提交
+
+        接近或超过撤回时限的消息也照常尝试撤回，由 NapCat 决定是否还能撤回。
+        """
+        if not (self.config_manager.is_auto_recall_group(group_id) and message_id):
+            return False
+        if self.detection_scheduler.record_recall(message_time):
+            logger.warning(f"消息 {message_id} 已接近或超过撤回时限，仍尝试撤回")
+        connection = self.connection
+        if connection.action_scheduler.enabled:
+            # 交给出站调度，撤回排在所有提示消息之前；调度协程中没有事件上下文，需绑定账号
+            connection.action_scheduler.recall(group_id, message_id, lambda: self.recall_message(message_id, connection))
+            logger.info(f"[{connection.name}] 已提交撤回: {message_id}")
         else:
+            await self.recall_message(message_id, connection)
+        return True
+
+    async def apply_verdicts(self, group_id: str, user_id: str, verdicts: List[Dict[str, Any]],
+                             message_id: Optional[int] = None, message_time: Optional[float] = None,
+                             recall_decided: bool = False, image_count: int = 1):
+        """按一条消息中各图片的判定结果保存违规图片，撤回并发送一条警告"""
+        violations = [verdict for verdict in verdicts if verdict['violation']]
+        if not violations:
             logger.info("未检测到违规内容")
             # 可选：发送正常结果
-            # info_msg = f"图片检测结果:\n{result_text}"
+            # info_msg = f"图片检测结果:\n" + "".join(verdict['text'] for verdict in verdicts)
             # await self.send_message('group', group_id, info_msg)
+            return
+
+        for verdict in violations:
+            await self.save_violation(group_id, user_id, verdict, message_id)
+
+        if not recall_decided:
+            await self.recall_violation(group_id, message_id, message_time)
+
+        if image_count > 1:
+            # 多图消息只列出违规的图片，并标明是第几张
+            result_text = "".join(f"[图片 {verdict.get('index', 0) + 1}/{image_count}] {verdict['text']}"
+                                  for verdict in violations)
+        else:
+            result_text = violations[0]['text']
+        labels = list(dict.fromkeys(label for verdict in violations for label in verdict['labels']))
+        warning_msg = f"⚠️ 检测到可能的违规内容!\n{result_text}\n请注意群规，维护良好的聊天环境。"
+        action_scheduler = self.connection.action_scheduler
+        if action_scheduler.enabled:
+            # 同群短时间内的警告由出站调度合并为一条
+            action_scheduler.warn(group_id, user_id, labels, warning_msg)
+            logger.info("已提交违规警告")
+        else:
+            await self.send_message('group', group_id, warning_msg)
+            logger.info("已发送违规警告")
+
+    async def handle_detection_results(self, group_id: str, user_id: str, results: List[Dict], message_id: Optional[int] = None, image_data: Optional[bytes] = None, image_url: Optional[str] = None, image_hash: Optional[int] = None, message_time: Optional[float] = None):
+        """处理单张图片的检测结果"""
+        if not results:
+            logger.warning("没有检测到任何结果")
+            return
+        verdict = self.evaluate_results(results)
+        verdict.update({'image_data': image_data, 'image_url': image_url, 'image_hash': image_hash})
+        await self.apply_verdicts(group_id, user_id, [verdict], message_id, message_time)
     
     async def handle_admin_command(self, user_id: str, group_id: str, message: str):
         """处理管理员命令"""
@@ -321,6 +914,13 @@ class NapCatBot:
                 await self.send_message('group', group_id, "✅ 当前群聊已从图片检测白名单移除")
             else:
                 await self.send_message('group', group_id, "ℹ️ 当前群聊不在白名单中")
+        elif message == "重载模型":
+            if self.model_swapping:
+                await self.send_message('group', group_id, "ℹ️ 新模型正在加载中")
+            else:
+                await self.send_message('group', group_id, "⏳ 正在后台加载新模型，加载期间继续使用当前模型")
+                # 加载耗时较长，不占用事件处理协程
+                asyncio.ensure_future(self._swap_model_and_report(group_id))
         elif message == "查看白名单":
             whitelist = self.config_manager.config['whitelist_groups']
             if whitelist:
@@ -329,8 +929,8 @@ class NapCatBot:
             else:
                 await self.send_message('group', group_id, "📋 白名单为空")
     
-    async def process_message(self, data: Dict[str, Any]):
-        """处理收到的消息"""
+    async def process_message(self, data: Dict[str, Any], catch_up: bool = False):
+        """处理收到的消息，catch_up 为 True 表示重连后补查的历史消息"""
         try:
             post_type = data.get('post_type')
             if post_type != 'message':
@@ -344,6 +944,7 @@ class NapCatBot:
             user_id = str(data.get('user_id', ''))
             message = data.get('message', [])
             message_id = data.get('message_id', None)
+            message_time = data.get('time', None)
             
             logger.debug(f"收到群消息: 群号={group_id}, 用户={user_id}")
             
@@ -366,32 +967,40 @@ class NapCatBot:
             has_image = any(segment.get('type') == 'image' for segment in message)
             if has_image:
                 logger.debug("消息包含图片，开始处理")
-                await self.process_image_message(group_id, user_id, message, message_id)
+                await self.process_image_message(group_id, user_id, message, message_id, message_time, catch_up)
             else:
                 logger.debug("消息不包含图片，跳过处理")
                 
         except Exception as e:
             logger.error(f"处理消息异常: {e}", exc_info=True)
     
-    async def listen(self):
-        """监听消息"""
+    async def listen(self, connection: NapCatConnection):
+        """监听一个账号的消息"""
         try:
-            async for message in self.websocket:
+            async for message in connection.websocket:
                 try:
                     data = json.loads(message)
-                    logger.debug(f"收到WebSocket消息: {message[:200]}...")
-                    await self.process_message(data)
+                    logger.debug(f"[{connection.name}] 收到WebSocket消息: {message[:200]}...")
+                    # 动作响应直接交给等待中的调用方
+                    if connection.actions.handle_response(data):
+                        continue
+                    # 放入缓冲后立即继续读取，分发器积压时动作响应和心跳也不会被耽误
+                    connection.inbound.put(str(data.get('group_id', '')), (connection, data))
                 except json.JSONDecodeError as e:
                     logger.error(f"JSON解析错误: {e}")
                 except Exception as e:
                     logger.error(f"处理消息异常: {e}")
                     
         except websockets.exceptions.ConnectionClosed:
-            logger.warning("WebSocket连接已关闭")
-            self.running = False
+            logger.warning(f"[{connection.name}] WebSocket连接已关闭")
         except Exception as e:
-            logger.error(f"监听消息异常: {e}")
-            self.running = False
+            logger.error(f"[{connection.name}] 监听消息异常: {e}")
+        connection.running = False
+        # 记录断线时间，重连后从这里开始补查；上次补查未完成时保留更早的时间
+        if connection.disconnected_at is None:
+            connection.disconnected_at = time.time()
+        # 等待中的动作改走HTTP，之后的动作也直接走HTTP；已收到的事件在后台继续处理，不推迟重连
+        connection.actions.detach()
     
     async def run(self):
         """运行机器人"""
@@ -402,30 +1011,110 @@ class NapCatBot:
             logger.error("请在config.json中配置管理员QQ")
             return
         
+        if self.metrics_server is not None:
+            try:
+                await self.metrics_server.start()
+            except Exception as e:
+                logger.error(f"指标接口启动失败: {e}")
+
+        self.start_model_loading()
+        await self.violation_archive.start()
+
+        if self.config_manager.watch_enabled and self.config_watch_task is None:
+            self.config_watch_task = asyncio.ensure_future(self.config_manager.watch())
+
+        if len(self.connections) > 1:
+            logger.info(f"共 {len(self.connections)} 个账号: {', '.join(connection.name for connection in self.connections)}")
+        for connection in self.connections:
+            connection.pump_task = asyncio.ensure_future(self.pump_events(connection))
+            connection.task = asyncio.ensure_future(self.run_connection(connection))
+        try:
+            await asyncio.gather(*[connection.task for connection in self.connections])
+        except KeyboardInterrupt:
+            logger.info("收到退出信号，正在关闭...")
+
+    async def pump_events(self, connection: NapCatConnection):
+        """把一个账号缓冲中的事件交给分发器，分发器排队已满时在这里等待"""
+        while True:
+            key, item = await connection.inbound.get()
+            try:
+                await self.dispatcher.dispatch(key, item)
+            finally:
+                connection.inbound.task_done()
+
+    async def run_connection(self, connection: NapCatConnection):
+        """保持一个账号的连接：断线后按退避重连，重连后补查断线期间的图片"""
+        backoff = connection.reconnect_backoff
         while True:
             try:
-                if await self.connect():
-                    await self.listen()
+                if await self.connect(connection):
+                    RECONNECTS.inc(result='ok')
+                    backoff.connected()
+                    self.start_catch_up(connection)
+                    await self.listen(connection)
+                    backoff.disconnected()
                 else:
-                    logger.error("连接失败，5秒后重试...")
-                    await asyncio.sleep(5)
-                    
-                if not self.running:
-                    logger.info("5秒后尝试重连...")
-                    await asyncio.sleep(5)
-                    
-            except KeyboardInterrupt:
-                logger.info("收到退出信号，正在关闭...")
-                break
+                    RECONNECTS.inc(result='failed')
+
+                delay = backoff.next_delay()
+                logger.info(f"[{connection.name}] {delay:.1f}秒后尝试重连（第 {backoff.attempt} 次）...")
+                await asyncio.sleep(delay)
+
             except Exception as e:
-                logger.error(f"运行异常: {e}")
-                await asyncio.sleep(5)
+                logger.error(f"[{connection.name}] 运行异常: {e}")
+                await asyncio.sleep(backoff.next_delay())
+
+    def start_catch_up(self, connection: NapCatConnection):
+        """重连成功后在后台补查断线期间的图片，上一次补查未完成时先取消"""
+        if connection.disconnected_at is None:
+            return
+        if connection.catch_up_task is not None and not connection.catch_up_task.done():
+            connection.catch_up_task.cancel()
+        connection.catch_up_task = asyncio.ensure_future(self._catch_up(connection, connection.disconnected_at))
+
+    async def _catch_up(self, connection: NapCatConnection, since: float):
+        try:
+            await connection.catch_up.run(
+                self.config_manager.config.get('whitelist_groups', []),
+                since,
+                self.seen_messages,
+                self.detection_scheduler.is_expired,
+                connection.bot_qq,
+            )
+            # 补查完成后才清除断线时间，中途再次断线时下次从更早的时间补查
+            if connection.disconnected_at == since:
+                connection.disconnected_at = None
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"[{connection.name}] 补查断线期间的消息异常: {e}", exc_info=True)
     
     async def close(self):
         """关闭连接"""
-        self.running = False
-        if self.websocket:
-            await self.websocket.close()
+        if self.config_watch_task is not None:
+            self.config_watch_task.cancel()
+            await asyncio.gather(self.config_watch_task, return_exceptions=True)
+            self.config_watch_task = None
+        for connection in self.connections:
+            await connection.stop()
+        # 先把各账号缓冲中已收到的事件交给分发器，再等分发器处理完
+        for connection in self.connections:
+            await connection.drain_inbound(self.drain_timeout)
+        await self.dispatcher.close(self.drain_timeout)
+        # 分发器处理完剩余事件后再关闭各账号的出站调度，撤回和警告不会丢失
+        for connection in self.connections:
+            await connection.close(self.drain_timeout)
+        await self.http.close()
+        await self.violation_archive.close()
+        if self.model_task is not None and not self.model_task.done():
+            self.model_task.cancel()
+            await asyncio.gather(self.model_task, return_exceptions=True)
+        await self.image_detector.close()
+        if self.metrics_server is not None:
+            await self.metrics_server.stop()
+        await self.config_manager.flush()
+        self.verdict_cache.close()
+        self.phash_index.close()
 
 async def main():
     bot = NapCatBot()
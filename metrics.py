@@ -0,0 +1,222 @@
+import bisect
+import contextlib
+import contextvars
+import functools
+import json
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# 默认耗时分桶（秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...], extra: Optional[Tuple[str, str]] = None) -> str:
+    items = list(labels) + ([extra] if extra else [])
+    if not items:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in items) + '}'
+
+
+class Counter:
+    """只增计数器，可按标签区分"""
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        self._values: Dict[Tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(tuple(sorted(labels.items())), 0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+
+class Gauge:
+    """瞬时值，由回调函数在采集时读取"""
+
+    def __init__(self, name: str, help_text: str, func: Callable[[], float]):
+        self.name = name
+        self.help = help_text
+        self.func = func
+
+    def render(self) -> List[str]:
+        try:
+            value = float(self.func())
+        except Exception as e:
+            logger.debug(f"读取指标 {self.name} 失败: {e}")
+            return []
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {value}"]
+
+
+class Histogram:
+    """耗时直方图，可按标签区分"""
+
+    def __init__(self, name: str, help_text: str, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[Tuple, list] = {}  # 标签 -> [各桶计数..., 总和, 总数]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, series in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(key, ('le', str(bound)))} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(key, ('le', '+Inf'))} {series[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {series[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {series[-1]}")
+        return lines
+
+
+class MetricsRegistry:
+    """指标注册表，输出 Prometheus 文本格式"""
+
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help_text: str) -> Counter:
+        return self._metrics.get(name) or self.register(Counter(name, help_text))
+
+    def histogram(self, name: str, help_text: str, buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._metrics.get(name) or self.register(Histogram(name, help_text, buckets))
+
+    def gauge(self, name: str, help_text: str, func: Callable[[], float]) -> Gauge:
+        # 同名指标以最后一次注册的回调为准（如重新创建的机器人实例）
+        return self.register(Gauge(name, help_text, func))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS = REGISTRY.histogram('antisetu_stage_seconds', '各处理阶段耗时（秒）')
+EVENT_SECONDS = REGISTRY.histogram('antisetu_event_seconds', '单个事件从收到到处理完成的耗时（秒）')
+SLOW_EVENTS = REGISTRY.counter('antisetu_slow_events_total', '超过慢事件阈值的事件数')
+
+# 当前事件的阶段耗时记录，供慢事件日志使用
+_current_trace: contextvars.ContextVar = contextvars.ContextVar('antisetu_trace', default=None)
+
+
+@contextlib.contextmanager
+def stage_timer(stage: str):
+    """记录一个处理阶段的耗时，同时写入当前事件的追踪记录"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.append((stage, round(elapsed * 1000, 1)))
+
+
+def timed(stage: str):
+    """装饰器：记录协程函数的耗时"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with stage_timer(stage):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class SlowEventTracer:
+    """慢事件追踪：事件总耗时超过阈值时输出各阶段耗时明细"""
+
+    def __init__(self, threshold_ms: Optional[float] = None, log_file: Optional[str] = None):
+        self.threshold = threshold_ms / 1000 if threshold_ms else None
+        self.log_file = log_file
+
+    @contextlib.contextmanager
+    def trace(self, description: Dict):
+        trace: List[Tuple[str, float]] = []
+        token = _current_trace.set(trace)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            _current_trace.reset(token)
+            EVENT_SECONDS.observe(elapsed)
+            if self.threshold is not None and elapsed >= self.threshold:
+                self._report(description, elapsed, trace)
+
+    def _report(self, description: Dict, elapsed: float, trace: List[Tuple[str, float]]):
+        SLOW_EVENTS.inc()
+        record = dict(description, total_ms=round(elapsed * 1000, 1), stages=trace)
+        logger.warning(f"慢事件: {json.dumps(record, ensure_ascii=False)}")
+        if self.log_file:
+            try:
+                with open(self.log_file, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(dict(record, time=time.time()), ensure_ascii=False) + "\n")
+            except Exception as e:
+                logger.error(f"写入慢事件日志失败: {e}")
+
+
+class MetricsServer:
+    """本地 HTTP 指标接口，GET /metrics 返回 Prometheus 文本格式"""
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 9464, registry: MetricsRegistry = REGISTRY):
+        self.host = host
+        self.port = port
+        self.registry = registry
+        self._runner: Optional[web.AppRunner] = None
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        return web.Response(text=self.registry.render(), content_type='text/plain', charset='utf-8')
+
+    async def start(self):
+        if self._runner is not None:
+            return
+        app = web.Application()
+        app.router.add_get('/metrics', self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info(f"指标接口已启动: http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
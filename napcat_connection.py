@@ -0,0 +1,123 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from action_scheduler import ActionScheduler
+from event_dispatcher import InboundBuffer
+from http_client import HttpClient
+from image_source import ImageSource
+from onebot_actions import ActionTransport
+from reconnect import HistoryCatchUp, ReconnectBackoff
+
+logger = logging.getLogger(__name__)
+
+# 可在单个账号中覆盖的配置项，其余配置所有账号共用
+ACCOUNT_OVERRIDES = ('image_source', 'action_scheduler', 'action_transport')
+
+
+def account_configs(config: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """读取 accounts 列表，未配置时使用顶层的 napcat_ws_url / napcat_http_url / bot_qq 作为唯一账号"""
+    accounts = config.get('accounts') or []
+    if not accounts:
+        return [{
+            'name': 'default',
+            'napcat_ws_url': config['napcat_ws_url'],
+            'napcat_http_url': config['napcat_http_url'],
+            'bot_qq': config.get('bot_qq', ''),
+        }]
+    result = []
+    names = set()
+    for index, account in enumerate(accounts):
+        name = str(account.get('name') or account.get('bot_qq') or f"account{index + 1}")
+        if name in names:
+            raise ValueError(f"accounts 中的账号名称重复: {name}")
+        names.add(name)
+        result.append(dict(account, name=name))
+    return result
+
+
+class NapCatConnection:
+    """一个机器人账号（一个 NapCat 实例）的连接和出站通道
+
+    每个账号有独立的 WebSocket、动作通道、出站限速、图片获取和重连状态；
+    检测器、检测调度、结果缓存等由同一进程中的所有账号共用。
+    """
+
+    def __init__(self, account: Dict[str, Any], http: HttpClient, config: Dict[str, Any],
+                 send_group_message: Callable[['NapCatConnection', str, str], Awaitable[Any]],
+                 download: Callable[[str], Awaitable[Optional[bytes]]],
+                 handle_catch_up: Callable[['NapCatConnection', Dict[str, Any]], Awaitable[None]],
+                 is_protected: Optional[Callable[[Dict[str, Any]], bool]] = None):
+        self.name = account['name']
+        self.update(account)
+        account_config = dict(config, **{key: account[key] for key in ACCOUNT_OVERRIDES if key in account})
+        self.websocket = None
+        self.running = False
+        # 收到的事件先放入缓冲，由 pump_task 交给分发器，读取协程从不等待
+        self.inbound = InboundBuffer(
+            config.get('event_dispatch', {}).get('max_buffered', 10000),
+            (lambda item: is_protected(item[1])) if is_protected else None,
+        )
+        self.pump_task: Optional[asyncio.Task] = None
+        # 动作优先经由WebSocket发送，HTTP作为回退
+        self.actions = ActionTransport(http, lambda: self.http_url, account_config)
+        # 出站动作调度：限速按账号计算，撤回和警告由收到消息的账号发出
+        self.action_scheduler = ActionScheduler(
+            lambda group_id, message: send_group_message(self, group_id, message),
+            account_config,
+        )
+        # 图片获取：优先读取该账号 NapCat 的本机缓存，失败时再下载
+        self.image_source = ImageSource(download, self.actions.call, account_config)
+        # 断线重连：立即重试一次后指数退避，重连后补查断线期间的图片
+        self.reconnect_backoff = ReconnectBackoff(config)
+        self.catch_up = HistoryCatchUp(
+            self.actions.call,
+            lambda event: handle_catch_up(self, event),
+            config,
+        )
+        self.disconnected_at: Optional[float] = None
+        self.catch_up_task: Optional[asyncio.Task] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def update(self, account: Dict[str, Any]):
+        """更新连接地址和账号QQ，地址在下次重连时生效"""
+        self.ws_url = account['napcat_ws_url']
+        self.http_url = account['napcat_http_url']
+        self.bot_qq = str(account.get('bot_qq', '') or '')
+
+    def __repr__(self) -> str:
+        return f"NapCatConnection({self.name!r}, {self.ws_url!r})"
+
+    async def stop(self):
+        """停止重连和补查，关闭WebSocket
+
+        关闭前先让动作通道改走HTTP，并在读取协程仍运行时等待已发出的动作收到响应，
+        之后仍在排队的撤回和警告不会发往已关闭的连接。
+        """
+        self.running = False
+        if self.catch_up_task is not None and not self.catch_up_task.done():
+            self.catch_up_task.cancel()
+            await asyncio.gather(self.catch_up_task, return_exceptions=True)
+        await self.actions.release(wait=self.task is not None and not self.task.done())
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+        if self.websocket:
+            await self.websocket.close()
+
+    async def drain_inbound(self, timeout: Optional[float] = None):
+        """等待缓冲中的事件全部交给分发器后停止 pump_task"""
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + (timeout or 0)
+        while self.inbound.unfinished and self.pump_task is not None and not self.pump_task.done():
+            if timeout is not None and loop.time() >= deadline:
+                logger.warning(f"[{self.name}] 等待事件缓冲清空超时，剩余 {self.inbound.unfinished} 个事件")
+                break
+            await asyncio.sleep(0.05)
+        if self.pump_task is not None and not self.pump_task.done():
+            self.pump_task.cancel()
+            await asyncio.gather(self.pump_task, return_exceptions=True)
+
+    async def close(self, timeout: Optional[float] = None):
+        """发送完排队的撤回和消息后关闭出站调度"""
+        await self.action_scheduler.close(timeout)
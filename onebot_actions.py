@@ -0,0 +1,107 @@
+import asyncio
+import itertools
+import json
+import logging
+import os
+from typing import Any, Callable, Dict, Optional
+
+from http_client import HttpClient
+
+logger = logging.getLogger(__name__)
+
+
+class ActionTransport:
+    """OneBot 动作发送通道
+
+    优先把动作作为 OneBot 动作帧通过已建立的 WebSocket 发送，按 echo 字段把响应
+    匹配回等待中的 Future；WebSocket 不可用时回退到 HTTP 接口。
+    """
+
+    def __init__(self, http: HttpClient, http_url: Callable[[], str], config: Optional[Dict[str, Any]] = None):
+        config = config or {}
+        transport_config = config.get('action_transport', {})
+        self.http = http
+        self.http_url = http_url
+        self.prefer_websocket = bool(transport_config.get('prefer_websocket', True))
+        self.timeout = float(transport_config.get('timeout', 5))
+        self.websocket = None
+        self._pending: Dict[str, asyncio.Future] = {}
+        self._echo_prefix = f"antisetu-{os.getpid()}"
+        self._counter = itertools.count(1)
+
+    def attach(self, websocket):
+        """绑定新建立的 WebSocket 连接"""
+        self.websocket = websocket
+
+    def detach(self):
+        """连接断开：解绑 WebSocket，并让所有等待中的动作失败"""
+        self.websocket = None
+        pending, self._pending = self._pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError("WebSocket连接已断开"))
+
+    async def release(self, wait: bool = True):
+        """准备关闭连接：之后的动作改走HTTP，等待已经发出的动作收到响应（最多 timeout 秒）后解绑
+
+        读取响应的协程已经停止时传 wait=False，直接解绑。
+        """
+        self.websocket = None
+        pending = [future for future in self._pending.values() if not future.done()]
+        if wait and pending:
+            await asyncio.wait(pending, timeout=self.timeout)
+        self.detach()
+
+    def handle_response(self, data: Dict[str, Any]) -> bool:
+        """处理 WebSocket 上收到的动作响应，返回该帧是否属于本通道"""
+        echo = data.get('echo')
+        if not isinstance(echo, str) or not echo.startswith(self._echo_prefix):
+            return False
+        future = self._pending.pop(echo, None)
+        if future is not None and not future.done():
+            future.set_result(data)
+        return True
+
+    @staticmethod
+    def is_ok(response: Optional[Dict[str, Any]]) -> bool:
+        """判断动作响应是否成功"""
+        if response is None:
+            return False
+        return response.get('status', 'ok') in ('ok', 'async') and response.get('retcode', 0) in (0, 1)
+
+    async def call(self, action: str, params: Dict[str, Any], idempotent: bool = True) -> Optional[Dict[str, Any]]:
+        """调用 OneBot 动作，返回响应字典，失败时返回 None
+
+        动作帧发送失败时回退到 HTTP；帧已发出后等待响应超时或连接断开时，NapCat 可能已经
+        执行了该动作，只有幂等动作（如撤回）才会回退到 HTTP 再试一次，避免重复发送消息。
+        """
+        if self.prefer_websocket and self.websocket is not None:
+            echo = f"{self._echo_prefix}-{next(self._counter)}"
+            future = asyncio.get_event_loop().create_future()
+            self._pending[echo] = future
+            try:
+                frame = json.dumps({'action': action, 'params': params, 'echo': echo}, ensure_ascii=False)
+                try:
+                    await self.websocket.send(frame)
+                except Exception as e:
+                    logger.warning(f"通过WebSocket发送动作 {action} 失败，改用HTTP: {e}")
+                else:
+                    try:
+                        return await asyncio.wait_for(future, self.timeout)
+                    except Exception as e:
+                        reason = "等待响应超时" if isinstance(e, asyncio.TimeoutError) else f"等待响应时连接断开: {e}"
+                        if not idempotent:
+                            logger.error(f"动作 {action} {reason}，可能已执行，不再重试")
+                            return None
+                        logger.warning(f"动作 {action} {reason}，改用HTTP重试")
+            finally:
+                self._pending.pop(echo, None)
+        return await self._call_http(action, params, idempotent)
+
+    async def _call_http(self, action: str, params: Dict[str, Any], idempotent: bool) -> Optional[Dict[str, Any]]:
+        url = f"{self.http_url()}/{action}"
+        try:
+            return await self.http.post_json(url, params, idempotent=idempotent)
+        except Exception as e:
+            logger.error(f"通过HTTP调用动作 {action} 异常: {e}")
+            return None
@@ -0,0 +1,258 @@
+import asyncio
+import io
+import itertools
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+HASH_BITS = 64
+SEGMENT_COUNT = 4
+
+
+def compute_dhash(image_data: bytes, hash_size: int = 8) -> Optional[int]:
+    """计算图片的差值感知哈希（dHash），返回64位整数"""
+    try:
+        image = Image.open(io.BytesIO(image_data))
+        # JPEG 可以直接以低分辨率解码，避免完整解码大图
+        image.draft('L', (hash_size * 8, hash_size * 8))
+        image = image.convert('L').resize((hash_size + 1, hash_size), Image.BILINEAR)
+        pixels = np.asarray(image, dtype=np.int16)
+        bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+        return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+    except Exception as e:
+        logger.error(f"计算图片感知哈希失败: {e}")
+        return None
+
+
+class PHashIndex:
+    """已知违规图片的感知哈希索引（多重索引汉明距离查找）
+
+    把64位哈希切成4段16位，按鸽巢原理，汉明距离不超过 max_distance 的
+    两个哈希至少有一段距离不超过 max_distance // 4。查询时只需在各段的桶中
+    查找该半径内的取值，再对少量候选计算真实距离。
+
+    索引文件为 JSONL，新记录在后台线程中批量追加；启动加载时去掉重复和损坏的行、
+    只保留最新的 max_entries 条，有删减时整体重写文件，避免文件无限增长拖慢启动。
+    运行中超过 max_entries 条时淘汰最早的记录，淘汰数累计到 max_entries 条时
+    重建内存索引并在后台重写文件，文件最多约为上限的两倍。
+    """
+
+    def __init__(self, config: Optional[Dict[str, Any]] = None):
+        config = config or {}
+        index_config = config.get('phash_index', {})
+        self.enabled = bool(index_config.get('enabled', True))
+        self.max_distance = int(index_config.get('max_distance', 6))
+        self.max_entries = int(index_config.get('max_entries', 100000))
+        violation_save_path = config.get('violation_save_path', 'violations')
+        self.index_file = index_config.get('index_file') or os.path.join(violation_save_path, 'phash_index.jsonl')
+
+        self._segments = self._split_segments(SEGMENT_COUNT)
+        self._probe_masks = self._make_probe_masks(HASH_BITS // SEGMENT_COUNT, self.max_distance // SEGMENT_COUNT)
+        self._tables: List[Dict[int, List[int]]] = [{} for _ in self._segments]
+        self._hashes: List[int] = []
+        self._entries: List[Optional[Dict[str, Any]]] = []
+        self._known = set()
+        # 最早一条未淘汰记录的下标，之前的位置都已淘汰
+        self._start = 0
+        # 等待追加到索引文件的行，以及正在写入的批次
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='phash-index')
+        self._pending: List[str] = []
+        self._flushing = None
+
+        if self.enabled:
+            self._load()
+        logger.info(f"违规图片感知哈希索引: 启用={self.enabled}, 最大距离={self.max_distance}, 已加载={len(self)}")
+
+    def __len__(self) -> int:
+        return len(self._hashes) - self._start
+
+    @staticmethod
+    def _split_segments(count: int) -> List[Tuple[int, int]]:
+        """把64位切成 count 段，返回每段的 (位移, 掩码)"""
+        count = max(1, min(count, HASH_BITS))
+        base, extra = divmod(HASH_BITS, count)
+        segments = []
+        shift = 0
+        for i in range(count):
+            width = base + (1 if i < extra else 0)
+            segments.append((shift, (1 << width) - 1))
+            shift += width
+        return segments
+
+    @staticmethod
+    def _make_probe_masks(width: int, radius: int) -> List[int]:
+        """生成 width 位内翻转不超过 radius 位的所有异或掩码"""
+        masks = []
+        for count in range(radius + 1):
+            for bits in itertools.combinations(range(width), count):
+                masks.append(sum(1 << bit for bit in bits))
+        return masks
+
+    def _load(self):
+        """从索引文件加载已保存的哈希，有重复、损坏或超出上限的记录时压缩文件"""
+        if not os.path.exists(self.index_file):
+            return
+        entries: Dict[int, Dict[str, Any]] = {}
+        lines = 0
+        try:
+            with open(self.index_file, 'r', encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    lines += 1
+                    try:
+                        entry = json.loads(line)
+                        image_hash = int(entry['hash'], 16)
+                    except (ValueError, KeyError, TypeError):
+                        continue
+                    # 同一哈希保留最后写入的记录，并按最后出现的位置排序
+                    entries.pop(image_hash, None)
+                    entries[image_hash] = entry
+        except Exception as e:
+            logger.error(f"加载感知哈希索引失败: {e}")
+            return
+        kept = list(entries.items())
+        if self.max_entries and len(kept) > self.max_entries:
+            kept = kept[-self.max_entries:]
+        for image_hash, entry in kept:
+            self._insert(image_hash, entry)
+        if len(kept) < lines:
+            self._compact([entry for _, entry in kept])
+            logger.info(f"感知哈希索引已压缩: {lines} 行 -> {len(kept)} 条")
+
+    def _compact(self, entries: List[Dict[str, Any]]):
+        """原子重写索引文件"""
+        tmp_path = f"{self.index_file}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                for entry in entries:
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            os.replace(tmp_path, self.index_file)
+        except Exception as e:
+            logger.error(f"压缩感知哈希索引失败: {e}")
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+    def _insert(self, image_hash: int, entry: Dict[str, Any]) -> bool:
+        if image_hash in self._known:
+            return False
+        idx = len(self._hashes)
+        self._hashes.append(image_hash)
+        self._entries.append(entry)
+        self._known.add(image_hash)
+        for table, (shift, mask) in zip(self._tables, self._segments):
+            table.setdefault((image_hash >> shift) & mask, []).append(idx)
+        return True
+
+    def add(self, image_hash: int, results: List[Dict], file: Optional[str] = None):
+        """登记一张违规图片的哈希及其检测结果，索引文件在后台追加"""
+        if not self.enabled or image_hash is None:
+            return
+        entry = {'hash': f"{image_hash:016x}", 'results': results, 'file': file}
+        if not self._insert(image_hash, entry):
+            return
+        self._pending.append(json.dumps(entry, ensure_ascii=False) + "\n")
+        if self.max_entries:
+            while len(self) > self.max_entries:
+                self._evict_oldest()
+            if self._start >= self.max_entries:
+                self._reindex()
+        if self._flushing is None:
+            self._flush()
+
+    def _evict_oldest(self):
+        """从各段的桶中移除最早的记录，下标位置留空"""
+        idx = self._start
+        image_hash = self._hashes[idx]
+        for table, (shift, mask) in zip(self._tables, self._segments):
+            key = (image_hash >> shift) & mask
+            bucket = table[key]
+            bucket.remove(idx)
+            if not bucket:
+                del table[key]
+        self._known.discard(image_hash)
+        self._entries[idx] = None
+        self._start += 1
+
+    def _reindex(self):
+        """去掉已淘汰的位置重建索引，并把索引文件重写为当前保留的记录"""
+        entries = self._entries[self._start:]
+        hashes = self._hashes[self._start:]
+        self._tables = [{} for _ in self._segments]
+        self._hashes = []
+        self._entries = []
+        self._known = set()
+        self._start = 0
+        for image_hash, entry in zip(hashes, entries):
+            self._insert(image_hash, entry)
+        # 等待追加的行已包含在重写内容中；重写排在写入线程中已提交的追加之后
+        self._pending = []
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._executor.submit(self._compact, entries).result()
+        else:
+            loop.run_in_executor(self._executor, self._compact, entries)
+        logger.info(f"感知哈希索引超过上限，已淘汰最早的记录，保留 {len(entries)} 条")
+
+    def _flush(self):
+        """把等待中的行作为一批交给写入线程，完成后若又有新行则继续下一批"""
+        lines, self._pending = self._pending, []
+        if not lines:
+            self._flushing = None
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._executor.submit(self._append, lines).result()
+            self._flushing = None
+            return
+        self._flushing = loop.run_in_executor(self._executor, self._append, lines)
+        self._flushing.add_done_callback(lambda _: self._flush())
+
+    def _append(self, lines: List[str]):
+        try:
+            directory = os.path.dirname(self.index_file)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.index_file, 'a', encoding='utf-8') as f:
+                f.writelines(lines)
+        except Exception as e:
+            logger.error(f"写入感知哈希索引失败: {e}")
+
+    def close(self):
+        """写入尚未落盘的记录"""
+        lines, self._pending = self._pending, []
+        if lines:
+            self._executor.submit(self._append, lines)
+        self._executor.shutdown(wait=True)
+
+    def lookup(self, image_hash: int) -> Optional[Tuple[int, Dict[str, Any]]]:
+        """查找汉明距离最近且不超过 max_distance 的已知违规图片，返回 (距离, 记录)"""
+        if not self.enabled or image_hash is None or not self._hashes:
+            return None
+        hashes = self._hashes
+        best_distance = self.max_distance + 1
+        best_idx = -1
+        # 同一候选可能出现在多个段的桶中，重复计算距离比去重更便宜
+        for table, (shift, mask) in zip(self._tables, self._segments):
+            key = (image_hash >> shift) & mask
+            for probe in self._probe_masks:
+                for idx in table.get(key ^ probe, ()):
+                    distance = bin(hashes[idx] ^ image_hash).count('1')
+                    if distance < best_distance:
+                        best_distance = distance
+                        best_idx = idx
+            if best_distance == 0:
+                break
+        if best_idx < 0:
+            return None
+        return best_distance, self._entries[best_idx]
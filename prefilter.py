@@ -0,0 +1,149 @@
+import io
+import logging
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from PIL import Image
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# 预筛各层，按判定顺序排列；model 表示未被放行、交给模型检测
+TIERS = ('size', 'uniform', 'text')
+
+PREFILTER_IMAGES = REGISTRY.counter('antisetu_prefilter_images_total', '预筛各层判定的图片数（tier=model 为交给模型的图片）')
+PREFILTER_MISSES = REGISTRY.counter('antisetu_prefilter_misses_total', '评估模式下被预筛放行但模型判定违规的图片数')
+
+# 灰度权重（ITU-R BT.601）
+_LUMA_WEIGHTS = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+
+def compute_signals(image_data: bytes, thumbnail_size: int = 64) -> Optional[Dict[str, Any]]:
+    """在缩略图上计算廉价的图像统计量
+
+    返回原图宽高、帧数；静态图另外返回亮度标准差、肤色像素比例和主色像素比例。
+    动图只返回尺寸信息，避免只看一帧就放行。
+    """
+    try:
+        image = Image.open(io.BytesIO(image_data))
+        width, height = image.size
+        signals = {'width': width, 'height': height, 'frames': getattr(image, 'n_frames', 1)}
+        if signals['frames'] > 1:
+            return signals
+        # JPEG 直接以 1/8 等比例解码，其他格式解码后再缩小
+        image.draft('RGB', (thumbnail_size, thumbnail_size))
+        image = image.convert('RGB')
+        image.thumbnail((thumbnail_size, thumbnail_size), Image.BILINEAR)
+        rgb = np.asarray(image, dtype=np.uint8)
+
+        luma = rgb.astype(np.float32) @ _LUMA_WEIGHTS
+        signals['luma_std'] = float(luma.std())
+
+        # 常用的 YCbCr 肤色范围
+        ycbcr = np.asarray(image.convert('YCbCr'), dtype=np.uint8)
+        cb = ycbcr[..., 1]
+        cr = ycbcr[..., 2]
+        skin = (cb >= 77) & (cb <= 127) & (cr >= 133) & (cr <= 173)
+        signals['skin_ratio'] = float(skin.mean())
+
+        # 每通道量化到 16 级后统计最多的颜色，截图和文字图的背景色占比很高
+        quantized = (rgb >> 4).astype(np.int32)
+        codes = (quantized[..., 0] << 8) | (quantized[..., 1] << 4) | quantized[..., 2]
+        counts = np.bincount(codes.ravel(), minlength=4096)
+        signals['flat_ratio'] = float(counts.max() / codes.size)
+        return signals
+    except Exception as e:
+        logger.debug(f"计算预筛统计量失败: {e}")
+        return None
+
+
+class Prefilter:
+    """模型前的廉价预筛：明显无害的图片（小表情、纯色图、文字截图）直接放行
+
+    各层依次判断：
+    - size：原图长边不超过 tiny_side（小表情）
+    - uniform：亮度标准差低于 uniform_std（纯色或近乎纯色）
+    - text：主色像素占比不低于 flat_ratio 且肤色像素比例不超过 max_skin_ratio（截图、文字梗图）
+    阈值设为 null 即关闭对应一层。评估模式下被放行的图片仍会交给模型检测，用于统计漏检率。
+    """
+
+    def __init__(self, config: Optional[Dict[str, Any]] = None):
+        config = config or {}
+        prefilter_config = config.get('prefilter', {})
+        self.enabled = bool(prefilter_config.get('enabled', False))
+        self.evaluate = bool(prefilter_config.get('evaluate', False))
+        self.thumbnail_size = int(prefilter_config.get('thumbnail_size', 64))
+        self.tiny_side = prefilter_config.get('tiny_side', 64)
+        self.uniform_std = prefilter_config.get('uniform_std', 3.0)
+        self.flat_ratio = prefilter_config.get('flat_ratio', 0.6)
+        self.max_skin_ratio = prefilter_config.get('max_skin_ratio', 0.02)
+        self.counts = {tier: 0 for tier in TIERS + ('model',)}
+        self.evaluated = {tier: 0 for tier in TIERS}
+        self.misses = {tier: 0 for tier in TIERS}
+        self.violations = 0  # 评估模式下模型判定违规的图片总数
+        if self.enabled:
+            logger.info(f"预筛已启用: 评估模式={self.evaluate}, 小图边长={self.tiny_side}, 纯色标准差={self.uniform_std}, "
+                        f"主色占比={self.flat_ratio}, 肤色上限={self.max_skin_ratio}")
+
+    def classify(self, signals: Optional[Dict[str, Any]]) -> Optional[str]:
+        """根据统计量判断放行的层，需要模型检测时返回 None"""
+        if not signals:
+            return None
+        if self.tiny_side is not None and max(signals['width'], signals['height']) <= self.tiny_side:
+            return 'size'
+        if 'luma_std' not in signals:
+            return None
+        if self.uniform_std is not None and signals['luma_std'] < self.uniform_std:
+            return 'uniform'
+        if (self.flat_ratio is not None and self.max_skin_ratio is not None
+                and signals['flat_ratio'] >= self.flat_ratio and signals['skin_ratio'] <= self.max_skin_ratio):
+            return 'text'
+        return None
+
+    def check(self, image_data: bytes) -> Optional[str]:
+        """对一张图片执行预筛，返回放行的层或 None（CPU 计算，应在线程池中调用）"""
+        return self.classify(compute_signals(image_data, self.thumbnail_size))
+
+    def count(self, tier: Optional[str]):
+        """记录一次预筛判定"""
+        self.counts[tier or 'model'] += 1
+        PREFILTER_IMAGES.inc(tier=tier or 'model')
+
+    def record_evaluation(self, tier: Optional[str], violation: bool):
+        """评估模式：记录图片在模型下是否违规，tier 为预筛放行的层（未放行为 None）"""
+        if violation:
+            self.violations += 1
+        if tier is None:
+            return
+        self.evaluated[tier] += 1
+        if violation:
+            self.misses[tier] += 1
+            PREFILTER_MISSES.inc(tier=tier)
+            logger.warning(f"预筛评估：{tier} 层放行的图片被模型判定为违规")
+
+    def stats(self) -> Dict[str, Any]:
+        """各层放行数量、放行比例，评估模式下附带各层漏检率"""
+        total = sum(self.counts.values())
+        cleared = total - self.counts['model']
+        stats: Dict[str, Any] = {
+            'images': total,
+            'counts': dict(self.counts),
+            'cleared_ratio': round(cleared / total, 4) if total else 0.0,
+        }
+        if self.evaluate:
+            evaluated = sum(self.evaluated.values())
+            misses = sum(self.misses.values())
+            # 放行的图片中违规的比例，以及全部违规图片中被预筛漏掉的比例
+            stats['miss_rate'] = round(misses / evaluated, 4) if evaluated else 0.0
+            stats['missed_violation_ratio'] = round(misses / self.violations, 4) if self.violations else 0.0
+            stats['miss_rate_by_tier'] = {
+                tier: round(self.misses[tier] / self.evaluated[tier], 4) if self.evaluated[tier] else 0.0
+                for tier in TIERS
+            }
+        return stats
+
+    @staticmethod
+    def cleared_results(tier: str) -> List[Dict]:
+        """被预筛放行时返回的检测结果"""
+        return [{'label': 'other', 'confidence': 1.0, 'prefilter': tier}]
@@ -0,0 +1,176 @@
+import asyncio
+import logging
+import random
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+RECONNECTS = REGISTRY.counter('antisetu_reconnects_total', 'WebSocket 重连次数（result=ok 成功，failed 失败）')
+CATCH_UP_MESSAGES = REGISTRY.counter(
+    'antisetu_catch_up_messages_total',
+    '重连后补查的历史消息数（scanned=已补查，duplicate=已处理过，expired=超过撤回时限，no_image=无图片）',
+)
+
+
+class ReconnectBackoff:
+    """重连退避：断线后立即重试一次，之后按指数退避并加随机抖动
+
+    连接保持超过 stable_after 秒才算稳定，之后再断线时重新从立即重试开始，
+    避免 NapCat 反复断开时机器人不停地立即重连。
+    """
+
+    def __init__(self, config: Optional[Dict[str, Any]] = None):
+        config = config or {}
+        reconnect_config = config.get('reconnect', {})
+        self.base_delay = float(reconnect_config.get('base_delay', 1))
+        self.max_delay = float(reconnect_config.get('max_delay', 60))
+        self.stable_after = float(reconnect_config.get('stable_after', 30))
+        self.attempt = 0
+        self._connected_at: Optional[float] = None
+
+    def connected(self):
+        self._connected_at = time.monotonic()
+
+    def disconnected(self):
+        if self._connected_at is not None and time.monotonic() - self._connected_at >= self.stable_after:
+            self.attempt = 0
+        self._connected_at = None
+
+    def next_delay(self) -> float:
+        """下一次重连前等待的秒数：第一次为 0，之后上限按 2 倍增长，取上限的一半到全部之间的随机值"""
+        attempt, self.attempt = self.attempt, self.attempt + 1
+        if attempt == 0:
+            return 0.0
+        ceiling = min(self.max_delay, self.base_delay * (2 ** (attempt - 1)))
+        return ceiling / 2 + random.uniform(0, ceiling / 2)
+
+
+def message_key(message: Dict[str, Any]) -> Optional[Tuple[str, Any]]:
+    """群消息的去重键：(群号, 消息ID)，没有消息ID时返回 None（不去重）
+
+    同一群中的多个机器人账号收到的是同一条消息，NapCat 上报的 message_id 相同。
+    """
+    message_id = message.get('message_id')
+    if message_id is None:
+        return None
+    return (str(message.get('group_id', '')), message_id)
+
+
+class SeenMessages:
+    """最近处理过的消息，容量有限，先进先出淘汰"""
+
+    def __init__(self, max_size: int = 50000):
+        self.max_size = max(1, int(max_size))
+        self._ids: "OrderedDict[Any, None]" = OrderedDict()
+
+    def __contains__(self, message_id: Any) -> bool:
+        return message_id in self._ids
+
+    def add(self, message_id: Any) -> bool:
+        """登记消息ID，返回是否为首次出现"""
+        if message_id is None:
+            return True
+        if message_id in self._ids:
+            return False
+        self._ids[message_id] = None
+        if len(self._ids) > self.max_size:
+            self._ids.popitem(last=False)
+        return True
+
+
+class HistoryCatchUp:
+    """重连后补查断线期间的图片
+
+    通过 get_group_msg_history 拉取账号所在的各白名单群最近的消息，跳过已处理过的消息ID和
+    已超过撤回时限的消息，其余按消息时间从早到晚交给 handler 检测；检测排在实时消息之后。
+    """
+
+    def __init__(self, call_action: Callable[[str, Dict[str, Any]], Awaitable[Optional[Dict[str, Any]]]],
+                 handler: Callable[[Dict[str, Any]], Awaitable[None]], config: Optional[Dict[str, Any]] = None):
+        config = config or {}
+        reconnect_config = config.get('reconnect', {})
+        self.call_action = call_action
+        self.handler = handler
+        self.enabled = bool(reconnect_config.get('catch_up', True))
+        self.history_count = int(reconnect_config.get('history_count', 50))
+        self.overlap = float(reconnect_config.get('overlap', 5))
+        self.concurrency = max(1, int(reconnect_config.get('catch_up_concurrency', 4)))
+
+    async def joined_groups(self) -> Optional[Set[str]]:
+        """账号所在的群（get_group_list），获取失败时返回 None，此时补查全部白名单群"""
+        try:
+            response = await self.call_action('get_group_list', {})
+        except Exception as e:
+            logger.debug(f"获取群列表失败: {e}")
+            return None
+        data = (response or {}).get('data')
+        if not isinstance(data, list):
+            return None
+        return {str(group.get('group_id')) for group in data if isinstance(group, dict)}
+
+    async def fetch_history(self, group_id: str) -> List[Dict[str, Any]]:
+        """拉取群最近的消息，失败时返回空列表"""
+        response = await self.call_action('get_group_msg_history', {'group_id': int(group_id), 'count': self.history_count})
+        data = (response or {}).get('data') or {}
+        messages = data.get('messages') if isinstance(data, dict) else None
+        if not messages:
+            return []
+        for message in messages:
+            # 历史消息不一定带群号和事件类型，补齐后与实时事件走同一条处理路径
+            message.setdefault('post_type', 'message')
+            message.setdefault('message_type', 'group')
+            message.setdefault('group_id', int(group_id))
+        return messages
+
+    async def run(self, group_ids: Iterable[str], since: float, seen: SeenMessages,
+                  is_expired: Callable[[Optional[float]], bool], self_id: Optional[str] = None) -> int:
+        """补查 since 之后的消息，返回交给 handler 的消息数"""
+        if not self.enabled:
+            return 0
+        group_ids = [str(group_id) for group_id in group_ids]
+        # 多账号时各账号只补查自己所在的群，不对其他账号的群发起注定失败的查询
+        joined = await self.joined_groups()
+        if joined is not None:
+            group_ids = [group_id for group_id in group_ids if group_id in joined]
+        histories = await asyncio.gather(*[self.fetch_history(group_id) for group_id in group_ids], return_exceptions=True)
+        candidates = []
+        for group_id, history in zip(group_ids, histories):
+            if isinstance(history, Exception):
+                logger.warning(f"拉取群 {group_id} 历史消息失败: {history}")
+                continue
+            if history and len(history) >= self.history_count and min(m.get('time', 0) for m in history) > since:
+                logger.warning(f"群 {group_id} 断线期间消息超过 {self.history_count} 条，更早的消息不再补查")
+            for message in history:
+                message_time = message.get('time') or 0
+                if message_time < since - self.overlap:
+                    continue
+                if self_id and str(message.get('user_id', '')) == str(self_id):
+                    continue
+                segments = message.get('message')
+                if not isinstance(segments, list) or not any(s.get('type') == 'image' for s in segments):
+                    CATCH_UP_MESSAGES.inc(result='no_image')
+                    continue
+                if message_key(message) in seen:
+                    CATCH_UP_MESSAGES.inc(result='duplicate')
+                    continue
+                if is_expired(message_time):
+                    CATCH_UP_MESSAGES.inc(result='expired')
+                    continue
+                candidates.append(message)
+
+        candidates.sort(key=lambda message: message.get('time') or 0)
+        if candidates:
+            logger.info(f"重连后补查 {len(candidates)} 条断线期间的图片消息")
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def handle(message: Dict[str, Any]):
+            async with semaphore:
+                CATCH_UP_MESSAGES.inc(result='scanned')
+                await self.handler(message)
+
+        await asyncio.gather(*[handle(message) for message in candidates])
+        return len(candidates)
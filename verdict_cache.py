@@ -0,0 +1,260 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class VerdictCache:
+    """图片检测结果缓存：内存LRU + 可选的磁盘持久化（SQLite）
+
+    磁盘读写都在后台单线程中使用同一个连接完成，写入期间到达的新记录合并为下一批一次提交，
+    内存未命中时的磁盘查询也不阻塞事件循环；尚未落盘的记录由内存缓存覆盖。
+    """
+
+    def __init__(self, config: Optional[Dict[str, Any]] = None):
+        config = config or {}
+        cache_config = config.get('verdict_cache', {})
+        self.enabled = bool(cache_config.get('enabled', True))
+        self.max_entries = int(cache_config.get('max_entries', 10000))
+        self.ttl_seconds = float(cache_config.get('ttl_seconds', 86400))
+        self.persist_path = cache_config.get('persist_path') or None
+        self.fingerprint = self.make_fingerprint(config)
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._db = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        # 等待写入磁盘的记录，以及正在写入的批次
+        self._pending: List[tuple] = []
+        self._flushing = None
+
+        if self.enabled and self.persist_path:
+            self._open_db()
+        logger.info(f"检测结果缓存: 启用={self.enabled}, 容量={self.max_entries}, TTL={self.ttl_seconds}s, 持久化={self.persist_path}")
+
+    @staticmethod
+    def make_fingerprint(config: Dict[str, Any]) -> str:
+        """根据模型配置（版本/阈值/标签/模型路径）、推理后端和预筛配置生成指纹，配置变化时缓存失效"""
+        model_config = config.get('model_config', {})
+        prefilter_config = config.get('prefilter', {})
+        backend_config = config.get('inference_backend', {})
+        payload = {
+            'version': model_config.get('version'),
+            'labels': model_config.get('labels'),
+            'confidence_threshold': model_config.get('confidence_threshold'),
+            'model_path': config.get('model_path'),
+            # 量化模型的概率与原始模型略有差异，默认后端不计入指纹，已有缓存不失效
+            'backend': backend_config if backend_config.get('type', 'torch') != 'torch' else None,
+            # 预筛直接放行的结果也会进入缓存
+            'prefilter': prefilter_config if prefilter_config.get('enabled') else None,
+        }
+        raw = json.dumps(payload, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def content_key(image_data: bytes) -> str:
+        """按图片内容生成缓存键"""
+        return "sha256:" + hashlib.sha256(image_data).hexdigest()
+
+    @staticmethod
+    def segment_key(segment: Dict[str, Any]) -> Optional[str]:
+        """按OneBot图片消息段的 file_unique / file 字段生成缓存键"""
+        data = segment.get('data', {})
+        file_id = data.get('file_unique') or data.get('file')
+        if not file_id:
+            return None
+        return f"file:{file_id}"
+
+    def _open_db(self):
+        """打开磁盘缓存，并清理模型配置已变化的旧记录"""
+        try:
+            directory = os.path.dirname(self.persist_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # 连接只在这一个线程中使用
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='verdict-cache')
+            self._executor.submit(self._connect).result()
+        except Exception as e:
+            logger.error(f"打开磁盘缓存失败，仅使用内存缓存: {e}")
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
+    def _connect(self):
+        db = sqlite3.connect(self.persist_path)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS verdicts ("
+            "key TEXT PRIMARY KEY, fingerprint TEXT NOT NULL, "
+            "results TEXT NOT NULL, created REAL NOT NULL)"
+        )
+        deleted = db.execute(
+            "DELETE FROM verdicts WHERE fingerprint != ? OR created < ?",
+            (self.fingerprint, time.time() - self.ttl_seconds),
+        ).rowcount
+        db.commit()
+        if deleted:
+            logger.info(f"已清理 {deleted} 条过期或模型配置不一致的缓存记录")
+        self._db = db
+
+    def update_fingerprint(self, config: Dict[str, Any]) -> bool:
+        """模型配置变化时清空缓存，返回是否发生了失效"""
+        fingerprint = self.make_fingerprint(config)
+        if fingerprint == self.fingerprint:
+            return False
+        self.fingerprint = fingerprint
+        self.clear()
+        logger.info("模型配置已变化，检测结果缓存已清空")
+        return True
+
+    def clear(self):
+        """清空内存和磁盘缓存"""
+        self._entries.clear()
+        if self._executor is not None:
+            # 排在已提交的写入之后执行，旧指纹的记录不会在清空后残留
+            self._pending.clear()
+            self._submit(self._clear_disk)
+
+    def _clear_disk(self):
+        try:
+            with self._db:
+                self._db.execute("DELETE FROM verdicts")
+        except Exception as e:
+            logger.error(f"清空磁盘缓存失败: {e}")
+
+    def record_miss(self):
+        """登记一次未命中，用于以 count_miss=False 查找后没有再查的情况"""
+        self.misses += 1
+
+    async def get(self, *keys: Optional[str], count_miss: bool = True) -> Optional[List[Dict]]:
+        """按顺序查找多个键，命中任意一个即返回检测结果
+
+        同一张图片分几次查找时（先按文件ID、下载后再按内容哈希），前几次传 count_miss=False，
+        一张图片只计一次未命中。
+        """
+        if not self.enabled:
+            return None
+        now = time.time()
+        for key in keys:
+            if not key:
+                continue
+            results = self._get_memory(key, now)
+            if results is None:
+                results = await self._get_disk(key, now)
+            if results is not None:
+                self.hits += 1
+                return results
+        if count_miss:
+            self.misses += 1
+        return None
+
+    def _get_memory(self, key: str, now: float) -> Optional[List[Dict]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        created, results = entry
+        if now - created > self.ttl_seconds:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return results
+
+    async def _get_disk(self, key: str, now: float) -> Optional[List[Dict]]:
+        """在后台线程中查询磁盘缓存，排在已提交的写入和清空之后"""
+        if self._executor is None:
+            return None
+        fingerprint = self.fingerprint
+        row = await asyncio.get_running_loop().run_in_executor(self._executor, self._read_row, key, fingerprint)
+        # 查询期间模型配置变化、缓存已清空时丢弃旧结果
+        if row is None or fingerprint != self.fingerprint:
+            return None
+        results, created = json.loads(row[0]), row[1]
+        if now - created > self.ttl_seconds:
+            return None
+        # 提升到内存缓存
+        self._put_memory(key, results, created)
+        return results
+
+    def _read_row(self, key: str, fingerprint: str) -> Optional[tuple]:
+        try:
+            return self._db.execute(
+                "SELECT results, created FROM verdicts WHERE key = ? AND fingerprint = ?",
+                (key, fingerprint),
+            ).fetchone()
+        except Exception as e:
+            logger.error(f"读取磁盘缓存失败: {e}")
+            return None
+
+    def put(self, results: List[Dict], *keys: Optional[str]):
+        """以多个键写入同一份检测结果"""
+        if not self.enabled or not results:
+            return
+        now = time.time()
+        keys = [key for key in keys if key]
+        for key in keys:
+            self._put_memory(key, results, now)
+        if self._executor is not None and keys:
+            payload = json.dumps(results, ensure_ascii=False)
+            self._pending.extend((key, self.fingerprint, payload, now) for key in keys)
+            if self._flushing is None:
+                self._flush()
+
+    def _submit(self, func, *args):
+        """交给写入线程执行；有运行中的事件循环时不等待结果"""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._executor.submit(func, *args).result()
+            return None
+        return loop.run_in_executor(self._executor, func, *args)
+
+    def _flush(self):
+        """把等待中的记录作为一批提交给写入线程，完成后若又有新记录则继续下一批"""
+        rows, self._pending = self._pending, []
+        if not rows:
+            self._flushing = None
+            return
+        self._flushing = self._submit(self._write_rows, rows)
+        if self._flushing is not None:
+            self._flushing.add_done_callback(lambda _: self._flush())
+
+    def _write_rows(self, rows: List[tuple]):
+        try:
+            with self._db:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO verdicts (key, fingerprint, results, created) VALUES (?, ?, ?, ?)",
+                    rows,
+                )
+        except Exception as e:
+            logger.error(f"写入磁盘缓存失败: {e}")
+
+    def _put_memory(self, key: str, results: List[Dict], created: float):
+        self._entries[key] = (created, results)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def hit_ratio(self) -> float:
+        """缓存命中率"""
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def close(self):
+        """写入尚未落盘的记录后关闭磁盘缓存"""
+        if self._executor is not None:
+            rows, self._pending = self._pending, []
+            if rows:
+                self._executor.submit(self._write_rows, rows)
+            self._executor.submit(self._db.close)
+            self._executor.shutdown(wait=True)
+            self._executor = None
+            self._db = None
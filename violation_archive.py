@@ -0,0 +1,315 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+from image_sniff import SNIFF_BYTES, sniff_format
+
+logger = logging.getLogger(__name__)
+
+# 图片格式 -> 保存时的扩展名
+EXTENSIONS = {'JPEG': 'jpg', 'PNG': 'png', 'GIF': 'gif', 'BMP': 'bmp', 'WEBP': 'webp'}
+
+
+class ViolationArchive:
+    """违规图片归档：按内容哈希去重保存，SQLite 索引记录每次违规
+
+    图片保存为 <根目录>/<哈希前2位>/<哈希3-4位>/<哈希>.<扩展名>，同一张图只保存一份；
+    每次违规（群、用户、标签、置信度、时间）在索引中各记一条。写文件和写索引都在
+    后台单线程中完成，不阻塞事件循环。
+    """
+
+    def __init__(self, config: Optional[Dict[str, Any]] = None):
+        config = config or {}
+        archive_config = config.get('violation_archive', {})
+        self.enabled = bool(archive_config.get('enabled', True))
+        self.root = config.get('violation_save_path', 'violations')
+        self.index_path = archive_config.get('index_path') or os.path.join(self.root, 'archive.db')
+        retention_days = archive_config.get('retention_days')
+        self.retention_seconds = float(retention_days) * 86400 if retention_days else None
+        max_total_mb = archive_config.get('max_total_mb')
+        self.max_total_bytes = int(float(max_total_mb) * 1024 * 1024) if max_total_mb else None
+        self.compact_interval = float(archive_config.get('compact_interval', 3600))
+        self.queue_size = int(archive_config.get('queue_size', 1000))
+        self.dropped = 0
+        self.stored = 0
+        self.duplicates = 0
+        self._db: Optional[sqlite3.Connection] = None
+        # SQLite 连接只在这一个线程中使用
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='violation-archive')
+        self._queue: Optional[asyncio.Queue] = None
+        self._writer_task: Optional[asyncio.Task] = None
+        self._compact_task: Optional[asyncio.Task] = None
+        logger.info(f"违规图片归档: 启用={self.enabled}, 目录={self.root}, 保留天数={retention_days}, 容量上限={max_total_mb}MB")
+
+    @staticmethod
+    def relative_path(digest: str, image_format: Optional[str]) -> str:
+        """内容哈希对应的相对保存路径，按哈希前缀分两级目录"""
+        extension = EXTENSIONS.get(image_format or '', 'bin')
+        return os.path.join(digest[:2], digest[2:4], f"{digest}.{extension}")
+
+    def _open_db(self):
+        os.makedirs(self.root, exist_ok=True)
+        directory = os.path.dirname(self.index_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(self.index_path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(
+            "CREATE TABLE IF NOT EXISTS images ("
+            "sha256 TEXT PRIMARY KEY, path TEXT NOT NULL, size INTEGER NOT NULL, "
+            "created REAL NOT NULL, last_seen REAL NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS violations ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, sha256 TEXT NOT NULL, group_id TEXT, user_id TEXT, "
+            "message_id INTEGER, labels TEXT NOT NULL, results TEXT NOT NULL, created REAL NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS idx_violations_created ON violations (created);"
+            "CREATE INDEX IF NOT EXISTS idx_violations_group ON violations (group_id, created);"
+            "CREATE INDEX IF NOT EXISTS idx_violations_user ON violations (user_id, created);"
+            "CREATE INDEX IF NOT EXISTS idx_violations_sha256 ON violations (sha256);"
+            "CREATE INDEX IF NOT EXISTS idx_images_last_seen ON images (last_seen);"
+        )
+        self._db.commit()
+
+    async def start(self):
+        """打开索引并启动后台写入和定期清理任务"""
+        if not self.enabled or self._writer_task is not None:
+            return
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self._executor, self._open_db)
+        except Exception as e:
+            logger.error(f"打开违规图片索引失败，归档已停用: {e}")
+            self.enabled = False
+            return
+        self._queue = asyncio.Queue(self.queue_size)
+        self._writer_task = loop.create_task(self._writer())
+        if self.retention_seconds or self.max_total_bytes:
+            self._compact_task = loop.create_task(self._compact_periodically())
+
+    def submit(self, image_data: bytes, group_id: str, user_id: str, results: List[Dict],
+               labels: List[str], message_id: Optional[int] = None) -> Optional[str]:
+        """登记一张违规图片，立即返回相对保存路径，实际写入在后台完成
+
+        队列已满时丢弃并返回 None。
+        """
+        if not self.enabled or self._queue is None:
+            return None
+        digest = hashlib.sha256(image_data).hexdigest()
+        path = self.relative_path(digest, sniff_format(image_data[:SNIFF_BYTES]))
+        record = {
+            'sha256': digest,
+            'path': path,
+            'group_id': group_id,
+            'user_id': user_id,
+            'message_id': message_id,
+            'labels': labels,
+            'results': results,
+            'created': time.time(),
+        }
+        try:
+            self._queue.put_nowait((record, image_data))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            logger.warning(f"违规图片归档队列已满，丢弃: {path}")
+            return None
+        return path
+
+    async def _writer(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            record, image_data = await self._queue.get()
+            try:
+                written = await loop.run_in_executor(self._executor, self._store, record, image_data)
+                if written:
+                    self.stored += 1
+                    logger.info(f"违规图片已保存到: {os.path.join(self.root, record['path'])}")
+                else:
+                    self.duplicates += 1
+                    logger.info(f"违规图片已存在，仅登记违规记录: {record['path']}")
+            except Exception as e:
+                logger.error(f"保存违规图片失败: {e}")
+            finally:
+                self._queue.task_done()
+
+    def _store(self, record: Dict[str, Any], image_data: bytes) -> bool:
+        """写入图片（已存在则跳过）和违规记录，返回是否写入了新文件"""
+        full_path = os.path.join(self.root, record['path'])
+        written = False
+        if not os.path.exists(full_path):
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            tmp_path = f"{full_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(image_data)
+            os.replace(tmp_path, full_path)
+            written = True
+        with self._db:
+            self._db.execute(
+                "INSERT OR IGNORE INTO images (sha256, path, size, created, last_seen) VALUES (?, ?, ?, ?, ?)",
+                (record['sha256'], record['path'], len(image_data), record['created'], record['created']),
+            )
+            self._db.execute(
+                "UPDATE images SET last_seen = ? WHERE sha256 = ?", (record['created'], record['sha256']))
+            self._db.execute(
+                "INSERT INTO violations (sha256, group_id, user_id, message_id, labels, results, created) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (record['sha256'], record['group_id'], record['user_id'], record['message_id'],
+                 json.dumps(record['labels'], ensure_ascii=False),
+                 json.dumps(record['results'], ensure_ascii=False), record['created']),
+            )
+        return written
+
+    async def _compact_periodically(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await loop.run_in_executor(self._executor, self.compact)
+            except Exception as e:
+                logger.error(f"清理违规图片归档失败: {e}")
+            await asyncio.sleep(self.compact_interval)
+
+    def compact(self) -> Dict[str, int]:
+        """按保留天数删除旧记录，再按容量上限删除最久未出现的图片，返回删除数量"""
+        removed_records = 0
+        removed_images = 0
+        if self.retention_seconds:
+            cutoff = time.time() - self.retention_seconds
+            with self._db:
+                removed_records += self._db.execute(
+                    "DELETE FROM violations WHERE created < ?", (cutoff,)).rowcount
+            # 没有任何违规记录引用的图片一并删除
+            orphans = self._db.execute(
+                "SELECT sha256, path FROM images WHERE sha256 NOT IN (SELECT sha256 FROM violations)"
+            ).fetchall()
+            removed_images += self._remove_images(orphans)
+
+        if self.max_total_bytes:
+            total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM images").fetchone()[0]
+            if total > self.max_total_bytes:
+                victims = []
+                for sha256, path, size in self._db.execute(
+                        "SELECT sha256, path, size FROM images ORDER BY last_seen"):
+                    if total <= self.max_total_bytes:
+                        break
+                    victims.append((sha256, path))
+                    total -= size
+                with self._db:
+                    removed_records += self._db.executemany(
+                        "DELETE FROM violations WHERE sha256 = ?", [(sha256,) for sha256, _ in victims]).rowcount
+                removed_images += self._remove_images(victims)
+
+        if removed_records or removed_images:
+            logger.info(f"违规图片归档清理完成: 删除记录 {removed_records} 条，图片 {removed_images} 张")
+        return {'records': removed_records, 'images': removed_images}
+
+    def _remove_images(self, images: List[tuple]) -> int:
+        for _, path in images:
+            try:
+                os.remove(os.path.join(self.root, path))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning(f"删除归档图片失败: {path}: {e}")
+        with self._db:
+            self._db.executemany("DELETE FROM images WHERE sha256 = ?", [(sha256,) for sha256, _ in images])
+        return len(images)
+
+    def query(self, group_id: Optional[str] = None, user_id: Optional[str] = None, label: Optional[str] = None,
+              since: Optional[float] = None, until: Optional[float] = None, limit: int = 100) -> List[Dict[str, Any]]:
+        """按群、用户、标签和时间范围查询违规记录，按时间倒序"""
+        conditions = []
+        params: List[Any] = []
+        if group_id is not None:
+            conditions.append("v.group_id = ?")
+            params.append(str(group_id))
+        if user_id is not None:
+            conditions.append("v.user_id = ?")
+            params.append(str(user_id))
+        if label is not None:
+            conditions.append("v.labels LIKE ?")
+            params.append(f'%"{label}"%')
+        if since is not None:
+            conditions.append("v.created >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append("v.created < ?")
+            params.append(until)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        rows = self._db.execute(
+            "SELECT v.id, v.sha256, i.path, v.group_id, v.user_id, v.message_id, v.labels, v.results, v.created "
+            f"FROM violations v LEFT JOIN images i ON i.sha256 = v.sha256 {where} "
+            "ORDER BY v.created DESC LIMIT ?",
+            params + [int(limit)],
+        ).fetchall()
+        return [
+            {
+                'id': row[0],
+                'sha256': row[1],
+                'path': os.path.join(self.root, row[2]) if row[2] else None,
+                'group_id': row[3],
+                'user_id': row[4],
+                'message_id': row[5],
+                'labels': json.loads(row[6]),
+                'results': json.loads(row[7]),
+                'created': row[8],
+            }
+            for row in rows
+        ]
+
+    async def search(self, **filters) -> List[Dict[str, Any]]:
+        """在归档线程中执行 query，供事件循环内调用"""
+        if self._db is None:
+            return []
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, lambda: self.query(**filters))
+
+    async def close(self):
+        """写完队列中剩余的图片后关闭索引"""
+        if self._compact_task is not None:
+            self._compact_task.cancel()
+            await asyncio.gather(self._compact_task, return_exceptions=True)
+            self._compact_task = None
+        if self._writer_task is not None:
+            await self._queue.join()
+            self._writer_task.cancel()
+            await asyncio.gather(self._writer_task, return_exceptions=True)
+            self._writer_task = None
+        if self._db is not None:
+            db, self._db = self._db, None
+            await asyncio.get_running_loop().run_in_executor(self._executor, db.close)
+        self._executor.shutdown(wait=True)
+
+
+def _main():
+    """命令行查询违规记录：python violation_archive.py --group 123456 --days 7"""
+    parser = argparse.ArgumentParser(description='查询违规图片归档')
+    parser.add_argument('--config', default='config.json')
+    parser.add_argument('--group', help='群号')
+    parser.add_argument('--user', help='QQ号')
+    parser.add_argument('--label', help='标签，如 porn')
+    parser.add_argument('--days', type=float, help='只看最近几天')
+    parser.add_argument('--limit', type=int, default=100)
+    parser.add_argument('--compact', action='store_true', help='按配置的保留天数和容量上限立即清理')
+    args = parser.parse_args()
+
+    with open(args.config, encoding='utf-8') as f:
+        config = json.load(f)
+    archive = ViolationArchive(config)
+    archive._open_db()
+    if args.compact:
+        print(archive.compact())
+        return
+    since = time.time() - args.days * 86400 if args.days else None
+    for record in archive.query(args.group, args.user, args.label, since=since, limit=args.limit):
+        print(json.dumps(record, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    _main()